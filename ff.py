@@ -7,18 +7,31 @@ game.py - Full integrated bot:
 - Xổ số (/xoso, /chon, auto multi-results, /end)
 - Bầu cua (/baucua)
 - Free Fire simplified (ST & TC) with button-only UI
-- System commands: /menu /help /dangky /diem /top /set /check /lich /tinhyeu /info
-- All game results are posted to GROUP_ID
+- System commands: /menu /help /dangky /diem /top /set /check /lich /tinhyeu /info /sub /unsub /subs
+- All game results are posted to GROUP_ID and mirrored to chats subscribed with /sub
 - Uses m.env for BOT_TOKEN and GROUP_ID
 """
 import os
 import re
+import sys
+import glob
+import mmap
 import json
+import time
+import heapq
+import signal
+import struct
+import sqlite3
 import random
+import itertools
+import bisect
 import asyncio
 import logging
+import multiprocessing
+from array import array
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional
 
 from dotenv import load_dotenv
@@ -26,85 +39,734 @@ from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter
 from telegram.ext import (
-    Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+    Application, ApplicationHandlerStop, CommandHandler, CallbackQueryHandler, ContextTypes,
+    MessageHandler, TypeHandler, filters
 )
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # --- Load env ---
 load_dotenv("m.env")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GROUP_ID = int(os.getenv("GROUP_ID") or 0)
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN not set in m.env")
+BOT_API_URL = os.getenv("BOT_API_URL")  # e.g. a local stand-in from loadtest.py
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)  # Prometheus text on /metrics; 0 = off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or 0)  # receive updates over HTTP instead of polling; 0 = polling
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public URL passed to setWebhook; unset = don't register (local testing)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # expected X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS") or 16)  # updates processed concurrently
+WEBHOOK_QUEUE = int(os.getenv("WEBHOOK_QUEUE") or 1000)  # accepted-but-unprocessed updates before answering 503
+SHARDS = int(os.getenv("SHARDS") or 1)  # >1: worker processes own chats by chat_id, accounts live in ACCOUNTS_DB
+ACCOUNTS_DB = os.getenv("ACCOUNTS_DB", "game_accounts.db")
 if not GROUP_ID:
     print("Warning: GROUP_ID not set in m.env. Results will use the chat where command invoked.")
 
 # --- Config & constants ---
 IMAGES_DIR = "images"
+ASSET_IDS_FILE = "asset_ids.json"  # Telegram file_ids of uploaded images, keyed by name/size/mtime
+ASSET_MAX_BYTES = 1_000_000  # images up to this size are kept in memory
 SAVE_FILE = "game_data.json"
+HISTORY_DIR = "history"  # one binary segment of settled bets per day (per shard)
+HISTORY_FLUSH_INTERVAL = 1.0
+HISTORY_LOOKBACK_DAYS = 30  # how far /lichsu searches back
+HISTORY_CHUNK = 4096  # records unpacked at a time while scanning a segment
+LEDGER_FILE = "game_ledger.jsonl"
+PERSIST_COALESCE = 0.5  # seconds; also the most ledger a crash may lose
+SNAPSHOT_INTERVAL = 300  # compact ledger into SAVE_FILE when idle this long
+SNAPSHOT_MAX_RECORDS = 50_000  # ...or once the ledger tail gets this long
+TOP_CACHE_SIZE = 50  # ranked entries kept per board; /top shows 10
+BOARD_KEEP_DAYS = 14  # day/week boards older than this are dropped
 DEFAULT_TX_COUNTDOWN = 10
 AUTO_CLOSE_AFTER_LAST_BET = 5
 COUNTDOWN_EDIT_INTERVAL = 5
+TG_TEXT_LIMIT = 4096
+TX_BOARD_MAX_CHARS = 3500  # above this the countdown shows a summary (Telegram caps at 4096)
+TX_BOARD_TOP = 10  # bettors listed in the summary
+TX_INTAKE_WINDOW = 0.02  # seconds a burst of presses is gathered before its batch is placed
+TX_INTAKE_BATCH = 500  # most bets placed in one batch
 XOSO_DEFAULT_SESSION = 60
 XOSO_MIN, XOSO_MAX = 1, 20
 XOSO_MAX_CHOICES = 5
+XOSO_ODDS = 4  # each drawn number a player picked pays stake / numbers picked * this
+XOSO_RESULT_TOP = 20  # winners named in the result message
+BAUCUA_SECONDS = 30  # betting window of a Bầu Cua round
+BAUCUA_DEFAULT_STAKE = 100_000
+BAUCUA_RESULT_TOP = 20
 
-MATCHMAKING_MAX_WAIT = 50
+# outbound rate limits (Telegram: ~30 msg/s overall, ~20/min per group)
+OUT_GLOBAL_RATE = 25
+OUT_GROUP_RATE = 20 / 60
+OUT_CHAT_RATE = 1
+OUT_CHAT_BURST = 3
+OUT_CONCURRENCY = 8
+OUT_EDIT_MAX_AGE = 15  # queued countdown edits older than this are dropped
+OUT_SCAN_LIMIT = 500  # queued items inspected per lane when picking the next send
+OUT_MIRROR_RATE = 20  # of OUT_GLOBAL_RATE, the most that result mirrors to subscribers may use
+OUT_MIRROR_MAX_AGE = 300  # queued mirrors older than this are dropped
+FANOUT_MAX_FAILURES = 5  # consecutive failed sends before a subscriber is dropped
+FANOUT_RELOAD = 30  # shard workers re-read the shared subscriber list this often
+
+MATCHMAKING_MAX_WAIT = 50  # longest a queued FF player waits; then the match starts with whoever is nearest
 LOBBY_SPAWN_SECONDS = 5  # as you wanted 5s into match
 PLANE_WAIT = 30
 BUY_SECONDS = 15
 COMBAT_SECONDS = 75  # 1m15s as requested
 MIN_ST_PLAYERS = 1  # you said no minimum
+FF_TICK = 1  # seconds between combat ticks
+FF_SHOTS_DIVISOR = 4  # shots per tick = 1 + alive // this
+FF_FEED_INTERVAL = 15  # seconds between kill-feed digests
+FF_FEED_LINES = 15
+FF_MATCH_SIZE = 8  # players per cross-chat match (4v4 in Tử Chiến)
+FF_MATCH_MIN = 2  # fewest players a timed-out ticket starts a match with
+FF_QUEUE_INTERVAL = 1  # seconds between matchmaking passes while someone is queued
+FF_RATING_START = 1000
+FF_RATING_BUCKET = 100  # rating points per matchmaking bucket
+FF_WIDEN_SECONDS = 10  # a queued player's window widens by one bucket each side this often
+FF_RATING_KILL = 10
+FF_RATING_WIN = 25
+FF_RATING_LOSS = 10
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+ACCOUNT_STRIPES = 64  # per-user lock stripes in the account engine
+REGISTER_AMOUNT = 100_000
+LOOP_LAG_INTERVAL = 0.5  # how often the event-loop lag probe wakes up
+DRAIN_TIMEOUT = 20  # seconds shutdown waits for queued updates and outgoing results
+SESSION_CHAT_CAP = 3  # live game sessions one chat may hold at once
+SESSION_SWEEP_INTERVAL = 60
+SESSION_GRACE = 120  # a round still registered this long after betting closed is evicted (and refunded)
+FF_LOBBY_IDLE = 600  # unstarted FF lobbies untouched this long are dropped
+FF_MATCH_MAX = 900  # started FF matches still registered after this long are dropped
+RNG_BACKEND = "numpy" if np is not None else "python"
+RNG_FIRST_BLOCK = 16  # floats pregenerated when a round first draws
+RNG_BLOCK = 4096  # largest pregenerated block
+CHAT_CACHE_SIZE = 10_000  # get_chat results kept for /check
+CHAT_CACHE_TTL = 3600
+CHAT_CACHE_MISS_TTL = 300  # unknown usernames are not asked again for this long
 
 # --- Logging ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("gamebot")
 
+# --- Clock & game events ---
+# Wall-clock time goes through `clock` and waits go through `timers` (loop
+# time), so sim.py can run every game on a virtual clock.
+class Clock:
+    def time(self) -> float:
+        return time.time()
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self.time())
+
+clock = Clock()
+event_listeners: List = []  # callables (kind, data) receiving structured game events
+
+def emit(kind:str, **data):
+    for fn in event_listeners:
+        try:
+            fn(kind, data)
+        except Exception as e:
+            logger.exception("event listener error: %s", e)
+
+# --- Metrics ---
+# Counters and latency histograms kept in memory and rendered in the Prometheus
+# text format on METRICS_PORT. Labels are keyword arguments; values owned by
+# other components (queue depths, session counts) are read at scrape time.
+def _labels(pairs, extra: tuple=()) -> str:
+    parts = [f'{k}="{v}"' for k,v in (*pairs, *extra)]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)  # last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, v)] += 1
+        self.sum += v
+
+class Metrics:
+    def __init__(self):
+        self.meta: Dict[str, tuple] = {}  # name -> (type, help), in output order
+        self.counters: Dict[str, Dict[tuple, float]] = defaultdict(lambda: defaultdict(float))
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = defaultdict(dict)
+        self.collectors: Dict[str, object] = {}  # name -> fn() -> value or {label pairs: value}
+
+    def describe(self, name:str, kind:str, text:str, collect=None):
+        self.meta[name] = (kind, text)
+        if collect is not None:
+            self.collectors[name] = collect
+
+    def inc(self, name:str, amount:float=1, **labels):
+        self.counters[name][tuple(sorted(labels.items()))] += amount
+
+    def observe(self, name:str, value:float, **labels):
+        key = tuple(sorted(labels.items()))
+        h = self.histograms[name].get(key)
+        if h is None:
+            h = self.histograms[name][key] = Histogram()
+        h.observe(value)
+
+    def timed(self, name:str, fn, **labels):
+        """Wrap an async handler so its latency lands in histogram `name`."""
+        async def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - t0, **labels)
+        return wrapper
+
+    def render(self) -> str:
+        out = []
+        for name, (kind, text) in self.meta.items():
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for pairs, h in self.histograms[name].items():
+                    acc = 0
+                    for le, n in zip(METRIC_BUCKETS + ("+Inf",), h.counts):
+                        acc += n
+                        out.append(f"{name}_bucket{_labels(pairs, (('le', le),))} {acc}")
+                    out.append(f"{name}_sum{_labels(pairs)} {h.sum}")
+                    out.append(f"{name}_count{_labels(pairs)} {acc}")
+                continue
+            if name in self.collectors:
+                v = self.collectors[name]()
+                series = v.items() if isinstance(v, dict) else [((), v)]
+            else:
+                series = self.counters[name].items()
+            for pairs, v in series:
+                out.append(f"{name}{_labels(pairs)} {v}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+def count_bet(game:str, amount:int, n:int=1):
+    metrics.inc("gamebot_bets_total", n, game=game)
+    metrics.inc("gamebot_bet_amount_total", amount, game=game)
+
+def count_payout(game:str, amount:int):
+    metrics.inc("gamebot_payout_amount_total", amount, game=game)
+
 # --- In-memory stores (persisted minimally to SAVE_FILE) ---
+def name_key(name:str) -> str:
+    return name.lstrip("@").lower()
+
+class UserNames(dict):
+    """uid -> display name, plus a normalized name -> uid index kept in step for /check."""
+    def __init__(self):
+        super().__init__()
+        self.by_name: Dict[str,int] = {}
+
+    def __setitem__(self, uid:int, name:str):
+        old = self.get(uid)
+        if old == name:
+            return
+        if old and self.by_name.get(name_key(old)) == uid:
+            del self.by_name[name_key(old)]
+        super().__setitem__(uid, name)
+        if name:
+            self.by_name[name_key(name)] = uid
+
+    def __delitem__(self, uid:int):
+        old = self[uid]
+        super().__delitem__(uid)
+        if old and self.by_name.get(name_key(old)) == uid:
+            del self.by_name[name_key(old)]
+
+    def find(self, name:str) -> Optional[int]:
+        return self.by_name.get(name_key(name))
+
 balances: Dict[int,int] = defaultdict(int)
-user_names: Dict[int,str] = {}
+user_names: Dict[int,str] = UserNames()
 leaderboard: Dict[int,int] = defaultdict(int)
-tx_sessions = {}   # chat_id -> TxSession
-xoso_sessions = {}
-baucua_sessions = {}
-ff_lobbies = {}
+ff_ratings: Dict[int,int] = {}  # uid -> Free Fire matchmaking rating
+subscriptions: Dict[int, List[str]] = {}  # chat_id -> games whose results are mirrored there
+
+# --- Leaderboard index ---
+# Every scope (global, per chat, per day, per week) keeps its scores plus a
+# cached top list that is patched on each update, so /top never sorts all users.
+class TopBoard:
+    def __init__(self, scores: Optional[Dict[int,int]] = None):
+        self.scores: Dict[int,int] = scores if scores is not None else {}
+        self._top: List[int] = []  # uids, best first, at most TOP_CACHE_SIZE
+        self._bound = None  # upper bound on any score outside _top
+        self._stale = True
+
+    def add(self, uid:int, delta:int):
+        new = self.scores.get(uid,0) + delta
+        self.scores[uid] = new
+        if self._stale:
+            return
+        top = self._top
+        sc = self.scores
+        if uid in top:
+            if delta >= 0 or self._bound is None or new >= self._bound:
+                top.sort(key=sc.__getitem__, reverse=True)
+            else:
+                self._stale = True  # someone outside the cache may now rank higher
+        elif len(top) < TOP_CACHE_SIZE:
+            top.append(uid)  # cache holds everyone while the board is small
+            top.sort(key=sc.__getitem__, reverse=True)
+        elif new > sc[top[-1]]:
+            out = top.pop()
+            top.append(uid)
+            top.sort(key=sc.__getitem__, reverse=True)
+            self._bound = sc[out] if self._bound is None else max(self._bound, sc[out])
+        else:
+            self._bound = new if self._bound is None else max(self._bound, new)
+
+    def add_many(self, deltas: List[tuple]):
+        """add() for a settled round; a big batch just re-ranks on the next top()."""
+        if len(deltas) <= TOP_CACHE_SIZE:
+            for uid, d in deltas:
+                self.add(uid, d)
+            return
+        sc = self.scores
+        for uid, d in deltas:
+            sc[uid] = sc.get(uid,0) + d
+        self._stale = True
+
+    def top(self, n:int=10):
+        if self._stale:
+            best = heapq.nlargest(TOP_CACHE_SIZE + 1, self.scores.items(), key=lambda kv: kv[1])
+            self._top = [uid for uid,_ in best[:TOP_CACHE_SIZE]]
+            self._bound = best[TOP_CACHE_SIZE][1] if len(best) > TOP_CACHE_SIZE else None
+            self._stale = False
+        return [(uid, self.scores[uid]) for uid in self._top[:n]]
+
+def period_keys(ts: float):
+    d = datetime.fromtimestamp(ts)
+    y, w, _ = d.isocalendar()
+    return f"d:{d:%Y-%m-%d}", f"w:{y}-W{w:02d}"
+
+class LeaderboardIndex:
+    """Boards keyed "g", "c:<chat_id>", "d:<YYYY-MM-DD>" and "w:<YYYY-Www>"."""
+    def __init__(self):
+        self.boards: Dict[str, TopBoard] = {"g": TopBoard(leaderboard)}
+        self.cells = BoardCells(self)
+
+    def board(self, key:str) -> TopBoard:
+        b = self.boards.get(key)
+        if b is None:
+            b = self.boards[key] = TopBoard()
+            if key[0] in "dw":
+                self._prune()
+        return b
+
+    def add(self, uid:int, delta:int, chat_id:Optional[int]=None, ts:Optional[float]=None):
+        """Apply a score delta to every scope."""
+        self.add_many([(uid, delta)], chat_id, ts)
+
+    def add_many(self, deltas: List[tuple], chat_id:Optional[int]=None, ts:Optional[float]=None):
+        """Apply (uid, delta) pairs sharing one chat and time to every scope."""
+        self.boards["g"].add_many(deltas)
+        keys = list(period_keys(ts)) if ts else []
+        if chat_id:
+            keys.append(f"c:{chat_id}")
+        for k in keys:
+            self.board(k).add_many(deltas)
+            persist.touch_many("board_scores", [f"{k}|{uid}" for uid, _ in deltas])
+
+    def top(self, key:str, n:int=10):
+        b = self.boards.get(key)
+        return b.top(n) if b else []
+
+    def _prune(self):
+        now = clock.now()
+        keep = set()
+        for i in range(BOARD_KEEP_DAYS):
+            keep.update(period_keys((now - timedelta(days=i)).timestamp()))
+        for k in [k for k in self.boards if k[0] in "dw" and k not in keep]:
+            for uid in self.boards.pop(k).scores:
+                persist.touch("board_scores", f"{k}|{uid}")  # drop from the snapshot too
+
+class BoardCells:
+    """Flat "<board>|<uid>" -> score view of the scoped boards, used as a persistence table."""
+    def __init__(self, index: "LeaderboardIndex"):
+        self.index = index
+
+    def get(self, key:str, default=None):
+        bk, _, uid = key.rpartition("|")
+        b = self.index.boards.get(bk)
+        return b.scores.get(int(uid), default) if b else default
+
+    def items(self):
+        for bk, b in self.index.boards.items():
+            if bk != "g":
+                for uid, v in b.scores.items():
+                    yield f"{bk}|{uid}", v
+
+    def __setitem__(self, key:str, v:int):
+        bk, _, uid = key.rpartition("|")
+        self.index.board(bk).scores[int(uid)] = v
+
+score_boards = LeaderboardIndex()
 
 # --- Persistence helpers ---
+# State lives in SAVE_FILE (a compacted snapshot) plus LEDGER_FILE, an
+# append-only log of balance/leaderboard deltas written since that snapshot.
+# Handlers only mutate memory and mark keys dirty; a background worker
+# coalesces bursts and does all file I/O on a single writer thread.
+PERSIST_TABLES = {"balances": balances, "user_names": user_names, "leaderboard": leaderboard,
+                  "board_scores": score_boards.cells, "ff_ratings": ff_ratings, "subscriptions": subscriptions}
+INT_KEY_TABLES = {"balances", "user_names", "leaderboard", "ff_ratings", "subscriptions"}
+LEDGER_TABLES = ("balances", "leaderboard")  # tables a ledger record dirties; names go through remember_user
+
+class Persistence:
+    def __init__(self):
+        self.seq = 0
+        self.pending: List[dict] = []  # ledger records not yet handed to the writer
+        self.dirty: Dict[str, set] = defaultdict(set)  # table -> keys changed since the last flush
+        self.mirror: Dict[str, dict] = {t: {} for t in PERSIST_TABLES}  # writer-thread copy of flushed state
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+        self._fh = None
+        self._wake: Optional[asyncio.Event] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+        self._unsnapshotted = 0
+        self.enabled = True  # off for headless simulation
+
+    def record(self, rec: dict):
+        if not self.enabled:
+            return
+        self.seq += 1
+        rec["s"] = self.seq
+        self.pending.append(rec)
+        uids = [r[0] for r in rec["b"]] if "b" in rec else (rec["u"],)
+        for t in LEDGER_TABLES:
+            self.dirty[t].update(uids)
+        self.request()
+
+    def touch(self, table: str, key):
+        if not self.enabled:
+            return
+        self.dirty[table].add(key)
+        self.request()
+
+    def touch_many(self, table: str, keys):
+        if not self.enabled:
+            return
+        self.dirty[table].update(keys)
+        self.request()
+
+    def request(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    def load_mirror(self):
+        for t, live in PERSIST_TABLES.items():
+            self.mirror[t] = dict(live.items())  # board_scores is a view with items() only
+
+    async def run(self):
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=SNAPSHOT_INTERVAL)
+                await asyncio.sleep(PERSIST_COALESCE)  # let the burst finish
+                await self.flush()
+            except asyncio.TimeoutError:
+                if self._unsnapshotted:
+                    await self.flush(snapshot=True)
+            except Exception as e:
+                logger.exception("persistence worker error: %s", e)
+
+    async def flush(self, snapshot: bool=False):
+        """Hand everything dirty to the writer thread and wait until it is on disk."""
+        if self._wake is not None:
+            self._wake.clear()
+        lines, self.pending = self.pending, []
+        dirty, self.dirty = self.dirty, defaultdict(set)
+        # O(dirty) copy on the loop; serialization happens on the writer thread
+        rows = [(t, k, PERSIST_TABLES[t].get(k)) for t, keys in dirty.items() for k in keys]
+        self._unsnapshotted += len(lines)
+        snapshot = snapshot or self._unsnapshotted >= SNAPSHOT_MAX_RECORDS
+        if snapshot:
+            self._unsnapshotted = 0
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        await loop.run_in_executor(self._executor, self._write, lines, rows, self.seq, snapshot)
+        self.flushes += 1
+        self.last_flush_seconds = loop.time() - t0
+        metrics.observe("gamebot_persist_flush_seconds", self.last_flush_seconds, snapshot=str(snapshot).lower())
+
+    def _write(self, lines: List[dict], rows: list, seq: int, snapshot: bool):
+        try:
+            if lines:
+                if self._fh is None:
+                    self._fh = open(LEDGER_FILE, "a", encoding="utf-8")
+                self._fh.write("".join(json.dumps(r, separators=(",", ":")) + "\n" for r in lines))
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+            for t, k, v in rows:
+                if v is None:
+                    self.mirror[t].pop(k, None)
+                else:
+                    self.mirror[t][k] = v
+            if snapshot:
+                self._snapshot(seq)
+        except Exception as e:
+            logger.exception("Error saving data: %s", e)
+
+    def _snapshot(self, seq: int):
+        data = {"seq": seq}
+        for t, m in self.mirror.items():
+            data[t] = {str(k): v for k,v in m.items()}
+        tmp = SAVE_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, SAVE_FILE)
+        # everything up to seq is in the snapshot now
+        if self._fh is not None:
+            self._fh.close()
+        self._fh = open(LEDGER_FILE, "w", encoding="utf-8")
+
+persist = Persistence()
+shared: Optional["SharedAccounts"] = None  # set in shard workers; replaces the ledger for accounts
+
+def apply_record(rec: dict):
+    """Apply one ledger record to the in-memory stores (used for live writes and replay).
+    Bulk records carry "b": [[uid, delta, lb], ...] sharing one kind/chat/ts."""
+    chat_id = rec.get("c"); ts = rec.get("ts")
+    scores = []
+    for uid, d, l in (rec["b"] if "b" in rec else ((rec["u"], rec.get("d"), rec.get("l")),)):
+        if d:
+            balances[uid] += d
+        if l:
+            scores.append((uid, l))
+    if scores:
+        score_boards.add_many(scores, chat_id, ts)
+
+def apply_delta(uid:int, delta:int, kind:str, lb:int=0, chat_id:Optional[int]=None):
+    """Change a balance (and optionally the leaderboard) and log it to the ledger.
+    kind: reg / bet / payout / loss / liixi / baucua"""
+    rec = {"k": kind, "u": uid, "d": delta}
+    if lb:
+        rec["l"] = lb
+        rec["ts"] = int(clock.time())
+        if chat_id:
+            rec["c"] = chat_id
+    if shared is not None:
+        shared.apply(rec)
+        return
+    apply_record(rec)
+    persist.record(rec)
+
+def debit(uid:int, amount:int, kind:str) -> bool:
+    """Take a stake only if the balance covers it; the check and the write are one step."""
+    if shared is not None:
+        return shared.debit(uid, amount)
+    if balances.get(uid,0) < amount:
+        return False
+    apply_delta(uid, -amount, kind)
+    return True
+
+def debit_many(items: List[tuple], kind:str) -> List[bool]:
+    """debit for a batch of (uid, amount), logged as one bulk record. A uid may
+    appear more than once; each of its stakes must be covered by what is left."""
+    if shared is not None:
+        return shared.debit_many(items)
+    spent = defaultdict(int)
+    ok, rows = [], []
+    for uid, amount in items:
+        if 0 < amount <= balances.get(uid,0) - spent[uid]:
+            spent[uid] += amount
+            rows.append((uid, -amount, 0))
+            ok.append(True)
+        else:
+            ok.append(False)
+    apply_bulk(rows, kind)
+    return ok
+
+def top_up(uid:int, target:int, kind:str) -> int:
+    """Raise a balance that is at or below zero to target; returns the amount credited."""
+    if shared is not None:
+        return shared.top_up(uid, target)
+    bal = balances.get(uid,0)
+    if bal > 0:
+        return 0
+    apply_delta(uid, target - bal, kind)
+    return target - bal
+
+def apply_bulk(rows: List[tuple], kind:str, chat_id:Optional[int]=None):
+    """apply_delta for many (uid, delta, lb) rows at once, logged as one ledger record."""
+    if not rows:
+        return
+    rec = {"k": kind, "b": list(rows), "ts": int(clock.time())}
+    if chat_id:
+        rec["c"] = chat_id
+    if shared is not None:
+        shared.apply(rec)
+        return
+    apply_record(rec)
+    persist.record(rec)
+
 def load_data():
+    seq = 0
     try:
         with open(SAVE_FILE, "r", encoding="utf-8") as f:
             data = json.load(f)
-        for k,v in data.get("balances",{}).items():
-            balances[int(k)] = v
-        for k,v in data.get("user_names",{}).items():
-            user_names[int(k)] = v
-        for k,v in data.get("leaderboard",{}).items():
-            leaderboard[int(k)] = v
+        for t, live in PERSIST_TABLES.items():
+            for k,v in data.get(t,{}).items():
+                live[int(k) if t in INT_KEY_TABLES else k] = v
+        seq = data.get("seq", 0)
         logger.info("Loaded data")
     except FileNotFoundError:
         logger.info("No save file")
     except Exception as e:
         logger.exception("Error loading data: %s", e)
-
-def save_data():
+    # replay ledger tail written after the snapshot
+    replayed = 0
     try:
-        data = {
-            "balances": {str(k): v for k,v in balances.items()},
-            "user_names": {str(k): v for k,v in user_names.items()},
-            "leaderboard": {str(k): v for k,v in leaderboard.items()},
-        }
-        with open(SAVE_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with open(LEDGER_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # torn write at crash time
+                if rec.get("s", 0) <= seq:
+                    continue
+                apply_record(rec)
+                seq = rec["s"]
+                replayed += 1
+        logger.info("Replayed %d ledger records", replayed)
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        logger.exception("Error saving data: %s", e)
+        logger.exception("Error replaying ledger: %s", e)
+    persist.seq = seq
+    persist._unsnapshotted = replayed
+    persist.load_mirror()
 
-# Register periodic save
-async def periodic_save_task():
-    while True:
-        await asyncio.sleep(30)
-        save_data()
+# --- Accounts ---
+# Handlers never touch balances directly. A stake is reserved (checked and
+# deducted in one step) when the bet is placed; the round later settles what it
+# reserved together with all payouts as one bulk ledger record, or refunds it.
+# Each user's operations run under one of ACCOUNT_STRIPES locks picked by uid,
+# so only users sharing a stripe ever wait on each other. In sharded mode the
+# SQLite writes run on the account thread, and the locks keep one user's
+# operations in order while the event loop serves everyone else.
+class AccountEngine:
+    def __init__(self, stripes:int=ACCOUNT_STRIPES):
+        self.locks = [asyncio.Lock() for _ in range(stripes)]
+        self.held = 0  # reserved by open rounds, not yet settled or refunded
+        self.stats = defaultdict(int)  # reserved / rejected / refunded / settled / credited
+
+    def lock(self, uid:int) -> asyncio.Lock:
+        return self.locks[uid % len(self.locks)]
+
+    async def _call(self, fn, *args):
+        if shared is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(shared.executor, fn, *args)
+
+    async def reserve(self, uid:int, amount:int, kind:str) -> bool:
+        if amount <= 0:
+            return False
+        async with self.lock(uid):
+            ok = await self._call(debit, uid, amount, kind)
+        self.stats["reserved" if ok else "rejected"] += 1
+        if ok:
+            self.held += amount
+        return ok
+
+    async def reserve_many(self, items: List[tuple], kind:str) -> List[bool]:
+        """reserve for a batch of (uid, amount) in one pass; the stripes involved are
+        taken in order, so batches never deadlock with each other."""
+        locks = [self.locks[i] for i in sorted({uid % len(self.locks) for uid, _ in items})]
+        for lk in locks:
+            await lk.acquire()
+        try:
+            ok = await self._call(debit_many, items, kind)
+        finally:
+            for lk in locks:
+                lk.release()
+        taken = sum(a for (_, a), k in zip(items, ok) if k)
+        self.held += taken
+        self.stats["reserved"] += sum(ok)
+        self.stats["rejected"] += len(ok) - sum(ok)
+        return ok
+
+    async def refund(self, uid:int, amount:int, kind:str="refund"):
+        async with self.lock(uid):
+            await self._call(apply_delta, uid, amount, kind)
+        self.held -= amount
+        self.stats["refunded"] += 1
+
+    async def refund_round(self, stakes: List[tuple], chat_id:Optional[int]=None):
+        """Give back every (uid, amount) a round reserved, as one batch."""
+        self.held -= sum(a for _, a in stakes)
+        await self._call(apply_bulk, [(uid, a, 0) for uid, a in stakes], "refund", chat_id)
+        self.stats["refunded"] += len(stakes)
+
+    async def settle(self, staked:int, rows: List[tuple], kind:str, chat_id:Optional[int]=None):
+        """Close a round: its reserved stakes are spent and rows (uid, payout, leaderboard
+        delta) are credited in one batch. Credits commute, so no per-user lock is needed."""
+        self.held -= staked
+        await self._call(apply_bulk, rows, kind, chat_id)
+        self.stats["settled"] += 1
+
+    async def credit(self, uid:int, amount:int, kind:str):
+        async with self.lock(uid):
+            await self._call(apply_delta, uid, amount, kind)
+        self.stats["credited"] += 1
+
+    async def register(self, uid:int, amount:int=REGISTER_AMOUNT) -> int:
+        async with self.lock(uid):
+            return await self._call(top_up, uid, amount, "reg")
+
+    async def balance(self, uid:int) -> int:
+        return await self._call(balances.get, uid, 0)
+
+accounts = AccountEngine()
 
 # --- Utilities ---
+def remember_user(user) -> str:
+    """Store the caller's display name; only a changed name is written and persisted."""
+    name = user.username or user.full_name
+    if user_names.get(user.id) != name:
+        user_names[user.id] = name
+        persist.touch("user_names", user.id)
+    return name
+
+class TTLCache:
+    """Small LRU map whose entries also expire; get() returns MISSING when absent or stale."""
+    MISSING = object()
+
+    def __init__(self, size:int, ttl:float):
+        self.size = size
+        self.ttl = ttl
+        self.data: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key:str):
+        hit = self.data.get(key)
+        if hit is None:
+            return self.MISSING
+        if hit[0] <= clock.time():
+            del self.data[key]
+            return self.MISSING
+        self.data.move_to_end(key)
+        return hit[1]
+
+    def put(self, key:str, value, ttl:Optional[float]=None):
+        self.data[key] = (clock.time() + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+chat_cache = TTLCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL)  # normalized @username -> chat id (None: not found)
+
 AMOUNT_RE = re.compile(r"""^([0-9]+(?:[.,][0-9]+)?)\s*([kKmMtT]?)$""")
 SUFFIX_MULT = {"":1,"k":1000,"K":1000,"m":1_000_000,"M":1_000_000,"t":1_000_000_000,"T":1_000_000_000}
 
@@ -127,27 +789,924 @@ def fmt_amount(v:int)->str:
     if v>=1000: return f"{v//1000}k"
     return str(v)
 
-def image_path(name:str)->Optional[str]:
-    p = os.path.join(IMAGES_DIR, name)
-    return p if os.path.exists(p) else None
+def chunk_lines(lines: List[str], limit:int=TG_TEXT_LIMIT) -> List[str]:
+    """Join lines into as few messages as fit Telegram's text limit."""
+    chunks, cur, size = [], [], 0
+    for line in lines:
+        if len(line) > limit:
+            line = line[:limit - 1] + "…"
+        if cur and size + len(line) + 1 > limit:
+            chunks.append("\n".join(cur))
+            cur, size = [], 0
+        cur.append(line)
+        size += len(line) + 1
+    if cur:
+        chunks.append("\n".join(cur))
+    return chunks
+
+# --- Assets ---
+# IMAGES_DIR is scanned once. After the first upload of an image Telegram's
+# file_id is kept and sent instead of the bytes; ids are saved to ASSET_IDS_FILE
+# with the file's size and mtime, so an edited image is uploaded again.
+class Asset:
+    __slots__ = ("name", "path", "size", "mtime", "data", "file_id")
+
+    def __init__(self, name:str, path:str, size:int, mtime:float):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.data: Optional[bytes] = None
+        self.file_id: Optional[str] = None
+
+    def payload(self):
+        if self.file_id:
+            return self.file_id
+        if self.data is not None:
+            return self.data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+class AssetRegistry:
+    def __init__(self, directory:str=IMAGES_DIR, ids_file:str=ASSET_IDS_FILE):
+        self.directory = directory
+        self.ids_file = ids_file
+        self.assets: Optional[Dict[str, Asset]] = None
+
+    def scan(self):
+        self.assets = {}
+        try:
+            with open(self.ids_file, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = {}
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            entries = []
+        for e in entries:
+            if not e.is_file():
+                continue
+            st = e.stat()
+            a = Asset(e.name, e.path, st.st_size, st.st_mtime)
+            if st.st_size <= ASSET_MAX_BYTES:
+                with open(e.path, "rb") as f:
+                    a.data = f.read()
+            ent = saved.get(e.name)
+            if ent and ent.get("size") == a.size and ent.get("mtime") == a.mtime:
+                a.file_id = ent.get("id")
+            self.assets[e.name] = a
+        logger.info("Assets: %d images, %d with cached file_id", len(self.assets),
+                    sum(1 for a in self.assets.values() if a.file_id))
+
+    def get(self, name:str) -> Optional[Asset]:
+        if self.assets is None:
+            self.scan()
+        return self.assets.get(name)
+
+    def record_send(self, asset: Asset, used_id: Optional[str], msg):
+        """Outbox callback: keep the uploaded photo's file_id, or drop one Telegram rejected."""
+        if msg is None:
+            if used_id and asset.file_id == used_id:
+                asset.file_id = None  # e.g. a different bot token; upload next time
+                self.save()
+            return
+        if not used_id and getattr(msg, "photo", None):
+            asset.file_id = msg.photo[-1].file_id
+            self.save()
+
+    def save(self):
+        data = {a.name: {"id": a.file_id, "size": a.size, "mtime": a.mtime} for a in self.assets.values() if a.file_id}
+        tmp = self.ids_file + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.ids_file)
+        except OSError as e:
+            logger.warning("could not save %s: %s", self.ids_file, e)
+
+assets = AssetRegistry()
+
+# --- History archive ---
+# Every settled bet is appended as a fixed-size record to HISTORY_DIR/YYYYMMDD.bin.
+# Segments are only ever appended to and are read through mmap in chunks, so
+# queries stream over disk instead of holding the history in memory. Totals per
+# segment are kept with the byte offset they cover, so repeating a board query
+# only reads what was appended since. Each round's seed and outcome also go to
+# HISTORY_DIR/YYYYMMDD.rounds.jsonl, so it can be replayed (see replay_round).
+HIST_REC = struct.Struct("<IqqqqBB2x")  # ts, chat_id, uid, stake, payout, game, flags
+HIST_GAMES = ("tx", "xoso", "baucua", "ff")
+HIST_GAME_NAMES = {"tx": "Tài/Xỉu", "xoso": "Xổ số", "baucua": "Bầu Cua", "ff": "Free Fire"}
+HIST_WON = 1
+HIST_UID_OFFSET = 12  # byte offset of uid inside a record
+
+def history_days(scope:str) -> List[str]:
+    """Segment days for "ngay" (today), "tuan" (this ISO week) or the /lichsu lookback, newest first."""
+    today = clock.now()
+    n = 1 if scope == "ngay" else today.isoweekday() if scope == "tuan" else HISTORY_LOOKBACK_DAYS
+    return [(today - timedelta(days=i)).strftime("%Y%m%d") for i in range(n)]
+
+class HistoryArchive:
+    def __init__(self, path:str=HISTORY_DIR):
+        self.path = path
+        self.suffix = ""  # shard workers each write their own segment per day
+        self.enabled = True  # off for headless simulation
+        self.buf: Dict[str, bytearray] = defaultdict(bytearray)  # day -> packed records not yet written
+        self.rounds: Dict[str, List[str]] = defaultdict(list)  # day -> round log lines not yet written
+        self.records = 0
+        self.totals: Dict[tuple, list] = {}  # (segment, kind) -> [bytes covered, totals]
+        self._fh = None
+        self._fh_day = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+
+    def add(self, game:str, chat_id:Optional[int], rows: List[tuple], won=None):
+        """rows are settlement rows (uid, payout, net). A row counts as won when its net
+        is positive, or when its uid is in `won` for games played without stakes."""
+        if not self.enabled or not rows:
+            return
+        ts = int(clock.time())
+        buf = self.buf[datetime.fromtimestamp(ts).strftime("%Y%m%d")]
+        pack = HIST_REC.pack; code = HIST_GAMES.index(game); chat_id = chat_id or 0
+        for uid, payout, net in rows:
+            flag = HIST_WON if (uid in won if won is not None else net > 0) else 0
+            buf += pack(ts, chat_id, uid, payout - net, payout, code, flag)
+        self.records += len(rows)
+
+    def add_round(self, rec: dict):
+        if self.enabled:
+            self.rounds[datetime.fromtimestamp(rec["ts"]).strftime("%Y%m%d")].append(json.dumps(rec, separators=(",", ":")))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception("history worker error: %s", e)
+
+    async def flush(self):
+        bufs, self.buf = self.buf, defaultdict(bytearray)
+        rounds, self.rounds = self.rounds, defaultdict(list)
+        if bufs or rounds:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, bufs, rounds)
+
+    def _write(self, bufs: Dict[str, bytearray], rounds: Dict[str, List[str]]):
+        for day, lines in rounds.items():
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                with open(os.path.join(self.path, f"{day}{self.suffix}.rounds.jsonl"), "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+            except Exception as e:
+                logger.exception("Error writing round log: %s", e)
+        for day, data in sorted(bufs.items()):
+            try:
+                if self._fh_day != day:
+                    if self._fh is not None:
+                        self._fh.close()
+                    os.makedirs(self.path, exist_ok=True)
+                    self._fh = open(os.path.join(self.path, f"{day}{self.suffix}.bin"), "ab")
+                    self._fh_day = day
+                    size = self._fh.tell()
+                    if size % HIST_REC.size:  # torn record from a crash
+                        self._fh.truncate(size - size % HIST_REC.size)
+                self._fh.write(data)
+                self._fh.flush()
+            except Exception as e:
+                logger.exception("Error writing history: %s", e)
+
+    # reads run on the history thread, after everything pending has been written
+    async def query(self, fn, *args):
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def segments(self, day:str) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.path, f"{day}*.bin")))
+
+    def scan(self, path:str, start:int=0, end:Optional[int]=None):
+        """Yield the records of one segment between byte offsets start and end."""
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size - size % HIST_REC.size if end is None else end
+            if end <= start:
+                return
+            step = HISTORY_CHUNK * HIST_REC.size
+            with mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as mm:
+                for a in range(start, end, step):
+                    view = memoryview(mm)[a:min(a + step, end)]
+                    recs = list(HIST_REC.iter_unpack(view))
+                    view.release()
+                    yield from recs
+
+    def find_uid(self, path:str, uid:int, limit:int) -> List[tuple]:
+        """Up to limit records of uid in one segment, newest first. Searches the raw bytes
+        for the packed uid (memchr speed) and keeps only hits on the uid field."""
+        size = os.path.getsize(path)
+        end = size - size % HIST_REC.size
+        if not end or limit <= 0:
+            return []
+        needle = struct.pack("<q", uid)
+        out = []
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as mm:
+            pos = end
+            while len(out) < limit:
+                i = mm.rfind(needle, 0, pos)
+                if i < 0:
+                    break
+                if i % HIST_REC.size == HIST_UID_OFFSET:
+                    out.append(HIST_REC.unpack_from(mm, i - HIST_UID_OFFSET))
+                pos = i + len(needle) - 1
+        return out
+
+    def last_bets(self, uid:int, n:int, days: List[str]) -> List[tuple]:
+        """A user's latest n records, newest first; days are searched newest first."""
+        out = []
+        for day in days:
+            found = [rec for path in self.segments(day) for rec in self.find_uid(path, uid, n - len(out))]
+            found.sort(key=lambda r: -r[0])  # shard segments of one day interleave
+            out += found[:n - len(out)]
+            if len(out) >= n:
+                break
+        return out
+
+    def segment_totals(self, path:str, kind:str) -> dict:
+        """kind "profit": uid -> payout - stake; kind "chats": chat_id -> [bets, staked, paid]."""
+        ent = self.totals.get((path, kind))
+        if ent is None:
+            ent = self.totals[(path, kind)] = [0, defaultdict(int) if kind == "profit" else defaultdict(lambda: [0, 0, 0])]
+        size = os.path.getsize(path)
+        end = size - size % HIST_REC.size
+        acc = ent[1]
+        if kind == "profit":
+            for _, _, uid, stake, payout, _, _ in self.scan(path, ent[0], end):
+                acc[uid] += payout - stake
+        else:
+            for _, chat_id, _, stake, payout, _, _ in self.scan(path, ent[0], end):
+                v = acc[chat_id]
+                v[0] += 1; v[1] += stake; v[2] += payout
+        ent[0] = max(ent[0], end)
+        return acc
+
+    def board(self, kind:str, days: List[str]) -> dict:
+        merged = defaultdict(int) if kind == "profit" else defaultdict(lambda: [0, 0, 0])
+        for day in days:
+            for path in self.segments(day):
+                for k, v in self.segment_totals(path, kind).items():
+                    if kind == "profit":
+                        merged[k] += v
+                    else:
+                        m = merged[k]
+                        m[0] += v[0]; m[1] += v[1]; m[2] += v[2]
+        # totals older than a week are not asked for again
+        cutoff = (clock.now() - timedelta(days=7)).strftime("%Y%m%d")
+        for key in [k for k in self.totals if os.path.basename(k[0])[:8] < cutoff]:
+            del self.totals[key]
+        return merged
+
+history = HistoryArchive()
+
+# --- Randomness ---
+# Each round draws from its own RNGStream, seeded from the service's master
+# generator. Uniform floats are produced in blocks (NumPy's PCG64 when numpy is
+# installed, else random.Random) and every other draw is derived from them, so
+# a round's seed and backend reproduce it exactly. The seed, the number of draws
+# and the outcome are written to the round log (see replay_round).
+class RNGStream:
+    __slots__ = ("seed", "backend", "draws", "_buf", "_block", "_gen")
+
+    def __init__(self, seed:int, backend:Optional[str]=None):
+        self.seed = seed
+        self.backend = backend or RNG_BACKEND
+        if self.backend == "numpy" and np is None:
+            raise RuntimeError("this round was drawn with numpy, which is not installed")
+        self.draws = 0
+        self._buf: List[float] = []  # pregenerated floats, next one last
+        self._block = RNG_FIRST_BLOCK  # doubles up to RNG_BLOCK, so short rounds stay cheap
+        self._gen = np.random.Generator(np.random.PCG64(seed)) if self.backend == "numpy" else random.Random(seed)
+
+    def _fill(self):
+        n = self._block
+        self._block = min(n * 2, RNG_BLOCK)
+        if self.backend == "numpy":
+            self._buf = self._gen.random(n)[::-1].tolist()
+        else:
+            r = self._gen.random
+            self._buf = [r() for _ in range(n)]
+            self._buf.reverse()
+
+    def random(self) -> float:
+        if not self._buf:
+            self._fill()
+        self.draws += 1
+        return self._buf.pop()
+
+    def randrange(self, n:int) -> int:
+        return int(self.random() * n)
+
+    def randint(self, a:int, b:int) -> int:
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq):
+        return seq[int(self.random() * len(seq))]
+
+    def state(self) -> dict:
+        return {"seed": self.seed, "backend": self.backend, "draws": self.draws}
+
+class RNGService:
+    def __init__(self, seed:Optional[int]=None):
+        self.reseed(seed)
+
+    def reseed(self, seed:Optional[int]=None):
+        """A fixed seed makes every later stream deterministic (simulation, benchmarks)."""
+        self.master = random.Random(seed) if seed is not None else random.SystemRandom()
+        self.misc = self.stream()  # draws that belong to no round (lì xì)
+
+    def stream(self) -> RNGStream:
+        return RNGStream(self.master.getrandbits(63))
+
+rngs = RNGService()
+
+def log_round(game:str, chat_id:int, rng: RNGStream, outcome, **inputs):
+    """Record what replay_round needs to reproduce a round, next to its outcome."""
+    rec = {"ts": int(clock.time()), "game": game, "chat": chat_id, **rng.state(), "outcome": outcome, **inputs}
+    history.add_round(rec)
+    emit("round", **rec)
+
+def replay_round(rec: dict):
+    """Re-run a logged round from its seed; returns (outcome, draws) to compare with the log."""
+    rng = RNGStream(rec["seed"], rec["backend"])
+    game = rec["game"]
+    if game == "tx":
+        outcome = tx_roll(rng, rec.get("prev"))
+    elif game == "xoso":
+        outcome = xoso_draw(rng)
+    elif game == "baucua":
+        outcome = [BAU_CUA_KEYS[d] for d in baucua_roll(rng)]
+    elif game == "ff":
+        lobby = FFLobby(rec["chat"], rec["mode"])
+        for uid, team in rec["players"]:
+            p = lobby.players[uid] = FFPlayer(uid, str(uid))
+            p.team = team
+        lobby.map_name = rng.choice(FF_MAPS)
+        ff_loot(lobby, rng)
+        engine = FFEngine(lobby, rng)
+        for _ in range(rec["ticks"]):
+            engine.tick()
+        outcome = ff_outcome(lobby)
+    else:
+        raise ValueError(f"unknown game {game!r}")
+    return outcome, rng.draws
+
+# --- Outbound scheduler ---
+# All game output goes through one queue with token buckets (global and per
+# chat) and priority lanes, so floods of edits never delay settlement results.
+# Mirrors of results to subscribed chats have their own lane and a share of
+# the global budget, so a big fan-out leaves room for everything else.
+PRIO_RESULT, PRIO_NORMAL, PRIO_MIRROR, PRIO_EDIT = 0, 1, 2, 3
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate:float, burst:float, now:float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def wait_time(self, now:float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1 - 1e-9:
+            return 0.0
+        return max(0.001, (1 - self.tokens) / self.rate)  # floor avoids float-rounding spins
+
+    def take(self):
+        self.tokens -= 1
+
+class OutItem:
+    __slots__ = ("prio", "chat_id", "method", "kwargs", "fallback", "created", "future")
+
+    def __init__(self, prio, chat_id, method, kwargs, fallback, created, future):
+        self.prio = prio
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.fallback = fallback
+        self.created = created
+        self.future = future
+
+class Outbox:
+    def __init__(self):
+        self.bot = None
+        self.lanes = [deque(), deque(), deque(), deque()]
+        self.edits: Dict[tuple, OutItem] = {}  # (chat_id, message_id) -> queued edit
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.blocked: Dict[int, float] = {}  # chat_id -> RetryAfter deadline
+        self.inflight = set()  # chats with a call in progress (keeps per-chat order)
+        self.stats = defaultdict(int)  # enqueued / sent / errors / dropped / merged / retry_after
+        self.share = 1  # processes sending with this bot token; they split the global and GROUP_ID budgets
+        self._global = None
+        self._mirror = None
+        self._sem = None
+        self._wake: Optional[asyncio.Event] = None
 
-async def send_group_or_chat(context: ContextTypes.DEFAULT_TYPE, chat_id:int, text:str, **kwargs):
-    """Send to GROUP_ID if set; else send to provided chat_id."""
-    target = GROUP_ID or chat_id
+    def depth(self) -> int:
+        return sum(len(l) for l in self.lanes)
+
+    def _enqueue(self, chat_id:int, method:str, prio:int, fallback:Optional[int], kwargs:dict) -> OutItem:
+        loop = asyncio.get_running_loop()
+        item = OutItem(prio, chat_id, method, kwargs, fallback, loop.time(), loop.create_future())
+        self.lanes[prio].append(item)
+        self.stats["enqueued"] += 1
+        if self._wake is not None:
+            self._wake.set()
+        return item
+
+    def submit(self, method:str, prio:int=PRIO_NORMAL, fallback:Optional[int]=None, **kwargs) -> asyncio.Future:
+        """Queue a Bot API call (kwargs must include chat_id); the future resolves to
+        its result (True for an edit that changed nothing), or None if it failed or
+        was dropped."""
+        return self._enqueue(kwargs["chat_id"], method, prio, fallback, kwargs).future
+
+    def send(self, chat_id:int, text:str, prio:int=PRIO_NORMAL, fallback:Optional[int]=None, **kwargs):
+        return self.submit("send_message", prio, fallback, chat_id=chat_id, text=text, **kwargs)
+
+    def edit(self, chat_id:int, message_id:int, text:str, **kwargs):
+        """Queue an edit; a newer edit for the same message replaces the queued one."""
+        queued = self.edits.get((chat_id, message_id))
+        if queued is not None:
+            queued.kwargs.update(text=text, **kwargs)
+            queued.created = asyncio.get_running_loop().time()  # age from the newest text
+            self.stats["merged"] += 1
+            return queued.future
+        item = self._enqueue(chat_id, "edit_message_text", PRIO_EDIT, None, dict(chat_id=chat_id, message_id=message_id, text=text, **kwargs))
+        self.edits[(chat_id, message_id)] = item
+        return item.future
+
+    async def drain(self, timeout:Optional[float]=None):
+        """Wait until nothing is queued or in flight (or timeout seconds pass)."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.depth() or self.inflight:
+            if deadline is not None and loop.time() >= deadline:
+                logger.warning("outbox: %d calls still queued at shutdown", self.depth())
+                return
+            await asyncio.sleep(0.05)
+
+    def _bucket(self, chat_id:int, now:float) -> TokenBucket:
+        b = self.buckets.get(chat_id)
+        if b is None:
+            # groups (negative ids) are limited to ~20 messages/minute, private chats to ~1/s
+            rate = OUT_GROUP_RATE if chat_id < 0 else OUT_CHAT_RATE
+            if chat_id == GROUP_ID:
+                rate /= self.share  # every shard posts results there
+            b = self.buckets[chat_id] = TokenBucket(rate, OUT_CHAT_BURST, now)
+        return b
+
+    def _next(self, now:float):
+        """Pop the best item that may be sent now; else return (None, seconds to wait)."""
+        wait = self._global.wait_time(now)
+        if wait:
+            return None, wait
+        wait = 1.0
+        for prio, lane in enumerate(self.lanes):
+            if prio == PRIO_MIRROR and lane:
+                w = self._mirror.wait_time(now)
+                if w:
+                    wait = min(wait, w)
+                    continue
+            i = 0
+            while i < len(lane) and i < OUT_SCAN_LIMIT:
+                item = lane[i]
+                if ((item.method == "edit_message_text" and now - item.created > OUT_EDIT_MAX_AGE)
+                        or (prio == PRIO_MIRROR and now - item.created > OUT_MIRROR_MAX_AGE)):
+                    del lane[i]
+                    self._finish(item, None)
+                    self.stats["dropped"] += 1
+                    continue
+                cid = item.chat_id
+                if cid not in self.inflight:
+                    w = max(self.blocked.get(cid, 0) - now, self._bucket(cid, now).wait_time(now))
+                    if w <= 0:
+                        del lane[i]
+                        return item, 0
+                    wait = min(wait, w)
+                i += 1
+        return None, wait
+
+    def _prune(self, now:float):
+        """Forget buckets of chats that have been quiet long enough to refill."""
+        for cid in [c for c,b in self.buckets.items() if c not in self.inflight and b.wait_time(now) == 0 and b.tokens >= b.burst]:
+            del self.buckets[cid]
+        for cid in [c for c,t in self.blocked.items() if t <= now]:
+            del self.blocked[cid]
+
+    def _unmerge(self, item:OutItem):
+        """Stop merging newer edits into `item` (it is being sent or is done)."""
+        if item.method == "edit_message_text":
+            key = (item.chat_id, item.kwargs.get("message_id"))
+            if self.edits.get(key) is item:
+                del self.edits[key]
+
+    def _finish(self, item:OutItem, result):
+        self._unmerge(item)
+        if not item.future.done():
+            item.future.set_result(result)
+
+    async def run(self, bot):
+        self.bot = bot
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._global = TokenBucket(OUT_GLOBAL_RATE / self.share, OUT_GLOBAL_RATE / self.share, loop.time())
+        self._mirror = TokenBucket(OUT_MIRROR_RATE / self.share, OUT_MIRROR_RATE / self.share, loop.time())
+        self._sem = asyncio.Semaphore(OUT_CONCURRENCY)
+        next_prune = loop.time() + 60
+        while True:
+            await self._sem.acquire()
+            now = loop.time()
+            if now >= next_prune:
+                self._prune(now)
+                next_prune = now + 60
+            item, wait = self._next(now)
+            if item is None:
+                self._sem.release()
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._unmerge(item)  # a newer edit queues behind this one instead of being lost
+            self._global.take()
+            if item.prio == PRIO_MIRROR:
+                self._mirror.take()
+            self.buckets[item.chat_id].take()
+            self.inflight.add(item.chat_id)
+            asyncio.create_task(self._deliver(item))
+
+    async def _deliver(self, item:OutItem):
+        chat_id = item.chat_id  # _failed may redirect the item to its fallback chat
+        try:
+            metrics.inc("gamebot_api_calls_total", method=item.method)
+            result = await getattr(self.bot, item.method)(**item.kwargs)
+            self.stats["sent"] += 1
+            self._finish(item, result)
+        except RetryAfter as e:
+            ra = e.retry_after
+            ra = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+            self.stats["retry_after"] += 1
+            self.blocked[item.chat_id] = asyncio.get_running_loop().time() + ra
+            self.lanes[item.prio].appendleft(item)  # retry first once the chat unblocks
+            if item.method == "edit_message_text":
+                self.edits.setdefault((item.chat_id, item.kwargs.get("message_id")), item)
+            logger.warning("outbox: flood limit in %s, retry after %.0fs", item.chat_id, ra)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                self._finish(item, True)  # the message already shows this text
+            else:
+                self._failed(item, e)
+        except Exception as e:
+            self._failed(item, e)
+        finally:
+            self.inflight.discard(chat_id)
+            self._sem.release()
+            self._wake.set()
+
+    def _failed(self, item:OutItem, e:Exception):
+        self.stats["errors"] += 1
+        metrics.inc("gamebot_api_errors_total", method=item.method)
+        logger.warning("outbox: %s to %s failed: %s", item.method, item.chat_id, e)
+        if item.fallback and item.fallback != item.chat_id:
+            # retry in the chat where the command was invoked
+            item.kwargs["chat_id"] = item.fallback
+            item.chat_id, item.fallback = item.fallback, None
+            self.lanes[item.prio].append(item)
+            return
+        emit("send_failed", chat_id=item.chat_id, method=item.method, error=e)
+        self._finish(item, None)
+
+outbox = Outbox()
+
+def edit_countdown(owner, chat_id:int, message_id:int, text:str):
+    """Queue a countdown edit unless the message already shows `text`. owner.sent_text
+    only follows an edit once it is delivered, so one that was dropped or failed is
+    sent again on the next tick."""
+    if text == owner.sent_text:
+        return
+    def delivered(fut: asyncio.Future):
+        if not fut.cancelled() and fut.result() is not None:
+            owner.sent_text = text
+    # merged edits share one future; their callbacks run in order, so the newest text wins
+    outbox.edit(chat_id, message_id, text).add_done_callback(delivered)
+
+# --- Timers ---
+# One heap-based scheduler owns every session deadline and countdown tick,
+# instead of a polling coroutine per session. Moving a deadline later (the
+# usual case, e.g. "close N seconds after the last bet") is O(1): the heap
+# entry stays put and is re-queued when it surfaces early.
+class Timer:
+    __slots__ = ("when", "callback", "args", "done")
+
+    def __init__(self, when:float, callback, args:tuple):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.done = False
+
+    def cancel(self):
+        self.done = True
+
+class TimerService:
+    def __init__(self):
+        self._heap = []  # (when, seq, Timer); when <= timer.when
+        self._seq = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self.fired = 0
+
+    def now(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    def call_at(self, when:float, callback, *args) -> Timer:
+        """Run callback(*args) at loop time `when`; coroutine functions run as tasks."""
+        t = Timer(when, callback, args)
+        self._push(t)
+        return t
+
+    def call_later(self, delay:float, callback, *args) -> Timer:
+        return self.call_at(self.now() + delay, callback, *args)
+
+    def reschedule(self, t:Timer, when:float):
+        if t.done:
+            return
+        earlier = when < t.when
+        t.when = when
+        if earlier:
+            self._push(t)  # the stale entry is skipped when it surfaces
+
+    def _push(self, t:Timer):
+        heapq.heappush(self._heap, (t.when, next(self._seq), t))
+        if self._heap[0][2] is t and self._wake is not None:
+            self._wake.set()  # new earliest deadline
+
+    async def sleep(self, delay:float):
+        fut = asyncio.get_running_loop().create_future()
+        self.call_later(delay, _resolve, fut)
+        await fut
+
+    async def run(self):
+        self._wake = asyncio.Event()
+        heap = self._heap
+        while True:
+            now = self.now()
+            while heap and heap[0][0] <= now:
+                when, _, t = heapq.heappop(heap)
+                if t.done:
+                    continue  # cancelled, or an entry left behind by reschedule()
+                if t.when > now:
+                    heapq.heappush(heap, (t.when, next(self._seq), t))
+                    continue
+                t.done = True
+                self.fired += 1
+                try:
+                    r = t.callback(*t.args)
+                    if asyncio.iscoroutine(r):
+                        asyncio.create_task(_log_errors(r))
+                except Exception as e:
+                    logger.exception("timer callback error: %s", e)
+            self._wake.clear()
+            timeout = heap[0][0] - now if heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+def _resolve(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_result(None)
+
+async def _log_errors(coro):
     try:
-        await context.bot.send_message(target, text, parse_mode=ParseMode.HTML, **kwargs)
+        await coro
     except Exception as e:
-        logger.exception("send_group_or_chat error: %s", e)
-        # fallback to chat where invoked
-        try:
-            await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, **kwargs)
-        except:
-            pass
+        logger.exception("timer task error: %s", e)
+
+timers = TimerService()
+
+def send_asset(name:str, prio:int=PRIO_NORMAL, fallback:Optional[int]=None, **kwargs) -> Optional[asyncio.Future]:
+    """Queue send_photo for an image in IMAGES_DIR, by file_id once it has been uploaded."""
+    a = assets.get(name)
+    if a is None:
+        return None
+    try:
+        photo = a.payload()
+    except OSError as e:
+        logger.warning("asset %s unreadable: %s", name, e)
+        return None
+    used_id = a.file_id
+    metrics.inc("gamebot_asset_sends_total", mode="file_id" if used_id else "upload")
+    fut = outbox.submit("send_photo", prio, fallback, photo=photo, **kwargs)
+    fut.add_done_callback(lambda f: assets.record_send(a, used_id, None if f.cancelled() else f.result()))
+    return fut
+
+async def send_group_or_chat(context: ContextTypes.DEFAULT_TYPE, chat_id:int, text:str, prio:int=PRIO_NORMAL,
+                             mirror:Optional[str]=None, **kwargs):
+    """Queue a message to GROUP_ID if set; else to provided chat_id (also the fallback).
+    With `mirror` set to a game, subscribers of that game get a copy too."""
+    if mirror:
+        fanout.publish(mirror, text, (chat_id, GROUP_ID), **kwargs)
+    return outbox.send(GROUP_ID or chat_id, text, prio, fallback=chat_id, parse_mode=ParseMode.HTML, **kwargs)
+
+# --- Result fan-out ---
+# Chats subscribe with /sub to the results of some or all games. A result is
+# rendered once and queued to every subscriber in the outbox's mirror lane,
+# which sends concurrently within its share of the rate budget. Chats the bot
+# can no longer post in are dropped at the first such error, others after
+# FANOUT_MAX_FAILURES failures in a row; a migrated group keeps its
+# subscription under the new id.
+FANOUT_GAMES = {"tx": "Tài Xỉu", "xoso": "Xổ số", "baucua": "Bầu Cua", "ff": "Free Fire"}
+FANOUT_DEAD = ("chat not found", "bot was kicked", "not enough rights", "have no rights", "chat_write_forbidden")
+
+class FanOut:
+    def __init__(self):
+        self.subs = subscriptions  # chat_id -> games; a SharedSubscriptions view in shard workers
+        self.by_game: Optional[Dict[str, List[int]]] = None  # built from subs on first use
+        self.loaded = 0.0
+        self.failures: Dict[int,int] = {}  # chat_id -> failed sends in a row
+        self.stats = defaultdict(int)  # mirrored / delivered / failed / pruned / migrated
+
+    def targets(self, game:str) -> List[int]:
+        if self.by_game is None or (shared is not None and timers.now() - self.loaded > FANOUT_RELOAD):
+            by_game = defaultdict(list)
+            for chat_id, games in self.subs.items():
+                for g in games:
+                    by_game[g].append(chat_id)
+            self.by_game, self.loaded = by_game, timers.now()
+        return self.by_game.get(game, [])
+
+    def subscribe(self, chat_id:int, games: List[str]):
+        self.subs[chat_id] = sorted(set(self.subs.get(chat_id) or ()) | set(games))
+        self._changed(chat_id)
+
+    def unsubscribe(self, chat_id:int, games: Optional[List[str]]=None) -> bool:
+        old = self.subs.get(chat_id)
+        if not old:
+            return False
+        left = [g for g in old if games and g not in games]
+        if left:
+            self.subs[chat_id] = left
+        else:
+            self.subs.pop(chat_id, None)
+        self.failures.pop(chat_id, None)
+        self._changed(chat_id)
+        return True
+
+    def _changed(self, chat_id:int):
+        self.by_game = None
+        persist.touch("subscriptions", chat_id)
+
+    def publish(self, game:str, text:str, exclude=(), **kwargs) -> int:
+        """Queue `text` to every subscriber of `game` except the chats in `exclude`."""
+        n = 0
+        for chat_id in self.targets(game):
+            if chat_id in exclude:
+                continue
+            fut = outbox.send(chat_id, text, PRIO_MIRROR, parse_mode=ParseMode.HTML, **kwargs)
+            fut.add_done_callback(lambda f, c=chat_id: self._sent(c, f))
+            n += 1
+        self.stats["mirrored"] += n
+        return n
+
+    def _sent(self, chat_id:int, fut: asyncio.Future):
+        if not fut.cancelled() and fut.result() is not None:
+            self.stats["delivered"] += 1
+            self.failures.pop(chat_id, None)
+
+    def on_event(self, kind:str, data: dict):
+        if kind != "send_failed":
+            return
+        chat_id, e = data["chat_id"], data["error"]
+        if chat_id not in self.subs:
+            return
+        self.stats["failed"] += 1
+        if isinstance(e, ChatMigrated):
+            games = self.subs.get(chat_id)
+            self.unsubscribe(chat_id)
+            self.subscribe(e.new_chat_id, games)
+            self.stats["migrated"] += 1
+            logger.info("fanout: chat %s moved to %s", chat_id, e.new_chat_id)
+            return
+        n = self.failures[chat_id] = self.failures.get(chat_id, 0) + 1
+        if isinstance(e, Forbidden) or any(s in str(e).lower() for s in FANOUT_DEAD) or n >= FANOUT_MAX_FAILURES:
+            self.unsubscribe(chat_id)
+            self.stats["pruned"] += 1
+            logger.warning("fanout: dropped subscriber %s after %d failed sends: %s", chat_id, n, e)
+
+fanout = FanOut()
+event_listeners.append(fanout.on_event)
+
+# --- Sessions ---
+# Live rounds are held in one SessionRegistry per game. A round leaves its
+# registry when it finishes; a periodic sweep evicts whatever a failed or
+# abandoned round left behind, refunding stakes it never settled. A chat may
+# hold at most SESSION_CHAT_CAP live sessions across all games.
+class SessionRegistry:
+    chats: Counter = Counter()  # chat_id -> live sessions across every registry
+    registries: List["SessionRegistry"] = []
+
+    def __init__(self, game:str, expired, evict):
+        self.game = game
+        self.items: Dict[int, object] = {}  # chat_id -> current session
+        self.retired = set()  # replaced by a newer round while still finishing
+        self.expired = expired  # (session, now) -> bool
+        self.evict = evict  # async (app, session)
+        self.evicted = 0
+        SessionRegistry.registries.append(self)
+
+    def get(self, chat_id:int, default=None):
+        return self.items.get(chat_id, default)
+
+    def __contains__(self, chat_id:int) -> bool:
+        return chat_id in self.items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def values(self) -> list:
+        return list(self.items.values())
+
+    def admits(self, chat_id:int) -> bool:
+        return chat_id in self.items or self.chats[chat_id] < SESSION_CHAT_CAP
+
+    def open(self, session):
+        chat_id = session.chat_id
+        old = self.items.get(chat_id)
+        if old is None:
+            self.chats[chat_id] += 1
+        elif old is not session:
+            self.retired.add(old)
+        self.items[chat_id] = session
+
+    def close(self, session):
+        """Drop a finished session; a newer round of the same chat stays registered."""
+        chat_id = session.chat_id
+        if self.items.get(chat_id) is not session:
+            self.retired.discard(session)
+            return
+        del self.items[chat_id]
+        self.chats[chat_id] -= 1
+        if not self.chats[chat_id]:
+            del self.chats[chat_id]
+
+    async def sweep(self, app: Application):
+        now = timers.now()
+        for s in [s for s in (*self.items.values(), *self.retired) if self.expired(s, now)]:
+            self.close(s)
+            self.evicted += 1
+            logger.warning("evicting stale %s session in chat %s", self.game, s.chat_id)
+            try:
+                await self.evict(app, s)
+            except Exception as e:
+                logger.exception("evicting %s session failed: %s", self.game, e)
+
+    def nbytes(self) -> int:
+        return sum(s.nbytes() for s in (*self.items.values(), *self.retired))
+
+SESSION_CAP_TEXT = "⚠️ Nhóm đang có quá nhiều phiên chơi cùng lúc."
+
+def round_expired(session, now:float) -> bool:
+    return now > session.end_time + SESSION_GRACE
+
+async def evict_round(app: Application, session):
+    """Stop a betting round that never finished and give back the stakes it holds."""
+    session.running = False
+    for t in (session.close_timer, session.tick_timer):
+        if t is not None:
+            t.cancel()
+    if session.settled:
+        return
+    session.settled = True
+    stakes = list(session.stakes())
+    await accounts.refund_round(stakes, session.chat_id)
+    if stakes:
+        outbox.send(session.chat_id, f"⚠️ Phiên bị hủy — đã hoàn {fmt_amount(sum(a for _, a in stakes))} cho {len(stakes)} người.")
+
+async def sweep_sessions(app: Application):
+    try:
+        for r in SessionRegistry.registries:
+            await r.sweep(app)
+    finally:
+        timers.call_later(SESSION_SWEEP_INTERVAL, sweep_sessions, app)
+
+def nbytes(*objs) -> int:
+    """Shallow size of objects; models add their per-entry costs on top."""
+    return sum(sys.getsizeof(o) for o in objs)
+
+ENTRY_BYTES = 2 * sys.getsizeof(10**12)  # a dict entry's boxed int key and value
 
 # --- Command: /menu /help ---
 async def menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    user_names[uid] = update.effective_user.username or update.effective_user.full_name
+    remember_user(update.effective_user)
     kb = [
         [InlineKeyboardButton("/tx Tài/Xỉu", callback_data="menu_tx"),
          InlineKeyboardButton("/xoso Xổ số", callback_data="menu_xoso")],
@@ -163,7 +1722,7 @@ async def menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    data = q.data or ""
+    data = context.args[0]
     if data == "menu_tx":
         await q.edit_message_text("🎲 /tx <số tiền>  — Đặt Tài/Xỉu (sử dụng nút để chọn)")
     elif data == "menu_xoso":
@@ -186,41 +1745,85 @@ async def menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- dangky / diem / top ---
 async def handle_dangky_private(q, context):
     uid = q.from_user.id
-    if balances.get(uid,0)>0:
+    if not await accounts.register(uid):
         await q.edit_message_text("Bạn đã đăng ký.")
         return
-    balances[uid] = 100_000
-    await q.edit_message_text(f"✅ Đăng ký: bạn nhận 100k. Số dư: {fmt_amount(balances[uid])}")
-    save_data()
+    await q.edit_message_text(f"✅ Đăng ký: bạn nhận 100k. Số dư: {fmt_amount(await accounts.balance(uid))}")
 
 async def handle_diem_private(q, context):
     uid = q.from_user.id
-    await q.edit_message_text(f"💼 Số dư: {fmt_amount(balances.get(uid,0))}")
+    await q.edit_message_text(f"💼 Số dư: {fmt_amount(await accounts.balance(uid))}")
 
 async def dangky_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if balances.get(uid,0)>0:
+    if not await accounts.register(uid):
         await update.message.reply_text("Bạn đã đăng ký trước đó.")
         return
-    balances[uid]=100_000
-    user_names[uid]=update.effective_user.username or update.effective_user.full_name
-    await update.message.reply_text(f"Đăng ký thành công. Số dư: {fmt_amount(balances[uid])}")
-    save_data()
+    remember_user(update.effective_user)
+    await update.message.reply_text(f"Đăng ký thành công. Số dư: {fmt_amount(await accounts.balance(uid))}")
 
 async def diem_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    await update.message.reply_text(f"Số dư: {fmt_amount(balances.get(uid,0))}")
+    await update.message.reply_text(f"Số dư: {fmt_amount(await accounts.balance(uid))}")
+
+TOP_SCOPES = {"nhom": "nhóm này", "ngay": "hôm nay", "tuan": "tuần này"}
 
 async def top_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    items = sorted(leaderboard.items(), key=lambda kv: kv[1], reverse=True)[:10]
+    scope = context.args[0].lower() if context.args else ""
+    if scope == "nhom":
+        key = f"c:{update.effective_chat.id}"
+    elif scope in ("ngay", "tuan"):
+        key = period_keys(clock.time())[0 if scope=="ngay" else 1]
+    else:
+        key = "g"
+    items = score_boards.top(key, 10)
     if not items:
         await update.message.reply_text("Chưa có dữ liệu.")
         return
-    lines = ["🏆 Top leaderboard:"]
+    lines = [f"🏆 Top leaderboard ({TOP_SCOPES[scope]}):" if scope in TOP_SCOPES else "🏆 Top leaderboard:"]
     for uid, val in items:
         lines.append(f"{user_names.get(uid,uid)} — {fmt_amount(val)}")
     await update.message.reply_text("\n".join(lines))
 
+HISTORY_SCOPES = {"ngay": "hôm nay", "tuan": "tuần này"}
+
+async def lichsu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    n = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+    recs = await history.query(history.last_bets, uid, max(1, min(n, 50)), history_days(""))
+    if not recs:
+        await update.message.reply_text("Chưa có lịch sử.")
+        return
+    lines = [f"📜 {len(recs)} ván gần nhất:"]
+    for ts, _, _, stake, payout, game, flags in recs:
+        g = HIST_GAMES[game]
+        res = ("thắng" if flags & HIST_WON else "thua") if g == "ff" else f"cược {fmt_amount(stake)} → {fmt_amount(payout)}"
+        lines.append(f"{datetime.fromtimestamp(ts):%d/%m %H:%M} {HIST_GAME_NAMES[g]}: {res}")
+    for text in chunk_lines(lines):
+        await update.message.reply_text(text)
+
+async def lai_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    scope = context.args[0].lower() if context.args and context.args[0].lower() in HISTORY_SCOPES else "ngay"
+    profit = await history.query(history.board, "profit", history_days(scope))
+    best = heapq.nlargest(10, profit.items(), key=lambda kv: kv[1])
+    if not best:
+        await update.message.reply_text("Chưa có dữ liệu.")
+        return
+    lines = [f"💰 Lãi/lỗ {HISTORY_SCOPES[scope]}:"]
+    lines += [f"{user_names.get(uid,uid)} — {'+' if v >= 0 else '-'}{fmt_amount(abs(v))}" for uid, v in best]
+    await update.message.reply_text("\n".join(lines))
+
+async def doanhthu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    scope = context.args[0].lower() if context.args and context.args[0].lower() in HISTORY_SCOPES else "ngay"
+    chats = await history.query(history.board, "chats", history_days(scope))
+    chat_id = update.effective_chat.id
+    bets, staked, paid = chats.get(chat_id, (0, 0, 0))
+    lines = [f"📊 Nhóm này {HISTORY_SCOPES[scope]}: {bets} cược, đặt {fmt_amount(staked)}, trả {fmt_amount(paid)}"]
+    if is_admin(update.effective_user.id):
+        lines.append("Nhóm sôi động nhất:")
+        lines += [f"• {c}: {v[0]} cược, đặt {fmt_amount(v[1])}" for c, v in heapq.nlargest(10, chats.items(), key=lambda kv: kv[1][1])]
+    await update.message.reply_text("\n".join(lines))
+
 # --- set / check / lich / tinhyeu / info ---
 ADMINS = set()  # populate if needed
 
@@ -245,16 +1848,28 @@ async def check_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Cú pháp: /check @username")
         return
     uname = context.args[0].lstrip("@")
-    try:
-        chat = await context.bot.get_chat(f"@{uname}")
-        await update.message.reply_text(f"@{uname} => id: {chat.id}")
+    uid = user_names.find(uname)
+    if uid is not None:
+        metrics.inc("gamebot_check_lookups_total", source="names")
+        await update.message.reply_text(f"@{uname} => id: {uid} (cache)")
         return
-    except Exception:
-        for uid, name in user_names.items():
-            if name and name.lstrip("@").lower()==uname.lower():
-                await update.message.reply_text(f"@{uname} => id: {uid} (cache)")
-                return
-    await update.message.reply_text("Không tìm thấy.")
+    key = name_key(uname)
+    cid = chat_cache.get(key)
+    if cid is TTLCache.MISSING:
+        try:
+            cid = (await context.bot.get_chat(f"@{uname}")).id
+            chat_cache.put(key, cid)
+            metrics.inc("gamebot_check_lookups_total", source="api")
+        except Exception:
+            cid = None
+            chat_cache.put(key, None, CHAT_CACHE_MISS_TTL)
+            metrics.inc("gamebot_check_lookups_total", source="miss")
+    else:
+        metrics.inc("gamebot_check_lookups_total", source="chat_cache")
+    if cid is None:
+        await update.message.reply_text("Không tìm thấy.")
+        return
+    await update.message.reply_text(f"@{uname} => id: {cid}")
 
 async def lich_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     holidays = [("Tết Dương lịch","2025-01-01"),("Tết Nguyên đán","2025-01-29"),("Quốc khánh","2025-09-02")]
@@ -275,22 +1890,193 @@ async def info_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         members = "unknown"
     await update.message.reply_text(f"Tên: {chat.title or 'private'}\nID: {chat.id}\nThành viên: {members}")
 
+# --- sub / unsub / subs ---
+async def can_manage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Bot admins anywhere; in groups also the group's own admins."""
+    chat = update.effective_chat; uid = update.effective_user.id
+    if is_admin(uid) or chat.type == "private":
+        return True
+    try:
+        member = await context.bot.get_chat_member(chat.id, uid)
+    except Exception:
+        return False
+    return member.status in ("administrator", "creator")
+
+async def sub_args(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """(target chat, games) from "[chat_id|@kênh] [game ...]"; None after replying with the problem."""
+    args = [a.lower() for a in context.args]
+    target = update.effective_chat.id
+    if args and (args[0].startswith("@") or args[0].lstrip("-").isdigit()):
+        # another chat, e.g. a channel the bot posts in
+        if not is_admin(update.effective_user.id):
+            await update.message.reply_text("Bạn không có quyền.")
+            return None
+        try:
+            target = int(args[0]) if args[0].lstrip("-").isdigit() else (await context.bot.get_chat(args[0])).id
+        except Exception:
+            await update.message.reply_text("Không tìm thấy.")
+            return None
+        args = args[1:]
+    elif not await can_manage(update, context):
+        await update.message.reply_text("Chỉ quản trị nhóm mới đổi được đăng ký.")
+        return None
+    if any(g not in FANOUT_GAMES for g in args):
+        await update.message.reply_text(f"Cú pháp: /sub hoặc /unsub [chat_id|@kênh] [{' '.join(FANOUT_GAMES)}]")
+        return None
+    return target, args
+
+async def sub_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parsed = await sub_args(update, context)
+    if parsed is None:
+        return
+    target, games = parsed
+    fanout.subscribe(target, games or list(FANOUT_GAMES))
+    names = ", ".join(FANOUT_GAMES[g] for g in fanout.subs.get(target))
+    await update.message.reply_text(f"📡 {target} sẽ nhận kết quả: {names}")
+
+async def unsub_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parsed = await sub_args(update, context)
+    if parsed is None:
+        return
+    target, games = parsed
+    if not fanout.unsubscribe(target, games or None):
+        await update.message.reply_text("Chưa đăng ký nhận kết quả.")
+        return
+    left = fanout.subs.get(target)
+    await update.message.reply_text(f"📴 Đã hủy. Còn nhận: {', '.join(FANOUT_GAMES[g] for g in left)}" if left else "📴 Đã hủy nhận kết quả.")
+
+async def subs_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    games = fanout.subs.get(update.effective_chat.id)
+    lines = [f"📡 Nhóm này nhận kết quả: {', '.join(FANOUT_GAMES[g] for g in games)}" if games else "Nhóm này chưa đăng ký (/sub)."]
+    if is_admin(update.effective_user.id):
+        st = fanout.stats
+        lines.append(f"Tổng {len(fanout.subs)} nơi nhận — gửi {st['delivered']}/{st['mirrored']}, lỗi {st['failed']}, đã gỡ {st['pruned']}")
+    await update.message.reply_text("\n".join(lines))
+
 # ------------------------------
 # --- TÀI / XỈU (button) ---
 # ------------------------------
+TX_SIDES = {"t": 0, "x": 1}
+TX_FAILED_TEXT = "⚠️ Không đặt được cược, thử lại sau."
+
+class BetBook:
+    """Bets of one TX round in array columns (17 bytes a bet) plus running totals
+    per side. Per-bettor stakes are folded from the columns in one pass when the
+    round settles or is refunded, not kept up to date on every bet."""
+    __slots__ = ("uids", "sides", "amounts", "totals")
+
+    def __init__(self):
+        self.uids = array("q")
+        self.sides = array("b")
+        self.amounts = array("q")
+        self.totals = [0, 0]  # staked on tài, xỉu
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def add(self, uid:int, side:int, amount:int):
+        self.uids.append(uid)
+        self.sides.append(side)
+        self.amounts.append(amount)
+        self.totals[side] += amount
+
+    def by_user(self) -> Dict[int, List[int]]:
+        """uid -> [staked on tài, staked on xỉu], in order of first bet."""
+        out: Dict[int, List[int]] = {}
+        for uid, side, amount in zip(self.uids, self.sides, self.amounts):
+            st = out.get(uid)
+            if st is None:
+                st = out[uid] = [0, 0]
+            st[side] += amount
+        return out
+
+    def settle(self, side:int, by_user: Optional[Dict[int, List[int]]] = None) -> List[tuple]:
+        """(uid, payout, net) per bettor when `side` wins; winners are paid 2x."""
+        lose = 1 - side
+        return [(uid, 2 * st[side], st[side] - st[lose]) for uid, st in (by_user or self.by_user()).items()]
+
+    def nbytes(self) -> int:
+        return nbytes(self, self.uids, self.sides, self.amounts)
+
 class TxSession:
+    __slots__ = ("chat_id", "book", "end_time", "last_bet_time", "countdown", "running", "settled",
+                 "previous_result", "message_id", "close_timer", "tick_timer", "board", "rng")
+
     def __init__(self, chat_id):
         self.chat_id = chat_id
-        self.bets = []  # list of dict {uid, uname, choice, amount}
-        self.end_time = None
+        self.book = BetBook()
+        self.end_time = None  # loop time (timers.now()) when betting closes
         self.last_bet_time = None
         self.countdown = DEFAULT_TX_COUNTDOWN
         self.running = False
+        self.settled = False
         self.previous_result = None
-        self._last_edit = None
         self.message_id = None
+        self.close_timer: Optional[Timer] = None
+        self.tick_timer: Optional[Timer] = None
+        self.board = TxBoard()
+        self.rng = rngs.stream()
+
+    def stakes(self):
+        return ((uid, st[0] + st[1]) for uid, st in self.book.by_user().items())
+
+    def nbytes(self) -> int:
+        return nbytes(self) + self.book.nbytes() + self.board.nbytes()
+
+class TxBoard:
+    """Countdown message body, built incrementally as bets arrive. Past
+    TX_BOARD_MAX_CHARS it switches to a fixed-size summary."""
+    __slots__ = ("lines", "size", "summary", "totals", "counts", "stakes", "version", "sent_text", "_body", "_body_version")
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.size = 0
+        self.summary = False
+        self.totals = {"t": 0, "x": 0}
+        self.counts = {"t": 0, "x": 0}
+        self.stakes = TopBoard()  # uid -> total staked, for "top bettors"
+        self.version = 0  # bumped on every bet
+        self.sent_text = ""  # countdown text last pushed to Telegram
+        self._body = "Chưa có ai đặt cược."
+        self._body_version = 0
 
-active_tx: Dict[int, TxSession] = {}
+    def add(self, uid:int, uname:str, choice:str, amount:int):
+        self.totals[choice] += amount
+        self.counts[choice] += 1
+        self.stakes.add(uid, amount)
+        self.version += 1
+        if self.summary:
+            return
+        line = f"• {uname}: {'Tài' if choice=='t' else 'Xỉu'} {fmt_amount(amount)}"
+        if self.size + len(line) + 1 > TX_BOARD_MAX_CHARS:
+            self.summary = True
+            self.lines = []
+            return
+        self.lines.append(line)
+        self.size += len(line) + 1
+
+    def body(self) -> str:
+        if self._body_version != self.version:
+            self._body_version = self.version
+            if self.summary:
+                n = self.counts["t"] + self.counts["x"]
+                top = self.stakes.top(TX_BOARD_TOP)
+                parts = [f"🔵 Tài: {fmt_amount(self.totals['t'])} ({self.counts['t']} cược)",
+                         f"🔴 Xỉu: {fmt_amount(self.totals['x'])} ({self.counts['x']} cược)",
+                         "Top cược:"]
+                parts += [f"• {user_names.get(uid, uid)}: {fmt_amount(v)}" for uid,v in top]
+                more = len(self.stakes.scores) - len(top)
+                if more > 0:
+                    parts.append(f"… +{more} người khác ({n} cược)")
+                self._body = "\n".join(parts)
+            else:
+                self._body = "\n".join(self.lines)
+        return self._body
+
+    def nbytes(self) -> int:
+        return nbytes(self, self.lines, self.stakes.scores, self._body) + self.size + len(self.stakes.scores) * ENTRY_BYTES
+
+active_tx = SessionRegistry("tx", round_expired, evict_round)
 
 async def tx_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
@@ -301,7 +2087,7 @@ async def tx_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Số tiền không hợp lệ.")
         return
     uid = update.effective_user.id
-    user_names[uid] = update.effective_user.username or update.effective_user.full_name
+    remember_user(update.effective_user)
     context.user_data["pending_tx_amount"] = amount
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔵 Tài", callback_data=f"tx|t|{amount}"),
                                 InlineKeyboardButton("🔴 Xỉu", callback_data=f"tx|x|{amount}")]])
@@ -309,137 +2095,268 @@ async def tx_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def tx_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
-    data = q.data or ""
-    try:
-        _, choice, amount = data.split("|")
-        amount = int(amount)
-    except:
-        await q.edit_message_text("Dữ liệu không hợp lệ.")
+    _, choice, amount = context.args
+    if choice not in TX_SIDES or amount <= 0:
+        await q.answer("Tương tác không hợp lệ.")
         return
-    uid = q.from_user.id
-    uname = q.from_user.username or q.from_user.full_name
-    user_names[uid] = uname
-    if balances.get(uid,0) < amount:
-        await q.edit_message_text("Bạn không đủ tiền.")
-        return
-    # deduct and register bet
-    balances[uid] -= amount
-    chat_id = q.message.chat_id
-    session = active_tx.get(chat_id)
-    if not session or not session.running:
-        # create session
-        m = await context.bot.send_message(chat_id, "🎲 Phiên TX bắt đầu — chờ cược...")
-        session = TxSession(chat_id)
-        session.running = True
-        session.end_time = datetime.now() + timedelta(seconds=session.countdown)
-        session._last_edit = datetime.now()
-        session.message_id = m.message_id
-        active_tx[chat_id] = session
-        # spawn countdown loop
-        asyncio.create_task(run_tx_countdown(context.application, session))
-    session.bets.append({"uid":uid,"uname":uname,"choice":choice,"amount":amount})
-    session.last_bet_time = datetime.now()
-    await q.edit_message_text(f"✅ @{uname} cược {'Tài' if choice=='t' else 'Xỉu'} {fmt_amount(amount)}")
-    save_data()
-
-async def run_tx_countdown(app: Application, session: TxSession):
-    chat_id = session.chat_id
+    uid = q.from_user.id; uname = remember_user(q.from_user)
+    # answered right away; the bet joins the chat's next batch and shows up on the
+    # round board, and only a rejection is sent back, privately
+    label = f"{'Tài' if choice=='t' else 'Xỉu'} {fmt_amount(amount)}"
+    fut = submit_tx_bet(context.application, q.message.chat_id, uid, uname, choice, amount)
+    fut.add_done_callback(lambda f: tx_bet_rejected(uid, label, f))
+    await q.answer(f"⏳ Đã nhận cược {label}")
+
+def tx_bet_rejected(uid:int, label:str, fut: asyncio.Future):
+    """Tell a bettor privately why their queued bet was not placed."""
+    reason = None if fut.cancelled() else fut.result()
+    if reason is not None:
+        outbox.send(uid, f"❌ Cược {label} không được đặt: {reason}")
+
+class TxIntake:
+    """Bets pressed in one chat that are waiting for the next batch."""
+    __slots__ = ("chat_id", "pending", "task")
+
+    def __init__(self, chat_id:int):
+        self.chat_id = chat_id
+        self.pending: List[tuple] = []  # (uid, uname, choice, amount, future)
+        self.task: Optional[asyncio.Task] = None
+
+tx_intakes: Dict[int, TxIntake] = {}
+
+def submit_tx_bet(app: Application, chat_id:int, uid:int, uname:str, choice:str, amount:int) -> asyncio.Future:
+    """Queue a bet; the future resolves to None once its batch placed it, else
+    to the reason it was rejected."""
+    intake = tx_intakes.get(chat_id)
+    if intake is None:
+        intake = tx_intakes[chat_id] = TxIntake(chat_id)
+    fut = asyncio.get_running_loop().create_future()
+    intake.pending.append((uid, uname, choice, amount, fut))
+    if intake.task is None:
+        intake.task = asyncio.create_task(drain_tx_intake(app, intake))
+    return fut
+
+async def drain_tx_intake(app: Application, intake: TxIntake):
     try:
-        while session.running:
-            now = datetime.now()
-            if session.last_bet_time and (now - session.last_bet_time).total_seconds() >= AUTO_CLOSE_AFTER_LAST_BET and session.bets:
-                break
-            if session.end_time and now >= session.end_time:
-                break
-            if session._last_edit is None or (now - session._last_edit).total_seconds() >= COUNTDOWN_EDIT_INTERVAL:
-                remaining = max(0, int((session.end_time - now).total_seconds())) if session.end_time else session.countdown
-                if session.bets:
-                    body = "\n".join([f"• {b['uname']}: {'Tài' if b['choice']=='t' else 'Xỉu'} {fmt_amount(b['amount'])}" for b in session.bets])
-                else:
-                    body = "Chưa có ai đặt cược."
-                try:
-                    await app.bot.edit_message_text(f"⏳ Phiên TX — còn {remaining}s\n{body}", chat_id=chat_id, message_id=session.message_id)
-                except:
-                    pass
-                session._last_edit = now
-            await asyncio.sleep(0.6)
-    except Exception as e:
-        logger.exception("tx countdown error: %s", e)
-    await end_tx_session(app, session)
+        while intake.pending:
+            if len(intake.pending) < TX_INTAKE_BATCH:
+                await asyncio.sleep(TX_INTAKE_WINDOW)  # let the rest of the burst arrive
+            batch = intake.pending[:TX_INTAKE_BATCH]
+            del intake.pending[:TX_INTAKE_BATCH]
+            try:
+                reasons = await place_tx_bets(app, intake.chat_id, [b[:4] for b in batch])
+            except Exception as e:
+                logger.exception("tx batch in chat %s failed: %s", intake.chat_id, e)
+                reasons = [TX_FAILED_TEXT] * len(batch)
+            for b, reason in zip(batch, reasons):
+                if not b[4].done():
+                    b[4].set_result(reason)
+    finally:
+        intake.task = None
+        if not intake.pending:
+            tx_intakes.pop(intake.chat_id, None)
+
+async def place_tx_bet(app: Application, chat_id:int, uid:int, uname:str, choice:str, amount:int) -> Optional[TxSession]:
+    """Queue one bet and wait for its batch. Returns None if it was not placed."""
+    if await submit_tx_bet(app, chat_id, uid, uname, choice, amount) is None:
+        return active_tx.get(chat_id)
+    return None
+
+async def place_tx_bets(app: Application, chat_id:int, bets: List[tuple]) -> List[Optional[str]]:
+    """Place a batch of (uid, uname, choice, amount) on the chat's round, opening one if
+    needed: one reservation pass, one book append and one close-timer update per batch.
+    Returns, per bet, None if it was placed or why it was rejected: the balance doesn't
+    cover it, the chat is at SESSION_CHAT_CAP, or the round message could not be sent."""
+    session = active_tx.get(chat_id)
+    if (not session or not session.running) and not active_tx.admits(chat_id):
+        return [SESSION_CAP_TEXT] * len(bets)
+    ok = await accounts.reserve_many([(uid, amount) for uid, _, _, amount in bets], "bet")
+    placed = [b for b, k in zip(bets, ok) if k]
+    if placed:
+        session = active_tx.get(chat_id)
+        if not session or not session.running:
+            m = await outbox.send(chat_id, "🎲 Phiên TX bắt đầu — chờ cược...")
+            if m is None:
+                await accounts.refund_round([(uid, amount) for uid, _, _, amount in placed], chat_id)
+                return [TX_FAILED_TEXT] * len(bets)
+            session = TxSession(chat_id)
+            session.running = True
+            session.end_time = timers.now() + session.countdown
+            session.message_id = m.message_id
+            active_tx.open(session)
+            session.close_timer = timers.call_at(session.end_time, end_tx_session, app, session)
+            session.tick_timer = timers.call_later(COUNTDOWN_EDIT_INTERVAL, tx_tick, app, session)
+        for uid, uname, choice, amount in placed:
+            session.book.add(uid, TX_SIDES[choice], amount)
+            session.board.add(uid, uname, choice, amount)
+        session.last_bet_time = timers.now()
+        # close AUTO_CLOSE_AFTER_LAST_BET seconds after the latest bet, but never after end_time
+        timers.reschedule(session.close_timer, min(session.end_time, session.last_bet_time + AUTO_CLOSE_AFTER_LAST_BET))
+        count_bet("tx", sum(b[3] for b in placed), len(placed))
+    metrics.inc("gamebot_tx_batches_total")
+    return [None if k else "Bạn không đủ tiền." for k in ok]
+
+def tx_tick(app: Application, session: TxSession):
+    if not session.running:
+        return
+    board = session.board
+    # the body is cached between bets, so rendering every tick is cheap; edit only on change
+    remaining = max(0, int(session.end_time - timers.now()))
+    text = f"⏳ Phiên TX — còn {remaining}s\n{board.body()}"
+    edit_countdown(board, session.chat_id, session.message_id, text)
+    session.tick_timer = timers.call_later(COUNTDOWN_EDIT_INTERVAL, tx_tick, app, session)
+
+def tx_roll(rng: RNGStream, previous:Optional[str]) -> str:
+    """Round result; biased to repeat the previous one 60% of the time."""
+    if previous and rng.random() < 0.6:
+        return previous
+    dice = [rng.randint(1,6) for _ in range(3)]
+    return "t" if sum(dice)>=11 else "x"
 
 async def end_tx_session(app: Application, session: TxSession):
+    if not session.running:
+        return
     session.running = False
+    session.close_timer.cancel()
+    session.tick_timer.cancel()
     chat_id = session.chat_id
-    # choose result (bias simple: 60% repeat previous)
-    if session.previous_result and random.random() < 0.6:
-        result = session.previous_result
-    else:
-        dice = [random.randint(1,6) for _ in range(3)]
-        s = sum(dice)
-        result = "t" if s>=11 else "x"
-        session.previous_result = result
+    prev = session.previous_result
+    result = session.previous_result = tx_roll(session.rng, prev)
     # try send PNG
-    png = image_path("tai.png") if result=="t" else image_path("xiu.png")
-    if png:
-        try:
-            await send_group_or_chat(app, chat_id, f"🎉 Kết quả: {'Tài' if result=='t' else 'Xỉu'}")
-            with open(png, "rb") as f:
-                await app.bot.send_photo(GROUP_ID or chat_id, f)
-        except:
-            await send_group_or_chat(app, chat_id, f"🎉 KQ: {'Tài' if result=='t' else 'Xỉu'}")
+    png = "tai.png" if result=="t" else "xiu.png"
+    if assets.get(png):
+        await send_group_or_chat(app, chat_id, f"🎉 Kết quả: {'Tài' if result=='t' else 'Xỉu'}", prio=PRIO_RESULT, mirror="tx")
+        send_asset(png, PRIO_RESULT, fallback=chat_id, chat_id=GROUP_ID or chat_id)
     else:
-        await send_group_or_chat(app, chat_id, f"🎉 KQ: {'Tài' if result=='t' else 'Xỉu'}")
-    winners=[]; losers=[]
-    for b in session.bets:
-        if b['choice']==result:
-            payout = b['amount']*2
-            balances[b['uid']] += payout
-            leaderboard[b['uid']] += (payout - b['amount'])
-            winners.append((b['uname'], payout))
-        else:
-            leaderboard[b['uid']] -= b['amount']
-            losers.append((b['uname'], b['amount']))
-    lines = [f"🎉 Chi tiết: {'Tài' if result=='t' else 'Xỉu'}"]
+        await send_group_or_chat(app, chat_id, f"🎉 KQ: {'Tài' if result=='t' else 'Xỉu'}", prio=PRIO_RESULT, mirror="tx")
+    if session.settled:
+        return  # evicted and refunded while the result was going out
+    side = TX_SIDES[result]
+    by_user = session.book.by_user()
+    settled = session.book.settle(side, by_user)
+    await accounts.settle(sum(session.book.totals), [(uid, payout, net) for uid,payout,net in settled], "payout", chat_id)
+    session.settled = True
+    history.add("tx", chat_id, settled)
+    log_round("tx", chat_id, session.rng, result, prev=prev)
+    count_payout("tx", 2*session.book.totals[side])
+    emit("tx_result", chat_id=chat_id, result=result, bets=len(session.book),
+         staked=sum(session.book.totals), paid=2*session.book.totals[side], bettors=len(settled))
+    winners = [(uid, payout) for uid,payout,_ in settled if payout]
+    losers = [(uid, st[1-side]) for uid,st in by_user.items() if st[1-side]]
+    lines = [f"🎉 Chi tiết: {'Tài' if result=='t' else 'Xỉu'} — {len(session.book)} cược, trả {fmt_amount(2*session.book.totals[side])}"]
     if winners:
         lines.append("🏆 Thắng:")
-        lines += [f"• @{u} nhận {fmt_amount(p)}" for u,p in winners]
+        lines += [f"• @{user_names.get(u,u)} nhận {fmt_amount(p)}" for u,p in winners]
     else:
         lines.append("🏆 Thắng: Không ai")
     if losers:
         lines.append("😞 Thua:")
-        lines += [f"• {u} mất {fmt_amount(a)}" for u,a in losers]
-    await send_group_or_chat(app, chat_id, "\n".join(lines))
-    active_tx.pop(chat_id, None)
-    save_data()
+        lines += [f"• {user_names.get(u,u)} mất {fmt_amount(a)}" for u,a in losers]
+    for text in chunk_lines(lines):
+        await send_group_or_chat(app, chat_id, text, prio=PRIO_RESULT, mirror="tx")
+    active_tx.close(session)
 
 # -----------------------
 # --- XỔ SỐ
 # -----------------------
+class XoSoBook:
+    """Picks of one round as bitmasks (bit n = number n) plus an inverted index
+    number -> pickers, so a draw only visits the pickers of the drawn numbers."""
+    __slots__ = ("masks", "stakes", "index", "staked")
+
+    def __init__(self):
+        self.masks: Dict[int,int] = {}  # uid -> picked numbers
+        self.stakes: Dict[int,int] = {}  # uid -> reserved stake
+        self.index = [set() for _ in range(XOSO_MAX + 1)]
+        self.staked = 0
+
+    def __len__(self):
+        return len(self.masks)
+
+    def add(self, uid:int, nums: List[int], amount:int) -> int:
+        """Record (or replace) a player's pick; returns the replaced stake."""
+        old = self.remove(uid)
+        mask = 0
+        for n in nums:
+            mask |= 1 << n
+            self.index[n].add(uid)
+        self.masks[uid] = mask
+        self.stakes[uid] = amount
+        self.staked += amount
+        return old
+
+    def remove(self, uid:int) -> int:
+        mask = self.masks.pop(uid, 0)
+        n = 0
+        while mask:
+            if mask & 1:
+                self.index[n].discard(uid)
+            mask >>= 1
+            n += 1
+        old = self.stakes.pop(uid, 0)
+        self.staked -= old
+        return old
+
+    def settle(self, drawn: List[int]):
+        """Returns (rows, hits): rows are (uid, payout, net) for every player, hits maps
+        winners to how many distinct drawn numbers they picked."""
+        hits = Counter()
+        for n in set(drawn):
+            hits.update(self.index[n])
+        masks, stakes = self.masks, self.stakes
+        rows = [(uid, 0, -st) for uid, st in stakes.items() if uid not in hits]
+        for uid, h in hits.items():
+            st = stakes[uid]
+            payout = st * h * XOSO_ODDS // masks[uid].bit_count()
+            rows.append((uid, payout, payout - st))
+        return rows, hits
+
+    def nbytes(self) -> int:
+        return nbytes(self, self.masks, self.stakes, *self.index) + len(self.masks) * 2 * ENTRY_BYTES
+
 class XoSoSession:
+    __slots__ = ("chat_id", "book", "end_time", "running", "settled", "message_id", "close_timer", "tick_timer", "rng")
+
     def __init__(self, chat_id):
         self.chat_id = chat_id
-        self.picks = {}  # uid -> list of numbers
-        self.end_time = None
+        self.book = XoSoBook()
+        self.end_time = None  # loop time (timers.now())
         self.running = False
+        self.settled = False
         self.message_id = None
-        self._last_edit = None
+        self.close_timer: Optional[Timer] = None
+        self.tick_timer: Optional[Timer] = None
+        self.rng = rngs.stream()
+
+    def stakes(self):
+        return self.book.stakes.items()
+
+    def nbytes(self) -> int:
+        return nbytes(self) + self.book.nbytes()
 
-active_xoso: Dict[int, XoSoSession] = {}
+active_xoso = SessionRegistry("xoso", round_expired, evict_round)
 
 async def xoso_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if chat_id in active_xoso and active_xoso[chat_id].running:
+    session = active_xoso.get(chat_id)
+    if session and session.running:
         await update.message.reply_text("Đã có phiên Xổ Số.")
         return
+    if not active_xoso.admits(chat_id):
+        await update.message.reply_text(SESSION_CAP_TEXT)
+        return
     m = await update.message.reply_text(f"🎰 Xổ số {XOSO_MIN}-{XOSO_MAX} — kéo dài {XOSO_DEFAULT_SESSION}s. /chon để tham gia")
+    open_xoso_session(context.application, chat_id, m.message_id)
+
+def open_xoso_session(app: Application, chat_id:int, message_id:int) -> XoSoSession:
     s = XoSoSession(chat_id)
-    s.end_time = datetime.now() + timedelta(seconds=XOSO_DEFAULT_SESSION)
+    s.end_time = timers.now() + XOSO_DEFAULT_SESSION
     s.running = True
-    s.message_id = m.message_id
-    s._last_edit = datetime.now()
-    active_xoso[chat_id] = s
-    asyncio.create_task(run_xoso_countdown(context.application, s))
+    s.message_id = message_id
+    active_xoso.open(s)
+    s.close_timer = timers.call_at(s.end_time, end_xoso_session, app, s)
+    s.tick_timer = timers.call_later(COUNTDOWN_EDIT_INTERVAL, xoso_tick, app, s)
+    return s
 
 async def chon_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -451,90 +2368,265 @@ async def chon_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Cú pháp: /chon 1,5 100k")
         return
     nums_raw = context.args[0]
-    nums = []
+    nums = set()
     for s in nums_raw.replace(" ", "").split(","):
         try:
             v = int(s)
             if XOSO_MIN <= v <= XOSO_MAX:
-                nums.append(v)
+                nums.add(v)
         except:
             pass
+    nums = sorted(nums)
     if not nums or len(nums) > XOSO_MAX_CHOICES:
         await update.message.reply_text("Số chọn không hợp lệ.")
         return
-    amount = parse_amount(context.args[1]) if len(context.args)>1 else 0
+    amount = parse_amount(context.args[1]) if len(context.args)>1 else None
+    if not amount or amount <= 0:
+        await update.message.reply_text("Cú pháp: /chon 1,5 100k")
+        return
     uid = update.effective_user.id
-    user_names[uid] = update.effective_user.username or update.effective_user.full_name
-    session.picks[uid] = nums
+    remember_user(update.effective_user)
+    if not await xoso_pick(session, uid, nums, amount):
+        await update.message.reply_text("Bạn không đủ tiền.")
+        return
     await update.message.reply_text(f"✅ @{user_names[uid]} chọn {nums} với {fmt_amount(amount)}")
 
-async def run_xoso_countdown(app: Application, session: XoSoSession):
+async def xoso_pick(session: XoSoSession, uid:int, nums: List[int], amount:int) -> bool:
+    """Reserve the stake and record the pick; a new pick replaces (and refunds) the old one."""
+    if not await accounts.reserve(uid, amount, "xoso"):
+        return False
+    if not session.running:  # drawn while the stake was being reserved
+        await accounts.refund(uid, amount)
+        return False
+    old = session.book.add(uid, nums, amount)
+    if old:
+        await accounts.refund(uid, old)
+    count_bet("xoso", amount)
+    return True
+
+def xoso_tick(app: Application, session: XoSoSession):
+    if not session.running:
+        return
+    remaining = max(0, int(session.end_time - timers.now()))
+    outbox.edit(session.chat_id, session.message_id, f"🎰 Xổ số còn {remaining}s — người đã chọn: {len(session.book)}")
+    session.tick_timer = timers.call_later(COUNTDOWN_EDIT_INTERVAL, xoso_tick, app, session)
+
+def xoso_draw(rng: RNGStream) -> List[int]:
+    """1..10 drawn numbers (can repeat)."""
+    return [rng.randint(XOSO_MIN, XOSO_MAX) for _ in range(rng.randint(1,10))]
+
+async def end_xoso_session(app: Application, session: XoSoSession):
+    if not session.running:
+        return
+    session.running = False
     chat_id = session.chat_id
-    try:
-        while session.running:
-            now = datetime.now()
-            if now >= session.end_time:
-                break
-            if session._last_edit is None or (now - session._last_edit).total_seconds() >= COUNTDOWN_EDIT_INTERVAL:
-                remaining = int((session.end_time - now).total_seconds())
-                try:
-                    await app.bot.edit_message_text(f"🎰 Xổ số còn {remaining}s — người đã chọn: {len(session.picks)}", chat_id=chat_id, message_id=session.message_id)
-                except:
-                    pass
-                session._last_edit = now
-            await asyncio.sleep(1)
-    except Exception as e:
-        logger.exception("xoso countdown error: %s", e)
-    # results: 1..10 random numbers (can duplicate)
-    results = [random.randint(XOSO_MIN, XOSO_MAX) for _ in range(random.randint(1,10))]
-    winners=[]
-    for uid, nums in session.picks.items():
-        for r in results:
-            if r in nums:
-                winners.append((uid, r))
+    session.close_timer.cancel()
+    session.tick_timer.cancel()
+    results = xoso_draw(session.rng)
+    book = session.book
+    rows, hits = book.settle(results)
+    await accounts.settle(book.staked, rows, "xoso", chat_id)
+    session.settled = True
+    history.add("xoso", chat_id, rows)
+    log_round("xoso", chat_id, session.rng, results)
+    paid = sum(r[1] for r in rows)
+    count_payout("xoso", paid)
+    emit("xoso_result", chat_id=chat_id, results=results, players=len(book), hits=sum(hits.values()),
+         staked=book.staked, paid=paid)
     lines=[f"🎉 KQ xổ số: {results}"]
-    if winners:
-        for uid,r in winners:
-            lines.append(f"• @{user_names.get(uid,uid)} trúng {r}")
+    if hits:
+        drawn = 0
+        for r in results:
+            drawn |= 1 << r
+        best = heapq.nlargest(XOSO_RESULT_TOP, ((p, uid) for uid,p,_ in rows if uid in hits))
+        for p, uid in best:
+            nums = [n for n in range(XOSO_MIN, XOSO_MAX + 1) if book.masks[uid] & drawn & (1 << n)]
+            lines.append(f"• @{user_names.get(uid,uid)} trúng {', '.join(map(str, nums))} — nhận {fmt_amount(p)}")
+        if len(hits) > len(best):
+            lines.append(f"… và {len(hits) - len(best)} người trúng khác")
     else:
         lines.append("Không ai trúng.")
-    await send_group_or_chat(app, chat_id, "\n".join(lines))
-    session.running = False
-    active_xoso.pop(chat_id, None)
+    await send_group_or_chat(app, chat_id, "\n".join(lines), prio=PRIO_RESULT, mirror="xoso")
+    active_xoso.close(session)
 
 # -----------------------
 # --- BẦU CUA
 # -----------------------
 BAU_CUA = {"bau":"🍐","cua":"🦀","ca":"🐟","ga":"🐔","nai":"🦌","tom":"🦞"}
+BAU_CUA_KEYS = list(BAU_CUA)  # animal -> column in the per-animal lists
+
+class BauCuaSession:
+    """One round: stakes pooled per animal, plus each bettor's stake per animal.
+    Settlement works from these aggregates, never from individual bets."""
+    __slots__ = ("chat_id", "pools", "counts", "by_user", "staked", "end_time", "running", "settled",
+                 "message_id", "close_timer", "tick_timer", "sent_text", "rng")
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.pools = [0] * len(BAU_CUA_KEYS)
+        self.counts = [0] * len(BAU_CUA_KEYS)
+        self.by_user: Dict[int, List[int]] = {}
+        self.staked = 0
+        self.end_time = None  # loop time (timers.now())
+        self.running = False
+        self.settled = False
+        self.message_id = None
+        self.close_timer: Optional[Timer] = None
+        self.tick_timer: Optional[Timer] = None
+        self.sent_text = None  # countdown text last pushed to Telegram
+        self.rng = rngs.stream()
+
+    def add(self, uid:int, animal:int, amount:int):
+        self.pools[animal] += amount
+        self.counts[animal] += 1
+        st = self.by_user.get(uid)
+        if st is None:
+            st = self.by_user[uid] = [0] * len(BAU_CUA_KEYS)
+        st[animal] += amount
+        self.staked += amount
+
+    def board(self) -> str:
+        lines = [f"{BAU_CUA[k]} {k}: {fmt_amount(self.pools[i])} ({self.counts[i]} cược)" for i,k in enumerate(BAU_CUA_KEYS)]
+        lines.append(f"Tổng: {fmt_amount(self.staked)} — {len(self.by_user)} người")
+        return "\n".join(lines)
+
+    @staticmethod
+    def multipliers(dice: List[int]) -> List[int]:
+        """What a stake returns per animal: rolled c times pays the stake back plus c times it."""
+        mult = [0] * len(BAU_CUA_KEYS)
+        for d in dice:
+            mult[d] += 1
+        return [m + 1 if m else 0 for m in mult]
+
+    def settle(self, dice: List[int]) -> List[tuple]:
+        """(uid, payout, net) per bettor."""
+        mult = self.multipliers(dice)
+        won = [i for i,m in enumerate(mult) if m]
+        rows = []
+        for uid, st in self.by_user.items():
+            payout = sum(st[i] * mult[i] for i in won)
+            rows.append((uid, payout, payout - sum(st)))
+        return rows
+
+    def stakes(self):
+        return ((uid, sum(st)) for uid, st in self.by_user.items())
+
+    def nbytes(self) -> int:
+        return nbytes(self, self.pools, self.counts, self.by_user) + len(self.by_user) * (ENTRY_BYTES + nbytes([0] * len(BAU_CUA_KEYS)))
+
+active_baucua = SessionRegistry("baucua", round_expired, evict_round)
+
 async def baucua_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    kb = [[InlineKeyboardButton(f"{v} {k}", callback_data=f"baucua|{k}") for k,v in BAU_CUA.items()]]
-    await update.message.reply_text("Chọn linh vật để đặt:", reply_markup=InlineKeyboardMarkup(kb))
+    amount = parse_amount(context.args[0]) if context.args else BAUCUA_DEFAULT_STAKE
+    if not amount or amount <= 0:
+        await update.message.reply_text("Số tiền không hợp lệ.")
+        return
+    buttons = [InlineKeyboardButton(f"{v} {k}", callback_data=f"baucua|{k}|{amount}") for k,v in BAU_CUA.items()]
+    kb = InlineKeyboardMarkup([buttons[:3], buttons[3:]])
+    await update.message.reply_text(f"Đặt {fmt_amount(amount)} — chọn linh vật:", reply_markup=kb)
 
 async def baucua_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
-    parts = q.data.split("|")
-    if len(parts)<2:
-        await q.edit_message_text("Tương tác không hợp lệ.")
+    _, choice, amount = context.args
+    if choice not in BAU_CUA or amount <= 0:
+        await q.answer("Tương tác không hợp lệ.")
         return
-    choice = parts[1]
-    uid = q.from_user.id; uname = q.from_user.username or q.from_user.full_name
-    user_names[uid]=uname
-    # For demo, default bet 100k
-    amt = 100_000
-    balances[uid] = balances.get(uid,0) - amt
-    await send_group_or_chat(context, q.message.chat_id, f"🦀 @{uname} đặt {choice} {fmt_amount(amt)}")
-    await q.edit_message_text(f"✅ Bạn đã đặt {choice} {fmt_amount(amt)}")
+    uid = q.from_user.id; uname = remember_user(q.from_user)
+    if not active_baucua.admits(q.message.chat_id):
+        await q.answer(SESSION_CAP_TEXT, show_alert=True)
+        return
+    if not await place_baucua_bet(context.application, q.message.chat_id, uid, choice, amount):
+        await q.answer("Bạn không đủ tiền.", show_alert=True)
+        return
+    # confirmed privately; the round's board message shows everyone's stakes
+    await q.answer(f"✅ Đã đặt {BAU_CUA[choice]} {choice} {fmt_amount(amount)}")
+
+async def place_baucua_bet(app: Application, chat_id:int, uid:int, choice:str, amount:int) -> Optional[BauCuaSession]:
+    """Reserve a stake and add it to the chat's round, opening one if needed."""
+    if not active_baucua.admits(chat_id) or not await accounts.reserve(uid, amount, "baucua"):
+        return None
+    count_bet("baucua", amount)
+    session = active_baucua.get(chat_id)
+    if session and session.running:
+        session.add(uid, BAU_CUA_KEYS.index(choice), amount)
+        return session
+    # registered before the board is posted, so presses arriving meanwhile join this round
+    session = BauCuaSession(chat_id)
+    session.running = True
+    session.end_time = timers.now() + BAUCUA_SECONDS
+    active_baucua.open(session)
+    session.close_timer = timers.call_at(session.end_time, end_baucua_session, app, session)
+    session.tick_timer = timers.call_later(COUNTDOWN_EDIT_INTERVAL, baucua_tick, app, session)
+    session.add(uid, BAU_CUA_KEYS.index(choice), amount)
+    m = await outbox.send(chat_id, f"🦀 Phiên Bầu Cua — {BAUCUA_SECONDS}s để đặt")
+    if m is None:
+        session.running = False
+        session.close_timer.cancel()
+        session.tick_timer.cancel()
+        active_baucua.close(session)
+        if not session.settled:
+            session.settled = True
+            await accounts.refund_round(list(session.stakes()), chat_id)
+        raise RuntimeError(f"could not post the Bầu Cua board in {chat_id}")
+    session.message_id = m.message_id
+    return session
+
+def baucua_tick(app: Application, session: BauCuaSession):
+    if not session.running:
+        return
+    remaining = max(0, int(session.end_time - timers.now()))
+    text = f"🦀 Phiên Bầu Cua — còn {remaining}s\n{session.board()}"
+    if session.message_id is not None:
+        edit_countdown(session, session.chat_id, session.message_id, text)
+    session.tick_timer = timers.call_later(COUNTDOWN_EDIT_INTERVAL, baucua_tick, app, session)
+
+def baucua_roll(rng: RNGStream) -> List[int]:
+    return [rng.randrange(len(BAU_CUA_KEYS)) for _ in range(3)]
+
+async def end_baucua_session(app: Application, session: BauCuaSession):
+    if not session.running:
+        return
+    session.running = False
+    session.close_timer.cancel()
+    session.tick_timer.cancel()
+    chat_id = session.chat_id
+    dice = baucua_roll(session.rng)
+    mult = session.multipliers(dice)
+    rows = session.settle(dice)
+    await accounts.settle(session.staked, rows, "baucua", chat_id)
+    session.settled = True
+    history.add("baucua", chat_id, rows)
+    log_round("baucua", chat_id, session.rng, [BAU_CUA_KEYS[d] for d in dice])
+    paid = sum(p * m for p, m in zip(session.pools, mult))
+    count_payout("baucua", paid)
+    emit("baucua_result", chat_id=chat_id, dice=[BAU_CUA_KEYS[d] for d in dice], bets=sum(session.counts),
+         staked=session.staked, paid=paid, bettors=len(rows))
+    lines = [f"🎲 Bầu Cua: {' '.join(BAU_CUA[BAU_CUA_KEYS[d]] for d in dice)} — {sum(session.counts)} cược, trả {fmt_amount(paid)}"]
+    for i, m in enumerate(mult):
+        if m and session.pools[i]:
+            k = BAU_CUA_KEYS[i]
+            lines.append(f"{BAU_CUA[k]} {k} x{m}: {fmt_amount(session.pools[i])} → {fmt_amount(session.pools[i] * m)}")
+    best = heapq.nlargest(BAUCUA_RESULT_TOP, ((p, uid) for uid,p,_ in rows if p))
+    if best:
+        lines.append("🏆 Thắng:")
+        lines += [f"• @{user_names.get(uid,uid)} nhận {fmt_amount(p)}" for p, uid in best]
+        winners = sum(1 for _,p,_ in rows if p)
+        if winners > len(best):
+            lines.append(f"… và {winners - len(best)} người thắng khác")
+    else:
+        lines.append("Không ai thắng.")
+    for text in chunk_lines(lines):
+        await send_group_or_chat(app, chat_id, text, prio=PRIO_RESULT, mirror="baucua")
+    active_baucua.close(session)
 
 # -----------------------
 # --- TẾT MINI
 # -----------------------
 async def liixi_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    amt = random.randint(10_000, 200_000)
-    balances[uid] = balances.get(uid,0) + amt
-    user_names[uid] = update.effective_user.username or update.effective_user.full_name
+    amt = rngs.misc.randint(10_000, 200_000)
+    await accounts.credit(uid, amt, "liixi")
+    remember_user(update.effective_user)
     await update.message.reply_text(f"🧧 Bạn nhận được lì xì {fmt_amount(amt)}")
 
 async def hoamai_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -554,6 +2646,9 @@ async def xongdat_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- FREE FIRE (ST + TC) simplified with button-only UI
 # -----------------------
 class FFPlayer:
+    __slots__ = ("user_id", "username", "hp", "medkits", "keos", "guns", "pistol", "alive", "knocked",
+                 "kills", "jumped", "team", "money", "mp5_level")
+
     def __init__(self, uid:int, uname:str):
         self.user_id = uid
         self.username = uname
@@ -571,6 +2666,11 @@ class FFPlayer:
         self.mp5_level = 0
 
 class FFLobby:
+    """A chat's lobby, or a cross-chat match (chat_id is then a match id and
+    `origin` maps each player to the chat they queued from)."""
+    __slots__ = ("chat_id", "mode", "players", "started", "message_id", "matchmaking_seconds", "lock", "map_name", "touched", "rng",
+                 "origin")
+
     def __init__(self, chat_id:int, mode:str):
         self.chat_id = chat_id
         self.mode = mode  # 'st' or 'tc'
@@ -580,8 +2680,283 @@ class FFLobby:
         self.matchmaking_seconds = 0
         self.lock = asyncio.Lock()
         self.map_name = None
+        self.touched = 0.0  # loop time of the last join/leave, or of the start of the match
+        self.rng = rngs.stream()
+        self.origin: Dict[int,int] = {}
+
+    def chats(self) -> List[int]:
+        return list(dict.fromkeys(self.origin.values())) if self.origin else [self.chat_id]
+
+    def nbytes(self) -> int:
+        return (nbytes(self, self.players, self.origin) + len(self.origin) * ENTRY_BYTES
+                + sum(nbytes(p, p.guns) + ENTRY_BYTES for p in self.players.values()))
+
+def lobby_expired(lobby: FFLobby, now:float) -> bool:
+    return now - lobby.touched > (FF_MATCH_MAX if lobby.started else FF_LOBBY_IDLE)
+
+async def evict_lobby(app: Application, lobby: FFLobby):
+    if not lobby.started and lobby.message_id:
+        outbox.edit(lobby.chat_id, lobby.message_id, "⌛ Phòng FF đã đóng vì không hoạt động.")
+
+ff_lobbies = SessionRegistry("ff", lobby_expired, evict_lobby)
+ff_matches = SessionRegistry("ff_match", lobby_expired, evict_lobby)  # cross-chat matches by match id
+# Telegram chat ids fit in 52 bits; match ids start past that, so a match never
+# shares a session counter, log line or callback with a real chat
+ff_match_ids = itertools.count(-(1 << 53), -1)
+
+# --- FF matchmaking ---
+# Players from every chat queue per mode and are pooled into matches of
+# FF_MATCH_SIZE. Tickets sit in rating buckets of FF_RATING_BUCKET points; a
+# bucket that fills up starts a match at once, and a periodic pass lets each
+# player waiting longer than FF_WIDEN_SECONDS reach one more bucket either side
+# per step. After MATCHMAKING_MAX_WAIT the match starts with whoever is
+# nearest, however few, as long as there are FF_MATCH_MIN; a player still alone
+# then leaves the queue. A chat lobby with FF_MATCH_MIN players plays on its own
+# with its own teams; only a lone starter is queued. In shard mode each worker
+# pools only its own chats.
+class FFTicket:
+    __slots__ = ("user_id", "username", "chat_id", "rating", "bucket", "since")
+
+    def __init__(self, uid:int, uname:str, chat_id:int, rating:int, since:float):
+        self.user_id = uid
+        self.username = uname
+        self.chat_id = chat_id
+        self.rating = rating
+        self.bucket = rating // FF_RATING_BUCKET
+        self.since = since
+
+class FFQueue:
+    """Tickets of one mode. `tickets` is in join order, which is wait order, and
+    each bucket is a FIFO dict, so joining and leaving cost O(1) plus a bisect
+    into the sorted ids of the non-empty buckets."""
+    def __init__(self, mode:str):
+        self.mode = mode
+        self.tickets: Dict[int, FFTicket] = {}  # uid -> ticket, oldest first
+        self.buckets: Dict[int, Dict[int, FFTicket]] = {}
+        self.keys: List[int] = []  # sorted ids of non-empty buckets
+        self.timer: Optional[Timer] = None
+        self.matched = 0
+
+    def __len__(self) -> int:
+        return len(self.tickets)
+
+    def __contains__(self, uid:int) -> bool:
+        return uid in self.tickets
+
+    def add(self, t: FFTicket) -> Optional[List[FFTicket]]:
+        """Queue a ticket; returns a match if its bucket is now full."""
+        self.tickets[t.user_id] = t
+        b = self.buckets.get(t.bucket)
+        if b is None:
+            b = self.buckets[t.bucket] = {}
+            bisect.insort(self.keys, t.bucket)
+        b[t.user_id] = t
+        if len(b) >= FF_MATCH_SIZE:
+            return self._take(list(itertools.islice(b.values(), FF_MATCH_SIZE)))
+        return None
+
+    def remove(self, uid:int) -> Optional[FFTicket]:
+        t = self.tickets.pop(uid, None)
+        if t is None:
+            return None
+        b = self.buckets[t.bucket]
+        del b[uid]
+        if not b:
+            del self.buckets[t.bucket]
+            del self.keys[bisect.bisect_left(self.keys, t.bucket)]
+        return t
+
+    def _take(self, picked: List[FFTicket]) -> List[FFTicket]:
+        for t in picked:
+            self.remove(t.user_id)
+        self.matched += 1
+        return picked
+
+    def window(self, t: FFTicket, spread:float) -> List[FFTicket]:
+        """Up to FF_MATCH_SIZE tickets within `spread` buckets of t's, nearest bucket first."""
+        lo = bisect.bisect_left(self.keys, t.bucket - spread)
+        hi = bisect.bisect_right(self.keys, t.bucket + spread)
+        picked = []
+        for k in sorted(self.keys[lo:hi], key=lambda k: abs(k - t.bucket)):
+            for other in self.buckets[k].values():
+                picked.append(other)
+                if len(picked) == FF_MATCH_SIZE:
+                    return picked
+        return picked
+
+    def take(self, now:float) -> tuple:
+        """Every match the widened windows allow, oldest ticket first, and the
+        timed-out tickets that found no one to play with."""
+        matches, stranded = [], []
+        for t in list(self.tickets.values()):
+            if t.user_id not in self.tickets:
+                continue  # went into an earlier match of this pass
+            waited = now - t.since
+            if waited < FF_WIDEN_SECONDS:
+                break  # younger tickets only see their own bucket, which add() already checked
+            timed_out = waited >= MATCHMAKING_MAX_WAIT
+            picked = self.window(t, float("inf") if timed_out else waited // FF_WIDEN_SECONDS)
+            if timed_out and len(picked) < FF_MATCH_MIN:
+                stranded.append(self.remove(t.user_id))
+            elif timed_out or len(picked) == FF_MATCH_SIZE:
+                matches.append(self._take(picked))
+        return matches, stranded
+
+ff_queues = {"st": FFQueue("st"), "tc": FFQueue("tc")}
+
+def ff_rating(uid:int) -> int:
+    return ff_ratings.get(uid, FF_RATING_START)
+
+def ff_enqueue(app: Application, mode:str, uid:int, uname:str, chat_id:int) -> bool:
+    """Queue a player for a cross-chat match; False if they are queued already."""
+    if any(uid in fq for fq in ff_queues.values()):
+        return False
+    queue = ff_queues[mode]
+    match = queue.add(FFTicket(uid, uname, chat_id, ff_rating(uid), timers.now()))
+    if match:
+        start_ff_match(app, mode, match)
+    if queue.tickets and queue.timer is None:
+        queue.timer = timers.call_later(FF_QUEUE_INTERVAL, ff_queue_pass, app, queue)
+    return True
+
+def ff_queue_pass(app: Application, queue: FFQueue):
+    queue.timer = None
+    matches, stranded = queue.take(timers.now())
+    for match in matches:
+        start_ff_match(app, queue.mode, match)
+    for t in stranded:
+        outbox.send(t.chat_id, f"⌛ @{t.username}: không tìm được đối thủ sau {MATCHMAKING_MAX_WAIT}s, đã rời hàng chờ.")
+    if queue.tickets:
+        queue.timer = timers.call_later(FF_QUEUE_INTERVAL, ff_queue_pass, app, queue)
+
+def start_ff_match(app: Application, mode:str, tickets: List[FFTicket]) -> FFLobby:
+    """Run queued players as one match; in Tử Chiến teams are snake-drafted by rating."""
+    lobby = FFLobby(next(ff_match_ids), mode)
+    now = timers.now()
+    for i, t in enumerate(sorted(tickets, key=lambda t: t.rating, reverse=True)):
+        p = lobby.players[t.user_id] = FFPlayer(t.user_id, t.username)
+        if mode == "tc":
+            p.team = 0 if i % 4 in (0, 3) else 1
+        lobby.origin[t.user_id] = t.chat_id
+        metrics.observe("gamebot_ff_queue_wait_seconds", now - t.since, mode=mode)
+    lobby.started = True
+    ff_matches.open(lobby)
+    asyncio.create_task(ff_matchmaking(app, lobby))
+    return lobby
+
+def rate_ff_match(lobby: FFLobby, won: set):
+    """Move each player's rating by their kills and by the win or loss."""
+    new = {uid: max(0, ff_rating(uid) + FF_RATING_KILL * p.kills + (FF_RATING_WIN if uid in won else -FF_RATING_LOSS))
+           for uid, p in lobby.players.items()}
+    ff_ratings.update(new)
+    persist.touch_many("ff_ratings", new)
+
+FF_MAPS = ["Làng Thông","Tháp Đồng Hồ","Cổng Trời","Khu Trung Cư","Đảo Quân Sự"]
+FF_PISTOLS = ["m500","g18"]
+FF_GUNS = ["ak47","scar","m14","mp5","mp40"]
+FF_DAMAGE = {"m500": (25,45), "g18": (15,30), "ak47": (30,55), "scar": (28,50), "m14": (35,70), "mp5": (18,35), "mp40": (20,38)}
+
+class FFEngine:
+    """Combat state of one match. Alive players sit in one list with an
+    index map (O(1) random pick and swap-remove) and are counted per team;
+    in Sinh Tồn every player is its own team."""
+    def __init__(self, lobby: FFLobby, rng: RNGStream):
+        self.lobby = lobby
+        self.rng = rng
+        self.players = lobby.players
+        self.alive: List[int] = []
+        self.pos: Dict[int,int] = {}
+        self.team_alive: Dict[object,int] = defaultdict(int)
+        self.team_up: Dict[object,int] = defaultdict(int)  # alive and not knocked
+        self.knocked: Dict[int, FFPlayer] = {}  # uid -> knocked by
+        self.feed: List[str] = []  # kill lines not yet posted
+        self.shots = 0
+        for uid, p in self.players.items():
+            if p.alive:
+                self.pos[uid] = len(self.alive)
+                self.alive.append(uid)
+                self.team_alive[self.team_of(p)] += 1
+                self.team_up[self.team_of(p)] += 1
+
+    def team_of(self, p: FFPlayer):
+        return p.team if self.lobby.mode == "tc" and p.team is not None else p.user_id
+
+    def _drop(self, uid:int):
+        i = self.pos.pop(uid)
+        last = self.alive.pop()
+        if last != uid:
+            self.alive[i] = last
+            self.pos[last] = i
+
+    def teams_left(self) -> int:
+        return sum(1 for n in self.team_alive.values() if n > 0)
+
+    def finished(self) -> bool:
+        return len(self.alive) <= 1 or self.teams_left() <= 1
+
+    def _eliminate(self, p: FFPlayer, by: FFPlayer, line:str):
+        team = self.team_of(p)
+        if not p.knocked:
+            self.team_up[team] -= 1
+        p.alive = False
+        p.knocked = False
+        self.team_alive[team] -= 1
+        by.kills += 1
+        self.feed.append(line)
+        emit("ff_kill", chat_id=self.lobby.chat_id, killer=by.user_id, victim=p.user_id)
+
+    def bleed_out(self):
+        """Finish every knocked player; they only count as alive until then."""
+        for uid, by in list(self.knocked.items()):
+            p = self.players[uid]
+            self._eliminate(p, by, f"☠️ @{p.username} bị @{by.username} kết liễu")
+        self.knocked.clear()
+
+    def tick(self):
+        """Resolve one batch of shots, scaled to the number of players alive."""
+        self.bleed_out()  # knocked players from the previous tick
+        alive = self.alive
+        for _ in range(1 + len(alive) // FF_SHOTS_DIVISOR):
+            if self.finished():
+                break
+            attacker = self.players[alive[self.rng.randrange(len(alive))]]
+            target = None
+            for _ in range(8):
+                t = self.players[alive[self.rng.randrange(len(alive))]]
+                if self.team_of(t) != self.team_of(attacker):
+                    target = t
+                    break
+            if target is None:
+                continue
+            gun = attacker.guns[0] if attacker.guns else attacker.pistol
+            lo, hi = FF_DAMAGE.get(gun, (15,60))
+            dmg = self.rng.randint(lo, hi)
+            target.hp -= dmg
+            self.shots += 1
+            if target.hp > 0:
+                continue
+            self._drop(target.user_id)
+            if self.lobby.mode == "tc" and self.team_up[self.team_of(target)] > 1:
+                target.knocked = True  # a teammate is still up
+                self.team_up[self.team_of(target)] -= 1
+                self.knocked[target.user_id] = attacker
+                self.feed.append(f"💥 @{attacker.username} hạ gục @{target.username} — {dmg} dmg")
+            else:
+                self._eliminate(target, attacker, f"🔫 @{attacker.username} hạ @{target.username} — {dmg} dmg")
+
+    def digest(self) -> Optional[str]:
+        """Pending kill feed as one message (at most FF_FEED_LINES lines)."""
+        if not self.feed:
+            return None
+        lines = self.feed[:FF_FEED_LINES]
+        if len(self.feed) > FF_FEED_LINES:
+            lines.append(f"… +{len(self.feed) - FF_FEED_LINES} pha hạ gục khác")
+        self.feed = []
+        return f"⚔️ Diễn biến — còn {len(self.alive)} người\n" + "\n".join(lines)
+
+    def standings(self) -> List[FFPlayer]:
+        return sorted(self.players.values(), key=lambda p: (p.alive, p.kills, p.hp), reverse=True)
 
-ff_lobbies: Dict[int, FFLobby] = {}
 
 def ff_lobby_kb(chat_id:int):
     return InlineKeyboardMarkup([
@@ -605,31 +2980,63 @@ async def ff_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("🏝 Sinh Tồn", callback_data="ff_mode|st"),
          InlineKeyboardButton("⚔️ Tử Chiến", callback_data="ff_mode|tc")],
-        [InlineKeyboardButton("⭐ Rank", callback_data="ff_rank")],
+        [InlineKeyboardButton("🔎 Ghép nhanh ST", callback_data="ff_queue|st"),
+         InlineKeyboardButton("🔎 Ghép nhanh TC", callback_data="ff_queue|tc")],
+        [InlineKeyboardButton("🚪 Rời hàng chờ", callback_data="ff_unqueue"),
+         InlineKeyboardButton("⭐ Rank", callback_data="ff_rank")],
     ])
     await update.message.reply_text("🔥 Free Fire — chọn chế độ", reply_markup=kb)
 
 async def ff_mode_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    parts = q.data.split("|")
-    mode = parts[1]
+    _, mode = context.args
+    if mode not in ("st", "tc"):
+        return
     chat_id = q.message.chat.id
+    old = ff_lobbies.get(chat_id)
+    if old and old.started:
+        await q.edit_message_text("Trận FF đang diễn ra.")
+        return
+    if not ff_lobbies.admits(chat_id):
+        await q.edit_message_text(SESSION_CAP_TEXT)
+        return
     # create lobby
     lobby = FFLobby(chat_id, mode)
-    uid = q.from_user.id; uname = q.from_user.username or q.from_user.full_name
-    lobby.players[uid] = FFPlayer(uid, uname)
-    user_names[uid] = uname
+    lobby.touched = timers.now()
+    uid = q.from_user.id; uname = remember_user(q.from_user)
+    p = lobby.players[uid] = FFPlayer(uid, uname)
+    if mode == "tc":
+        p.team = 0
     m = await context.bot.send_message(chat_id, f"🎮 Phòng FF ({'Sinh tồn' if mode=='st' else 'Tử chiến'}) đã tạo. Người chơi: 1", reply_markup=ff_lobby_kb(chat_id))
     lobby.message_id = m.message_id
-    ff_lobbies[chat_id] = lobby
+    ff_lobbies.open(lobby)
+
+async def ff_queue_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    _, mode = context.args
+    if mode not in ff_queues:
+        await q.answer()
+        return
+    uname = remember_user(q.from_user)
+    if not ff_enqueue(context.application, mode, q.from_user.id, uname, q.message.chat.id):
+        await q.answer("Bạn đã ở trong hàng chờ.")
+        return
+    await q.answer(f"🔎 Đang tìm trận {'Sinh tồn' if mode=='st' else 'Tử chiến'}... ({len(ff_queues[mode])} người chờ, tối đa {MATCHMAKING_MAX_WAIT}s)")
+
+async def ff_unqueue_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    left = [fq for fq in ff_queues.values() if fq.remove(q.from_user.id)]
+    await q.answer("🚪 Đã rời hàng chờ." if left else "Bạn không ở trong hàng chờ.")
+
+async def ff_rank_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer(f"⭐ Điểm FF: {ff_rating(q.from_user.id)}\n🔎 Đang chờ: ST {len(ff_queues['st'])} · TC {len(ff_queues['tc'])}", show_alert=True)
 
 async def ff_lobby_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    parts = q.data.split("|")
-    action = parts[0]
-    chat_id = int(parts[1])
+    action, chat_id = context.args
     lobby = ff_lobbies.get(chat_id)
     if not lobby:
         await q.edit_message_text("Phòng không tồn tại.")
@@ -637,6 +3044,9 @@ async def ff_lobby_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = q.from_user.id; uname = q.from_user.username or q.from_user.full_name
     async with lobby.lock:
         if action=="ff_join":
+            if lobby.started:
+                await q.edit_message_text("Trận đã bắt đầu.")
+                return
             if uid in lobby.players:
                 await q.edit_message_text(f"Bạn đã ở trong phòng. Tổng: {len(lobby.players)}")
                 return
@@ -649,15 +3059,20 @@ async def ff_lobby_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 lobby.players[uid] = p
             else:
                 lobby.players[uid] = FFPlayer(uid, uname)
-            user_names[uid]=uname
+            remember_user(q.from_user)
+            lobby.touched = timers.now()
             await q.edit_message_text(f"✅ @{uname} tham gia. Tổng: {len(lobby.players)}", reply_markup=ff_lobby_kb(chat_id))
             return
         if action=="ff_leave":
+            if lobby.started:
+                await q.edit_message_text("Trận đã bắt đầu.")
+                return
             if uid in lobby.players:
                 lobby.players.pop(uid,None)
+                lobby.touched = timers.now()
                 await q.edit_message_text(f"🚪 @{uname} rời phòng. Tổng: {len(lobby.players)}", reply_markup=ff_lobby_kb(chat_id))
                 if not lobby.players:
-                    ff_lobbies.pop(chat_id,None)
+                    ff_lobbies.close(lobby)
                 return
             else:
                 await q.edit_message_text("Bạn không ở trong phòng.")
@@ -666,145 +3081,897 @@ async def ff_lobby_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if lobby.started:
                 await q.edit_message_text("Phòng đã bắt đầu.")
                 return
-            lobby.started = True
-            await q.edit_message_text("⏳ Đang ghép trận... (random 1..50s)")
-            # start matchmaking loop
-            asyncio.create_task(ff_matchmaking(context.application, lobby))
+            if len(lobby.players) >= FF_MATCH_MIN:
+                lobby.started = True
+                await q.edit_message_text("✅ Phòng đủ người — vào trận!")
+                asyncio.create_task(ff_matchmaking(context.application, lobby))
+                return
+            # a player alone: pool them with players from other chats
+            queued = sum(ff_enqueue(context.application, lobby.mode, p.user_id, p.username, chat_id) for p in lobby.players.values())
+            ff_lobbies.close(lobby)
+            await q.edit_message_text(f"🔎 Đã đưa {queued} người vào hàng chờ ghép trận (tối đa {MATCHMAKING_MAX_WAIT}s).")
             return
 
+def ff_loot(lobby: FFLobby, rng: RNGStream):
+    for p in lobby.players.values():
+        p.pistol = rng.choice(FF_PISTOLS)
+        if rng.random()<0.85:
+            p.guns.append(rng.choice(FF_GUNS))
+
+def ff_outcome(lobby: FFLobby) -> list:
+    return [[p.user_id, p.kills, p.alive] for p in lobby.players.values()]
+
+async def ff_announce(app: Application, lobby: FFLobby, text:str, prio:int=PRIO_NORMAL, mirror:bool=False, **kwargs):
+    """Post to every chat with a player in the match (once when everything goes to GROUP_ID);
+    with `mirror`, FF subscribers outside the match get a copy."""
+    chats = lobby.chats()
+    if mirror:
+        fanout.publish("ff", text, (*chats, GROUP_ID), **kwargs)
+    for chat_id in chats[:1] if GROUP_ID else chats:
+        await send_group_or_chat(app, chat_id, text, prio=prio, **kwargs)
+
 async def ff_matchmaking(app: Application, lobby: FFLobby):
     chat_id = lobby.chat_id
-    # random wait 1..50
-    wait = random.randint(1, MATCHMAKING_MAX_WAIT)
-    await asyncio.sleep(wait)
+    lobby.touched = timers.now()
     # proceed to lobby spawn (5s)
-    await send_group_or_chat(app, chat_id, f"✅ Ghép thành công! Vào sảnh {LOBBY_SPAWN_SECONDS}s...")
-    await asyncio.sleep(LOBBY_SPAWN_SECONDS)
+    chats = lobby.chats()
+    where = f" — {len(lobby.players)} người từ {len(chats)} nhóm" if len(chats) > 1 else ""
+    await ff_announce(app, lobby, f"✅ Ghép thành công{where}! Vào sảnh {LOBBY_SPAWN_SECONDS}s...")
+    await timers.sleep(LOBBY_SPAWN_SECONDS)
     # plane stage
-    lobby.map_name = random.choice(["Làng Thông","Tháp Đồng Hồ","Cổng Trời","Khu Trung Cư","Đảo Quân Sự"])
-    await send_group_or_chat(app, chat_id, f"✈️ Máy bay — Map: {lobby.map_name}\n🪂 30s để nhảy (bấm nút nếu muốn)",)
+    lobby.map_name = lobby.rng.choice(FF_MAPS)
+    await ff_announce(app, lobby, f"✈️ Máy bay — Map: {lobby.map_name}\n🪂 30s để nhảy (bấm nút nếu muốn)",)
     # send plane kb once
-    try:
-        await app.bot.send_message(chat_id, "🪂 Nhấn để nhảy", reply_markup=ff_plane_kb(chat_id))
-    except:
-        pass
+    for c in chats:
+        outbox.send(c, "🪂 Nhấn để nhảy", reply_markup=ff_plane_kb(chat_id))
     # simulate plane wait but do not spam: announce only a few milestones
-    await asyncio.sleep(5)
-    await send_group_or_chat(app, chat_id, "✈️ Máy bay — 25s còn lại")
-    await asyncio.sleep(15)
-    await send_group_or_chat(app, chat_id, "✈️ Máy bay — 10s còn lại")
-    await asyncio.sleep(8)
-    await send_group_or_chat(app, chat_id, "✈️ Máy bay — 2s còn lại")
+    await timers.sleep(5)
+    await ff_announce(app, lobby, "✈️ Máy bay — 25s còn lại")
+    await timers.sleep(15)
+    await ff_announce(app, lobby, "✈️ Máy bay — 10s còn lại")
+    await timers.sleep(8)
+    await ff_announce(app, lobby, "✈️ Máy bay — 2s còn lại")
     # auto jump those not jumped
     for p in lobby.players.values():
         if not p.jumped:
             p.jumped = True
-    await send_group_or_chat(app, chat_id, "🪂 Tất cả đã đáp đất — bắt đầu tìm đồ")
+    await ff_announce(app, lobby, "🪂 Tất cả đã đáp đất — bắt đầu tìm đồ")
     # loot
-    for p in lobby.players.values():
-        p.pistol = random.choice(["m500","g18"])
-        if random.random()<0.85:
-            p.guns.append(random.choice(list(["ak47","scar","m14","mp5","mp40"])))
-        await asyncio.sleep(0.05)
-    # announce loot summary batched
+    ff_loot(lobby, lobby.rng)
     lines=["🔎 Loot summary:"]
     for p in lobby.players.values():
         lines.append(f"• @{p.username}: {p.pistol.upper()}" + (f" + {p.guns[0].upper()}" if p.guns else ""))
-    await send_group_or_chat(app, chat_id, "\n".join(lines))
-    # combat phase (auto)
-    await send_group_or_chat(app, chat_id, f"⚔️ Combat bắt đầu — {COMBAT_SECONDS}s")
-    start = datetime.now()
-    end = start + timedelta(seconds=COMBAT_SECONDS)
-    while datetime.now() < end:
-        alive = [pl for pl in lobby.players.values() if pl.alive and not pl.knocked]
-        if len(alive)<=1:
-            break
-        attacker = random.choice(alive)
-        targets = [t for t in lobby.players.values() if t.user_id!=attacker.user_id and t.alive and not t.knocked]
-        if not targets:
-            break
-        target = random.choice(targets)
-        # simulate shot
-        dmg = random.randint(15,60)
-        target.hp -= dmg
-        attacker.kills += 1 if random.random()<0.2 else 0
-        if target.hp<=0 and target.alive:
-            target.alive=False
-            await send_group_or_chat(app, chat_id, f"🔫 @{attacker.username} hạ @{target.username} — {dmg} dmg")
-        await asyncio.sleep(random.uniform(0.5,1.2))
+    for text in chunk_lines(lines):
+        await ff_announce(app, lobby, text)
+    # combat phase (auto); kills are posted as periodic digests
+    await ff_announce(app, lobby, f"⚔️ Combat bắt đầu — {COMBAT_SECONDS}s")
+    engine = FFEngine(lobby, lobby.rng)
+    end = timers.now() + COMBAT_SECONDS
+    next_digest = timers.now() + FF_FEED_INTERVAL
+    ticks = 0  # counted rather than timed, so a replay runs the same ticks
+    while ticks < COMBAT_SECONDS // FF_TICK and not engine.finished():
+        engine.tick()
+        ticks += 1
+        if timers.now() >= next_digest:
+            text = engine.digest()
+            if text:
+                await ff_announce(app, lobby, text)
+            next_digest = timers.now() + FF_FEED_INTERVAL
+        await timers.sleep(FF_TICK)
+    engine.bleed_out()  # nobody revives once combat is over
+    text = engine.digest()
+    if text:
+        await ff_announce(app, lobby, text)
     # determine winner
-    survivors = [pl for pl in lobby.players.values() if pl.alive]
-    if survivors:
+    survivors = [pl for pl in engine.standings() if pl.alive]
+    emit("ff_result", chat_id=chat_id, mode=lobby.mode, players=len(lobby.players), survivors=len(survivors),
+         shots=engine.shots, seconds=COMBAT_SECONDS - max(0, end - timers.now()),
+         kills={p.user_id: p.kills for p in lobby.players.values()})
+    won = {p.user_id for p in survivors if p.team == survivors[0].team} if lobby.mode == "tc" and survivors else {p.user_id for p in survivors[:1]}
+    rows = defaultdict(list)
+    for uid in lobby.players:
+        rows[lobby.origin.get(uid, chat_id)].append((uid, 0, 0))
+    for c, r in rows.items():
+        history.add("ff", c, r, won)
+    rate_ff_match(lobby, won)
+    log_round("ff", chat_id, lobby.rng, ff_outcome(lobby), mode=lobby.mode,
+              players=[[uid, p.team] for uid, p in lobby.players.items()], ticks=ticks)
+    if lobby.mode == "tc" and survivors:
+        team = survivors[0].team
+        names = ", ".join(f"@{p.username}" for p in survivors if p.team == team)
+        await ff_announce(app, lobby, f"🏆 Kết thúc — Đội {team + 1 if team is not None else '?'} thắng: {names}", prio=PRIO_RESULT, mirror=True)
+    elif survivors:
         winner = survivors[0]
-        await send_group_or_chat(app, chat_id, f"🏆 Kết thúc — Người sống sót: @{winner.username}")
+        await ff_announce(app, lobby, f"🏆 Kết thúc — Người sống sót: @{winner.username} ({winner.kills} hạ gục)", prio=PRIO_RESULT, mirror=True)
     else:
-        await send_group_or_chat(app, chat_id, "Hòa. Không còn ai sống sót.")
+        await ff_announce(app, lobby, "Hòa. Không còn ai sống sót.", prio=PRIO_RESULT, mirror=True)
     # cleanup
-    ff_lobbies.pop(chat_id, None)
+    (ff_matches if lobby.origin else ff_lobbies).close(lobby)
 
 # -----------------------
 # --- Callbacks / Routing
 # -----------------------
-async def global_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    if not q: return
-    data = q.data or ""
-    # dispatch for menu
-    if data.startswith("menu_"):
-        return await menu_button(update, context)
-    if data.startswith("tx|"):
-        return await tx_callback(update, context)
-    if data.startswith("baucua|"):
-        return await baucua_callback(update, context)
-    if data.startswith("ff_mode|"):
-        return await ff_mode_callback(update, context)
-    if data.startswith("ff_"):
-        return await ff_lobby_callback(update, context)
-    # fallback
-    await q.answer("Tương tác không xử lý được hoặc đã hết hạn.", show_alert=False)
+class Route:
+    __slots__ = ("name", "handler", "parsers", "calls", "errors", "seconds", "max_seconds")
+
+    def __init__(self, name:str, handler, parsers:tuple):
+        self.name = name
+        self.handler = handler
+        self.parsers = parsers  # one callable per "|"-separated field after the head
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+class CallbackRouter:
+    """callback_data is "<head>|<field>|..."; the head picks the route from one dict
+    and the fields are parsed once into context.args as [head, *fields]."""
+    def __init__(self):
+        self.routes: Dict[str, Route] = {}
+        self.prefixes: List[tuple] = []  # (prefix, Route) for families like "menu_*"
+        self.unmatched = 0
+
+    def add(self, head:str, handler, *parsers):
+        self.routes[head] = Route(head, handler, parsers)
+
+    def add_prefix(self, prefix:str, handler):
+        self.prefixes.append((prefix, Route(prefix + "*", handler, ())))
+
+    def _lookup(self, head:str) -> Optional[Route]:
+        route = self.routes.get(head)
+        if route is None:
+            for prefix, r in self.prefixes:
+                if head.startswith(prefix):
+                    return r
+        return route
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        if not q: return
+        head, *fields = (q.data or "").split("|")
+        route = self._lookup(head)
+        if route is None or len(fields) != len(route.parsers):
+            self.unmatched += 1
+            await q.answer("Tương tác không xử lý được hoặc đã hết hạn.", show_alert=False)
+            return
+        try:
+            context.args = [head] + [parse(v) for parse, v in zip(route.parsers, fields)]
+        except ValueError:
+            route.errors += 1
+            await q.answer("Dữ liệu không hợp lệ.")
+            return
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        try:
+            await route.handler(update, context)
+        except Exception:
+            route.errors += 1
+            raise
+        finally:
+            dt = loop.time() - t0
+            route.calls += 1
+            route.seconds += dt
+            route.max_seconds = max(route.max_seconds, dt)
+            metrics.observe("gamebot_callback_seconds", dt, route=route.name)
+
+callback_router = CallbackRouter()
+callback_router.add_prefix("menu_", menu_button)
+callback_router.add("tx", tx_callback, str, int)
+callback_router.add("baucua", baucua_callback, str, int)
+callback_router.add("ff_mode", ff_mode_callback, str)
+for _action in ("ff_join", "ff_leave", "ff_start"):
+    callback_router.add(_action, ff_lobby_callback, int)
+callback_router.add("ff_queue", ff_queue_callback, str)
+callback_router.add("ff_unqueue", ff_unqueue_callback)
+callback_router.add("ff_rank", ff_rank_callback)
+
+# -----------------------
+# --- HTTP / metrics endpoint
+# -----------------------
+# Minimal HTTP/1.1 (keep-alive, content-length bodies); loadtest.py reuses it.
+async def read_http_request(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n", b"\n", b""):
+            break
+        k, _, v = h.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    n = int(headers.get("content-length") or 0)
+    body = await reader.readexactly(n) if n else b""
+    return method, target, headers, body
+
+def write_http_response(writer: asyncio.StreamWriter, status: int, body: bytes, content_type: str = "application/json"):
+    reason = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 429: "Too Many Requests", 503: "Service Unavailable"}.get(status, "OK")
+    writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n".encode() + body)
+
+def resident_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+metrics.describe("gamebot_command_seconds", "histogram", "Command handler latency.")
+metrics.describe("gamebot_callback_seconds", "histogram", "Callback handler latency per route.")
+metrics.describe("gamebot_callback_errors_total", "counter", "Callback handler errors and malformed data per route.",
+                 lambda: {(("route", r.name),): r.errors for r in [*callback_router.routes.values(), *(r for _, r in callback_router.prefixes)]})
+metrics.describe("gamebot_callback_unmatched_total", "counter", "Callback presses no route handled.", lambda: callback_router.unmatched)
+metrics.describe("gamebot_loop_lag_seconds", "histogram", "Event-loop scheduling delay.")
+metrics.describe("gamebot_persist_flush_seconds", "histogram", "Ledger flush (and snapshot) duration.")
+metrics.describe("gamebot_persist_pending_records", "gauge", "Ledger records not yet flushed.", lambda: len(persist.pending))
+metrics.describe("gamebot_api_calls_total", "counter", "Bot API calls made by the outbox.")
+metrics.describe("gamebot_api_errors_total", "counter", "Bot API calls that failed.")
+metrics.describe("gamebot_outbox_events_total", "counter", "Outbox queue events (enqueued, sent, merged, dropped, retry_after, errors).",
+                 lambda: {(("event", k),): v for k,v in outbox.stats.items()})
+metrics.describe("gamebot_outbox_depth", "gauge", "Queued outbound calls.", outbox.depth)
+metrics.describe("gamebot_active_sessions", "gauge", "Running game sessions.",
+                 lambda: {(("game", r.game),): len(r) for r in SessionRegistry.registries})
+metrics.describe("gamebot_session_bytes", "gauge", "Approximate memory held by live sessions.",
+                 lambda: {(("game", r.game),): r.nbytes() for r in SessionRegistry.registries})
+metrics.describe("gamebot_sessions_evicted_total", "counter", "Stale sessions evicted by the sweep.",
+                 lambda: {(("game", r.game),): r.evicted for r in SessionRegistry.registries})
+metrics.describe("gamebot_process_resident_bytes", "gauge", "Resident set size of this process.", resident_bytes)
+metrics.describe("gamebot_webhook_queue_depth", "gauge", "Webhook updates accepted but not yet processed.",
+                 lambda: webhook.queue.qsize() if webhook else 0)
+metrics.describe("gamebot_webhook_updates_total", "counter", "Webhook updates by outcome (accepted, rejected, processed, errors).",
+                 lambda: {(("outcome", k),): v for k,v in webhook.stats.items()} if webhook else {})
+metrics.describe("gamebot_fanout_total", "counter", "Result mirrors to subscribers (mirrored, delivered, failed, pruned, migrated).",
+                 lambda: {(("event", k),): v for k,v in fanout.stats.items()})
+metrics.describe("gamebot_fanout_subscribers", "gauge", "Chats subscribed to results.", lambda: len(fanout.subs))
+metrics.describe("gamebot_tx_batches_total", "counter", "TX bet batches placed (bets per batch = bets / batches).")
+metrics.describe("gamebot_ff_queue_depth", "gauge", "Players waiting for a cross-chat FF match.",
+                 lambda: {(("mode", m),): len(fq) for m, fq in ff_queues.items()})
+metrics.describe("gamebot_ff_queue_wait_seconds", "histogram", "Time from joining the FF queue to the match starting.")
+metrics.describe("gamebot_ff_matches_total", "counter", "Cross-chat FF matches formed by the queue.",
+                 lambda: {(("mode", m),): fq.matched for m, fq in ff_queues.items()})
+metrics.describe("gamebot_asset_sends_total", "counter", "Image sends by file_id reuse or upload.")
+metrics.describe("gamebot_check_lookups_total", "counter", "/check lookups by where the answer came from.")
+metrics.describe("gamebot_account_held_amount", "gauge", "Stakes reserved by rounds not yet settled.", lambda: accounts.held)
+metrics.describe("gamebot_account_ops_total", "counter", "Account engine operations.",
+                 lambda: {(("op", k),): v for k,v in accounts.stats.items()})
+metrics.describe("gamebot_bets_total", "counter", "Bets placed.")
+metrics.describe("gamebot_bet_amount_total", "counter", "Amount staked.")
+metrics.describe("gamebot_payout_amount_total", "counter", "Amount paid out.")
+
+async def watch_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.observe("gamebot_loop_lag_seconds", max(0.0, loop.time() - t0 - LOOP_LAG_INTERVAL))
+
+async def metrics_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            req = await read_http_request(reader)
+            if req is None:
+                break
+            method, target, _, _ = req
+            if method == "GET" and target.split("?")[0] == "/metrics":
+                write_http_response(writer, 200, metrics.render().encode(), "text/plain; version=0.0.4")
+            else:
+                write_http_response(writer, 404, b"not found", "text/plain")
+            await writer.drain()
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_metrics(host:str, port:int):
+    server = await asyncio.start_server(metrics_conn, host, port)
+    logger.info("Metrics on http://%s:%d/metrics", host, port)
+    async with server:
+        await server.serve_forever()
+
+# -----------------------
+# --- Webhook mode
+# -----------------------
+class WebhookServer:
+    """Telegram POSTs Update JSON here. Updates go into a bounded queue drained by
+    WEBHOOK_WORKERS tasks calling app.process_update; when the queue is full the
+    POST gets 503 and Telegram redelivers it later."""
+    def __init__(self, app: Application, workers:int=WEBHOOK_WORKERS, maxsize:int=WEBHOOK_QUEUE):
+        self.app = app
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.workers = workers
+        self.stats = defaultdict(int)  # accepted / rejected / processed / errors
+        self.accepting = False
+        self._server = None
+        self._tasks: List[asyncio.Task] = []
+        self._conns: Dict[asyncio.StreamWriter, asyncio.Task] = {}  # open connections and their handlers
+
+    async def start(self, host:str, port:int):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._server = await asyncio.start_server(self._conn, host, port)
+        self.accepting = True
+        logger.info("Webhook on http://%s:%d%s (%d workers)", host, port, WEBHOOK_PATH, self.workers)
+
+    def _accept(self, headers:dict, body:bytes) -> int:
+        if WEBHOOK_SECRET and headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return 403
+        if not self.accepting or self.queue.full():
+            self.stats["rejected"] += 1
+            return 503
+        try:
+            update = Update.de_json(json.loads(body), self.app.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400
+        self.queue.put_nowait(update)
+        self.stats["accepted"] += 1
+        return 200
+
+    async def _conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._conns[writer] = asyncio.current_task()
+        try:
+            while True:
+                req = await read_http_request(reader)
+                if req is None:
+                    break
+                method, target, headers, body = req
+                status = self._accept(headers, body) if method == "POST" and target.split("?")[0] == WEBHOOK_PATH else 404
+                write_http_response(writer, status, b"{}" if status == 200 else b"", "application/json")
+                await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._conns.pop(writer, None)
+            writer.close()
+
+    async def _work(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.app.process_update(update)
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.exception("webhook update failed: %s", e)
+            finally:
+                self.queue.task_done()
+
+    async def drain(self, timeout:float=DRAIN_TIMEOUT):
+        """Stop accepting, finish what is queued, then close the connections Telegram
+        keeps alive and stop the workers."""
+        self.accepting = False
+        if self._server is not None:
+            self._server.close()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("webhook: %d updates unprocessed at shutdown", self.queue.qsize())
+        conns = list(self._conns.items())
+        for writer, _ in conns:
+            writer.close()  # an idle handler then reads EOF and returns
+        done, pending = await asyncio.wait([t for _, t in conns], timeout=1) if conns else ((), ())
+        for t in pending:
+            t.cancel()
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, *pending, return_exceptions=True)
+
+webhook: Optional[WebhookServer] = None
+
+async def run_webhook(app: Application):
+    """Serve updates over HTTP until SIGINT/SIGTERM, then drain gracefully."""
+    global webhook
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+    webhook = WebhookServer(app)
+    await webhook.start(WEBHOOK_HOST, WEBHOOK_PORT)
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Draining...")
+        await webhook.drain()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+# -----------------------
+# --- Sharding
+# -----------------------
+# With SHARDS > 1 the main process only receives updates and forwards each to
+# worker process chat_id % SHARDS, so a chat's sessions, timers and outbox live
+# in one worker. Balances, names, leaderboards, FF ratings and result
+# subscribers move to ACCOUNTS_DB (SQLite in
+# WAL mode), where each change is one transaction and stakes are taken with a
+# conditional UPDATE, so a balance stays right whichever worker touches it.
+# The database is seeded from SAVE_FILE/LEDGER_FILE on first use and is the
+# source of truth from then on.
+class SharedAccounts:
+    def __init__(self, path:str=ACCOUNTS_DB):
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS balances (uid INTEGER PRIMARY KEY, v INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS user_names (uid INTEGER PRIMARY KEY, v TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS ff_ratings (uid INTEGER PRIMARY KEY, v INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS subscriptions (chat INTEGER PRIMARY KEY, v TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS board_scores (board TEXT NOT NULL, uid INTEGER NOT NULL, v INTEGER NOT NULL,
+                                                     PRIMARY KEY (board, uid));
+            CREATE INDEX IF NOT EXISTS board_rank ON board_scores (board, v);
+            CREATE INDEX IF NOT EXISTS user_names_key ON user_names (lower(ltrim(v, '@')));
+        """)
+        # account writes go through a second connection owned by one thread (AccountEngine
+        # runs them there), so waiting on another process's write lock never stalls the loop
+        self.wdb = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="accounts")
+        self.balances = SharedBalances(self)
+        self.names = SharedNames(self)
+        self.boards = SharedBoards(self)
+        self.ratings = SharedRatings(self)
+        self.subscriptions = SharedSubscriptions(self)
+        self._day = None
+
+    def is_empty(self) -> bool:
+        return self.db.execute("SELECT NOT EXISTS (SELECT 1 FROM balances)").fetchone()[0] == 1
+
+    def seed(self):
+        """Copy the single-process state (after load_data) into an empty database."""
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.executemany("INSERT INTO balances VALUES (?, ?)", balances.items())
+        self.db.executemany("INSERT INTO user_names VALUES (?, ?)", user_names.items())
+        self.db.executemany("INSERT INTO ff_ratings VALUES (?, ?)", ff_ratings.items())
+        self.db.executemany("INSERT INTO subscriptions VALUES (?, ?)", ((c, ",".join(g)) for c, g in subscriptions.items()))
+        self.db.executemany("INSERT INTO board_scores VALUES ('g', ?, ?)", leaderboard.items())
+        self.db.executemany("INSERT INTO board_scores VALUES (?, ?, ?)",
+                            ((k.rpartition("|")[0], int(k.rpartition("|")[2]), v) for k,v in score_boards.cells.items()))
+        self.db.execute("COMMIT")
+
+    def apply(self, rec: dict):
+        """Same record format as apply_record, applied in one transaction."""
+        chat_id = rec.get("c"); ts = rec.get("ts")
+        keys = ["g"]
+        if ts:
+            keys += period_keys(ts)
+        if chat_id:
+            keys.append(f"c:{chat_id}")
+        rows = rec["b"] if "b" in rec else ((rec["u"], rec.get("d"), rec.get("l")),)
+        db = self.wdb
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("INSERT INTO balances VALUES (?, ?) ON CONFLICT (uid) DO UPDATE SET v = v + excluded.v",
+                           ((uid, d) for uid, d, _ in rows if d))
+            db.executemany("INSERT INTO board_scores VALUES (?, ?, ?) ON CONFLICT (board, uid) DO UPDATE SET v = v + excluded.v",
+                           ((k, uid, l) for uid, _, l in rows if l for k in keys))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        if ts and keys[1] != self._day:
+            self._day = keys[1]
+            self._prune()
+
+    def debit(self, uid:int, amount:int) -> bool:
+        cur = self.wdb.execute("UPDATE balances SET v = v - ? WHERE uid = ? AND v >= ?", (amount, uid, amount))
+        return cur.rowcount == 1
+
+    def debit_many(self, items: List[tuple]) -> List[bool]:
+        db = self.wdb
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            ok = [amount > 0 and db.execute("UPDATE balances SET v = v - ? WHERE uid = ? AND v >= ?", (amount, uid, amount)).rowcount == 1
+                  for uid, amount in items]
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return ok
+
+    def top_up(self, uid:int, target:int) -> int:
+        db = self.wdb
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute("SELECT v FROM balances WHERE uid = ?", (uid,)).fetchone()
+        bal = row[0] if row else 0
+        if bal > 0:
+            db.execute("ROLLBACK")
+            return 0
+        db.execute("INSERT INTO balances VALUES (?, ?) ON CONFLICT (uid) DO UPDATE SET v = excluded.v", (uid, target))
+        db.execute("COMMIT")
+        return target - bal
+
+    def write(self, sql:str, rows: list, pending: Optional[dict]=None, written: Optional[dict]=None) -> asyncio.Future:
+        """Run an upsert/delete on the account thread, so waiting for another process's
+        write lock never stalls the loop. Keys of `written` are dropped from `pending`
+        (the view's not-yet-committed values) once the write lands, if still unchanged."""
+        fut = asyncio.get_running_loop().run_in_executor(self.executor, self._write, sql, rows)
+        fut.add_done_callback(lambda f: self._written(f, pending, written))
+        return fut
+
+    def _write(self, sql:str, rows: list):
+        db = self.wdb
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(sql, rows)
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _written(self, fut: asyncio.Future, pending: Optional[dict], written: Optional[dict]):
+        if not fut.cancelled() and fut.exception() is not None:
+            logger.error("shared write failed: %s", fut.exception())
+        for k, v in (written or {}).items():
+            if k in pending and pending[k] == v:
+                del pending[k]
+
+    def _prune(self):
+        now = clock.now()
+        keep = set()
+        for i in range(BOARD_KEEP_DAYS):
+            keep.update(period_keys((now - timedelta(days=i)).timestamp()))
+        marks = ",".join("?" * len(keep))
+        self.wdb.execute(f"DELETE FROM board_scores WHERE substr(board, 1, 2) IN ('d:', 'w:') AND board NOT IN ({marks})", tuple(keep))
+
+class SharedBalances:
+    """Read view standing in for `balances` in shard workers (writes go through apply/debit).
+    It reads on the account thread's connection, so use it through AccountEngine."""
+    def __init__(self, accounts: SharedAccounts):
+        self.db = accounts.wdb
+
+    def get(self, uid:int, default:int=0) -> int:
+        row = self.db.execute("SELECT v FROM balances WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else default
+
+    def __getitem__(self, uid:int) -> int:
+        return self.get(uid)
+
+class SharedNames:
+    """Stands in for `user_names` in shard workers; writes only when a name changes.
+    A name not cached yet is fetched on the account thread and the caller gets the
+    default meanwhile (names are only ever shown, and callers fall back to the uid)."""
+    def __init__(self, accounts: SharedAccounts):
+        self.accounts = accounts
+        self.db = accounts.db
+        self.cache: Dict[int,str] = {}
+        self.loading = set()  # uids being fetched
+
+    def get(self, uid:int, default=None):
+        name = self.cache.get(uid)
+        if name is None:
+            self._load(uid)
+            return default
+        return name
+
+    def _load(self, uid:int):
+        if uid in self.loading:
+            return
+        self.loading.add(uid)
+        fut = asyncio.get_running_loop().run_in_executor(self.accounts.executor, self._read, uid)
+        fut.add_done_callback(lambda f: self._loaded(uid, f))
+
+    def _read(self, uid:int) -> Optional[str]:
+        row = self.accounts.wdb.execute("SELECT v FROM user_names WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else None
+
+    def _loaded(self, uid:int, fut: asyncio.Future):
+        self.loading.discard(uid)
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        if fut.result() is not None:
+            self.cache.setdefault(uid, fut.result())  # a name set meanwhile is newer
+
+    def __getitem__(self, uid:int) -> str:
+        name = self.get(uid)
+        if name is None:
+            raise KeyError(uid)
+        return name
+
+    def __setitem__(self, uid:int, name:str):
+        if self.cache.get(uid) != name:
+            self.cache[uid] = name
+            self.accounts.write("INSERT INTO user_names VALUES (?, ?) ON CONFLICT (uid) DO UPDATE SET v = excluded.v", [(uid, name)])
+
+    def find(self, name:str) -> Optional[int]:
+        # matches the user_names_key index; Telegram usernames are ASCII, so SQLite's lower() agrees with name_key
+        row = self.db.execute("SELECT uid FROM user_names WHERE lower(ltrim(v, '@')) = ? LIMIT 1", (name_key(name),)).fetchone()
+        return row[0] if row else None
+
+    def items(self):
+        return self.db.execute("SELECT uid, v FROM user_names").fetchall()
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM user_names").fetchone()[0]
+
+class SharedBoards:
+    """Stands in for `score_boards` in shard workers. Scores are added through
+    shared.apply on the account thread; there is no `cells` table to persist,
+    since board_scores is already where they live."""
+    def __init__(self, accounts: SharedAccounts):
+        self.accounts = accounts
+        self.db = accounts.db
+
+    def add(self, uid:int, delta:int, chat_id:Optional[int]=None, ts:Optional[float]=None):
+        return self.add_many([(uid, delta)], chat_id, ts)
+
+    def add_many(self, deltas: List[tuple], chat_id:Optional[int]=None, ts:Optional[float]=None) -> asyncio.Future:
+        rec = {"b": [(uid, 0, d) for uid, d in deltas]}
+        if ts:
+            rec["ts"] = int(ts)
+        if chat_id:
+            rec["c"] = chat_id
+        return asyncio.get_running_loop().run_in_executor(self.accounts.executor, self.accounts.apply, rec)
+
+    def top(self, key:str, n:int=10):
+        return self.db.execute("SELECT uid, v FROM board_scores WHERE board = ? ORDER BY v DESC LIMIT ?", (key, n)).fetchall()
+
+class SharedRatings:
+    """Stands in for `ff_ratings` in shard workers."""
+    def __init__(self, accounts: SharedAccounts):
+        self.accounts = accounts
+        self.db = accounts.db
+        self.pending: Dict[int,int] = {}  # written, not yet committed
+
+    def get(self, uid:int, default=None):
+        if uid in self.pending:
+            return self.pending[uid]
+        row = self.db.execute("SELECT v FROM ff_ratings WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else default
+
+    def update(self, ratings: Dict[int,int]):
+        ratings = dict(ratings)
+        self.pending.update(ratings)
+        self.accounts.write("INSERT INTO ff_ratings VALUES (?, ?) ON CONFLICT (uid) DO UPDATE SET v = excluded.v",
+                            list(ratings.items()), self.pending, ratings)
+
+class SharedSubscriptions:
+    """Stands in for `subscriptions` in shard workers; games are stored comma-separated."""
+    def __init__(self, accounts: SharedAccounts):
+        self.accounts = accounts
+        self.db = accounts.db
+        self.pending: Dict[int, Optional[List[str]]] = {}  # written, not yet committed (None: deleted)
+
+    def get(self, chat_id:int, default=None):
+        if chat_id in self.pending:
+            games = self.pending[chat_id]
+            return default if games is None else games
+        row = self.db.execute("SELECT v FROM subscriptions WHERE chat = ?", (chat_id,)).fetchone()
+        return row[0].split(",") if row else default
+
+    def __contains__(self, chat_id:int) -> bool:
+        return self.get(chat_id) is not None
+
+    def __setitem__(self, chat_id:int, games: List[str]):
+        self.pending[chat_id] = games
+        self.accounts.write("INSERT INTO subscriptions VALUES (?, ?) ON CONFLICT (chat) DO UPDATE SET v = excluded.v",
+                            [(chat_id, ",".join(games))], self.pending, {chat_id: games})
+
+    def pop(self, chat_id:int, default=None):
+        games = self.get(chat_id, default)
+        self.pending[chat_id] = None
+        self.accounts.write("DELETE FROM subscriptions WHERE chat = ?", [(chat_id,)], self.pending, {chat_id: None})
+        return games
+
+    def items(self):
+        subs = {c: v.split(",") for c, v in self.db.execute("SELECT chat, v FROM subscriptions").fetchall()}
+        for c, games in self.pending.items():
+            if games is None:
+                subs.pop(c, None)
+            else:
+                subs[c] = games
+        return list(subs.items())
+
+    def __len__(self) -> int:
+        return len(self.items())
+
+class ShardRouter:
+    """Front-process side: one bounded queue and worker process per shard."""
+    def __init__(self, shards:int):
+        ctx = multiprocessing.get_context("spawn")
+        self.queues = [ctx.Queue(WEBHOOK_QUEUE) for _ in range(shards)]
+        self.procs = [ctx.Process(target=shard_main, args=(i, shards, q), name=f"shard-{i}", daemon=False)
+                      for i, q in enumerate(self.queues)]
+        self.routed = [0] * shards
+
+    def start(self):
+        accounts = SharedAccounts()
+        if accounts.is_empty():
+            load_data()
+            accounts.seed()
+            logger.info("Seeded %s from %s", ACCOUNTS_DB, SAVE_FILE)
+        accounts.db.close()
+        for p in self.procs:
+            p.start()
+
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        i = (chat.id if chat else 0) % len(self.queues)
+        self.routed[i] += 1
+        # blocks while the shard is behind, which backs up polling / the webhook queue
+        await asyncio.get_running_loop().run_in_executor(None, self.queues[i].put, update.to_dict())
+        raise ApplicationHandlerStop
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for p in self.procs:
+            p.join(DRAIN_TIMEOUT + 10)
+            if p.is_alive():
+                logger.warning("%s did not stop, terminating", p.name)
+                p.terminate()
+
+def shard_main(index:int, shards:int, q):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the front process coordinates shutdown
+    asyncio.run(run_shard(index, shards, q))
+
+async def run_shard(index:int, shards:int, q):
+    global shared, balances, user_names, score_boards, ff_ratings, METRICS_PORT
+    shared = SharedAccounts()
+    balances, user_names, score_boards, ff_ratings = shared.balances, shared.names, shared.boards, shared.ratings
+    fanout.subs = shared.subscriptions
+    persist.enabled = False
+    outbox.share = shards
+    history.suffix = f"-s{index}"
+    if METRICS_PORT:
+        METRICS_PORT += index + 1
+    app = build_app()
+    register_handlers(app)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    logger.info("Shard %d/%d up", index + 1, shards)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, lambda: None)  # wait for the front's stop marker instead
+    sem = asyncio.Semaphore(WEBHOOK_WORKERS)
+
+    async def process(data: dict):
+        try:
+            await app.process_update(Update.de_json(data, app.bot))
+        except Exception as e:
+            logger.exception("shard %d: update failed: %s", index, e)
+        finally:
+            sem.release()
+
+    while True:
+        data = await loop.run_in_executor(None, q.get)
+        if data is None:
+            break
+        await sem.acquire()
+        asyncio.create_task(process(data))
+    for _ in range(WEBHOOK_WORKERS):
+        await sem.acquire()  # in-flight updates done
+    await app.post_stop(app)
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
 
 # -----------------------
 # --- Startup / main
 # -----------------------
+def add_command(app: Application, name:str, fn):
+    app.add_handler(CommandHandler(name, metrics.timed("gamebot_command_seconds", fn, command=name)))
+
 def register_handlers(app: Application):
-    app.add_handler(CommandHandler("menu", menu_cmd))
-    app.add_handler(CallbackQueryHandler(global_callback))
+    add_command(app, "menu", menu_cmd)
+    app.add_handler(CallbackQueryHandler(callback_router.dispatch))
     # system
-    app.add_handler(CommandHandler("dangky", dangky_cmd))
-    app.add_handler(CommandHandler("diem", diem_cmd))
-    app.add_handler(CommandHandler("top", top_cmd))
-    app.add_handler(CommandHandler("set", set_cmd))
-    app.add_handler(CommandHandler("check", check_cmd))
-    app.add_handler(CommandHandler("lich", lich_cmd))
-    app.add_handler(CommandHandler("tinhyeu", tinhyeu_cmd))
-    app.add_handler(CommandHandler("info", info_cmd))
+    add_command(app, "dangky", dangky_cmd)
+    add_command(app, "diem", diem_cmd)
+    add_command(app, "top", top_cmd)
+    add_command(app, "lichsu", lichsu_cmd)
+    add_command(app, "lai", lai_cmd)
+    add_command(app, "doanhthu", doanhthu_cmd)
+    add_command(app, "set", set_cmd)
+    add_command(app, "check", check_cmd)
+    add_command(app, "lich", lich_cmd)
+    add_command(app, "tinhyeu", tinhyeu_cmd)
+    add_command(app, "info", info_cmd)
+    add_command(app, "sub", sub_cmd)
+    add_command(app, "unsub", unsub_cmd)
+    add_command(app, "subs", subs_cmd)
     # TX, Xoso, Baucua
-    app.add_handler(CommandHandler("tx", tx_cmd))
-    app.add_handler(CommandHandler("xoso", xoso_cmd))
-    app.add_handler(CommandHandler("chon", chon_cmd))
-    app.add_handler(CommandHandler("baucua", baucua_cmd))
+    add_command(app, "tx", tx_cmd)
+    add_command(app, "xoso", xoso_cmd)
+    add_command(app, "chon", chon_cmd)
+    add_command(app, "baucua", baucua_cmd)
     # Tết
-    app.add_handler(CommandHandler("liixi", liixi_cmd))
-    app.add_handler(CommandHandler("hoamai", hoamai_cmd))
-    app.add_handler(CommandHandler("phao", phao_cmd))
-    app.add_handler(CommandHandler("xongdat", xongdat_cmd))
+    add_command(app, "liixi", liixi_cmd)
+    add_command(app, "hoamai", hoamai_cmd)
+    add_command(app, "phao", phao_cmd)
+    add_command(app, "xongdat", xongdat_cmd)
     # FF
-    app.add_handler(CommandHandler("ff", ff_cmd))
+    add_command(app, "ff", ff_cmd)
     # free text fallback to notify group
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), lambda u,c: None))
 
+# Long-running workers. Started with asyncio.create_task rather than
+# app.create_task: Application.stop() awaits tasks it created, and these never end.
+workers: List[asyncio.Task] = []
+
 async def on_startup(app: Application):
-    logger.info("Starting periodic save task")
-    app.create_task(periodic_save_task())
+    assets.scan()
+    if shared is None:  # shard workers keep accounts in ACCOUNTS_DB and never write SAVE_FILE/LEDGER_FILE
+        logger.info("Starting persistence worker")
+        workers.append(asyncio.create_task(persist.run()))
+    workers.append(asyncio.create_task(history.run()))
+    timers.call_later(SESSION_SWEEP_INTERVAL, sweep_sessions, app)
+    workers.append(asyncio.create_task(outbox.run(app.bot)))
+    workers.append(asyncio.create_task(timers.run()))
+    if METRICS_PORT:
+        workers.append(asyncio.create_task(watch_loop_lag()))
+        workers.append(asyncio.create_task(serve_metrics(METRICS_HOST, METRICS_PORT)))
+
+async def stop_workers():
+    for t in workers:
+        t.cancel()
+    if workers:
+        await asyncio.wait(workers, timeout=5)
+    workers.clear()
+
+async def on_stop(app: Application):
+    """Settle rounds still running so no stake is left open across a restart,
+    and let their results go out while the bot can still send."""
+    for session in list(active_tx.values()):
+        await end_tx_session(app, session)
+    for session in list(active_xoso.values()):
+        await end_xoso_session(app, session)
+    for session in list(active_baucua.values()):
+        await end_baucua_session(app, session)
+    await outbox.drain(DRAIN_TIMEOUT)
+
+async def on_shutdown(app: Application):
+    await stop_workers()
+    if shared is None:
+        await persist.flush(snapshot=True)
+    await history.flush()
+
+def build_app(hooks: bool=True) -> Application:
+    builder = Application.builder().token(BOT_TOKEN)
+    if hooks:
+        builder = builder.post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    return builder.build()
+
+def serve(app: Application):
+    if WEBHOOK_PORT:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
 
 def main():
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN not set in m.env")
+    if SHARDS > 1:
+        router = ShardRouter(SHARDS)
+        router.start()
+        app = build_app(hooks=False)
+        app.add_handler(TypeHandler(Update, router.route), group=-1)
+        logger.info("Bot starting with %d shards...", SHARDS)
+        try:
+            serve(app)
+        finally:
+            router.stop()
+        return
     load_data()
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = build_app()
     register_handlers(app)
-    app.add_handler(CallbackQueryHandler(global_callback))
-    app.post_init(on_startup)
     logger.info("Bot starting...")
-    app.run_polling()
+    serve(app)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+loadtest.py - local fake Telegram Bot API + load generator for ff.py
+- Serves the Bot API methods the bot uses (getMe, getUpdates, sendMessage,
+  editMessageText, answerCallbackQuery, sendPhoto, getChat, ...) on localhost
+- Configurable per-call latency and 429 (flood) injection
+- Spawns `python ff.py` against it and drives synthetic users through
+  /dangky, /tx + tx buttons, /xoso + /chon, /baucua and the FF lobby buttons
+- Reports p50/p95/p99 update-to-reply latency, updates/s, outbound calls/update
+
+    python loadtest.py --users 200 --groups 20 --duration 60
+    python loadtest.py --webhook               # deliver updates by POSTing to the bot's webhook
+    python loadtest.py --serve --port 8081     # fake API only; run ff.py yourself
+
+Reference run (--users 100 --groups 10 --duration 30, API latency 5-30 ms):
+    polling    43.5 updates/s  p50 1787 ms  p95 1994 ms  p99 2037 ms  (updates handled one at a time)
+    --webhook 166.1 updates/s  p50 21.7 ms  p95 34.5 ms  p99 142.7 ms
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+from email.parser import BytesParser
+from urllib.parse import parse_qs, urlsplit
+from collections import Counter, defaultdict, deque
+
+from ff import read_http_request, write_http_response
+
+BOT_ID = 777000
+TOKEN = "123456:LOADTEST"
+
+# --- Bot API request parsing ---
+def parse_params(target: str, headers: dict, body: bytes) -> dict:
+    """Bot API parameters from query string, form, JSON or multipart bodies."""
+    params = {k: v[-1] for k, v in parse_qs(urlsplit(target).query).items()}
+    ctype = headers.get("content-type", "")
+    if ctype.startswith("application/json") and body:
+        params.update(json.loads(body))
+    elif ctype.startswith("application/x-www-form-urlencoded"):
+        params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+    elif ctype.startswith("multipart/form-data"):
+        msg = BytesParser().parsebytes(b"Content-Type: " + ctype.encode() + b"\r\n\r\n" + body)
+        for part in msg.get_payload() if msg.is_multipart() else []:
+            name = part.get_param("name", header="content-disposition")
+            if name and not part.get_filename():
+                params[name] = part.get_payload(decode=True).decode()
+            elif name:
+                params[name] = "<file>"
+    # PTB sends non-string values JSON-encoded
+    for k, v in list(params.items()):
+        if isinstance(v, str) and v[:1] in "{[0123456789-tf":
+            try:
+                params[k] = json.loads(v)
+            except ValueError:
+                pass
+    return params
+
+# --- Fake Bot API ---
+class FakeBotAPI:
+    def __init__(self, latency=(0.0, 0.0), flood_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.updates = deque()
+        self._update_ids = itertools.count(1)
+        self._msg_ids = itertools.count(1)
+        self._new_update = asyncio.Event()
+        self.calls = Counter()
+        self.flooded = Counter()
+        self.listeners = []  # callables (method, params, result)
+        self.webhook = None  # (host, port, path): POST updates there instead of serving getUpdates
+        self.webhook_503 = 0
+        self._idle = []  # keep-alive connections to the webhook
+
+    def push_update(self, update: dict) -> int:
+        update["update_id"] = next(self._update_ids)
+        if self.webhook:
+            asyncio.ensure_future(self.post_update(update))
+        else:
+            self.updates.append(update)
+            self._new_update.set()
+        return update["update_id"]
+
+    async def post_update(self, update: dict):
+        """Deliver like Telegram does: POST the JSON, redeliver after a pause on non-200."""
+        host, port, path = self.webhook
+        body = json.dumps(update).encode()
+        while True:
+            reader, writer = self._idle.pop() if self._idle else await asyncio.open_connection(host, port)
+            writer.write(f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            n = 0
+            while True:
+                h = await reader.readline()
+                if h in (b"\r\n", b""):
+                    break
+                if h.lower().startswith(b"content-length:"):
+                    n = int(h.split(b":")[1])
+            await reader.readexactly(n)
+            self._idle.append((reader, writer))
+            if status == 200:
+                return
+            self.webhook_503 += status == 503
+            await asyncio.sleep(1)
+
+    def next_message_id(self) -> int:
+        return next(self._msg_ids)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                req = await read_http_request(reader)
+                if req is None:
+                    break
+                method_name, target, headers, body = req
+                path = urlsplit(target).path
+                api_method = path.rsplit("/", 1)[-1]
+                try:
+                    params = parse_params(target, headers, body)
+                    status, payload = await self.call(api_method, params)
+                except Exception as e:
+                    status, payload = 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+                write_http_response(writer, status, json.dumps(payload).encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def call(self, method: str, params: dict):
+        self.calls[method] += 1
+        if method != "getUpdates":
+            lo, hi = self.latency
+            if hi:
+                await asyncio.sleep(random.uniform(lo, hi))
+            if self.flood_rate and method in ("sendMessage", "editMessageText", "sendPhoto") and random.random() < self.flood_rate:
+                self.flooded[method] += 1
+                return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                             "parameters": {"retry_after": self.retry_after}}
+        handler = getattr(self, "m_" + method, None)
+        result = await handler(params) if handler else True
+        for fn in self.listeners:
+            fn(method, params, result)
+        return 200, {"ok": True, "result": result}
+
+    async def m_getMe(self, p):
+        return {"id": BOT_ID, "is_bot": True, "first_name": "LoadBot", "username": "load_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    async def m_getUpdates(self, p):
+        offset = int(p.get("offset") or 0)
+        timeout = float(p.get("timeout") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()  # confirmed by the bot
+        if not self.updates and timeout:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(p.get("limit") or 100)
+        return list(itertools.islice(self.updates, limit))
+
+    def _message(self, p, **extra):
+        chat_id = int(p["chat_id"])
+        return {"message_id": self.next_message_id(), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private", "title": f"g{chat_id}"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "LoadBot"},
+                "text": p.get("text", ""), **extra}
+
+    async def m_sendMessage(self, p):
+        extra = {"reply_markup": p["reply_markup"]} if isinstance(p.get("reply_markup"), dict) else {}
+        return self._message(p, **extra)
+
+    async def m_sendPhoto(self, p):
+        fid = f"photo{self.next_message_id()}"
+        return self._message(p, photo=[{"file_id": fid, "file_unique_id": fid, "width": 512, "height": 512}])
+
+    async def m_editMessageText(self, p):
+        msg = self._message(p)
+        msg["message_id"] = int(p.get("message_id") or 0)
+        return msg
+
+    async def m_getChat(self, p):
+        cid = p.get("chat_id")
+        if isinstance(cid, str) and cid.startswith("@"):
+            raise ValueError("chat not found")
+        cid = int(cid)
+        return {"id": cid, "type": "group" if cid < 0 else "private", "title": f"g{cid}"}
+
+    async def m_answerCallbackQuery(self, p):
+        return True
+
+    async def m_deleteWebhook(self, p):
+        return True
+
+    async def m_getWebhookInfo(self, p):
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+
+# --- Load generator ---
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+class LoadGen:
+    """Synthetic users sending commands and pressing the buttons the bot returns."""
+    SCENARIOS = [("tx", 5), ("xoso", 1), ("baucua", 2), ("ff", 1), ("diem", 1)]
+
+    def __init__(self, api: FakeBotAPI, users: int, groups: int, think: float, reply_timeout: float):
+        self.api = api
+        self.users = [{"id": 10_000 + i, "is_bot": False, "first_name": f"U{i}", "username": f"user{i}"} for i in range(users)]
+        self.groups = [-(100_000 + g) for g in range(groups)]
+        self.think = think
+        self.reply_timeout = reply_timeout
+        self.waiting_cmd = {}  # (chat_id, message_id) -> (future, kind, t0)
+        self.waiting_cb = {}  # callback_query id -> (future, kind, t0)
+        self.latency = defaultdict(list)
+        self.timeouts = Counter()
+        self.updates_sent = 0
+        self.outbound_total = 0
+        self._cb_ids = itertools.count(1)
+        api.listeners.append(self.on_call)
+
+    def on_call(self, method, p, result):
+        if method == "getUpdates":
+            return
+        self.outbound_total += 1
+        if method == "answerCallbackQuery":
+            w = self.waiting_cb.pop(str(p.get("callback_query_id")), None)
+            if w and not w[0].done():
+                w[0].set_result(None)
+            return
+        if method != "sendMessage" or not isinstance(result, dict):
+            return
+        reply_to = p.get("reply_to_message_id") or (p.get("reply_parameters") or {}).get("message_id")
+        if reply_to is not None:
+            w = self.waiting_cmd.pop((int(p["chat_id"]), int(reply_to)), None)
+            if w and not w[0].done():
+                w[0].set_result(result)
+
+    def _done(self, fut, kind, t0):
+        if fut.done():
+            self.latency[kind].append(time.perf_counter() - t0)
+        else:
+            self.timeouts[kind] += 1
+
+    async def command(self, user, chat_id, text, kind):
+        msg_id = self.api.next_message_id()
+        cmd = text.split()[0]
+        fut = asyncio.get_running_loop().create_future()
+        t0 = time.perf_counter()
+        self.waiting_cmd[(chat_id, msg_id)] = (fut, kind, t0)
+        self.api.push_update({"message": {
+            "message_id": msg_id, "date": int(time.time()), "from": user, "text": text,
+            "chat": {"id": chat_id, "type": "group", "title": f"g{chat_id}"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(cmd)}]}})
+        self.updates_sent += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), self.reply_timeout)
+        except asyncio.TimeoutError:
+            self.waiting_cmd.pop((chat_id, msg_id), None)
+            return None
+        finally:
+            self._done(fut, kind, t0)
+
+    async def press(self, user, message, data, kind):
+        qid = str(next(self._cb_ids))
+        fut = asyncio.get_running_loop().create_future()
+        t0 = time.perf_counter()
+        self.waiting_cb[qid] = (fut, kind, t0)
+        self.api.push_update({"callback_query": {"id": qid, "from": user, "chat_instance": "load",
+                                                 "data": data, "message": message}})
+        self.updates_sent += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), self.reply_timeout)
+        except asyncio.TimeoutError:
+            self.waiting_cb.pop(qid, None)
+        finally:
+            self._done(fut, kind, t0)
+
+    @staticmethod
+    def buttons(message):
+        kb = (message or {}).get("reply_markup") or {}
+        return [b["callback_data"] for row in kb.get("inline_keyboard", []) for b in row if b.get("callback_data")]
+
+    async def user_loop(self, user, deadline):
+        chat_id = random.choice(self.groups)
+        await self.command(user, chat_id, "/dangky", "dangky")
+        names, weights = zip(*self.SCENARIOS)
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(random.expovariate(1 / self.think) if self.think else 0)
+            kind = random.choices(names, weights)[0]
+            if kind == "tx":
+                reply = await self.command(user, chat_id, f"/tx {random.choice(['1k', '5k', '10k'])}", "tx_cmd")
+                opts = self.buttons(reply)
+                if opts:
+                    await self.press(user, reply, random.choice(opts), "tx_cb")
+            elif kind == "xoso":
+                await self.command(user, chat_id, "/xoso", "xoso_cmd")
+                nums = ",".join(str(n) for n in random.sample(range(1, 21), random.randint(1, 5)))
+                await self.command(user, chat_id, f"/chon {nums} 1k", "chon_cmd")
+            elif kind == "baucua":
+                reply = await self.command(user, chat_id, "/baucua", "baucua_cmd")
+                opts = self.buttons(reply)
+                if opts:
+                    await self.press(user, reply, random.choice(opts), "baucua_cb")
+            elif kind == "ff":
+                reply = await self.command(user, chat_id, "/ff", "ff_cmd")
+                modes = [d for d in self.buttons(reply) if d.startswith("ff_mode|")]
+                if modes:
+                    await self.press(user, reply, random.choice(modes), "ff_mode_cb")
+                    lobby_msg = dict(reply, reply_markup={"inline_keyboard": [[{"text": "join", "callback_data": f"ff_join|{chat_id}"}]]})
+                    await self.press(user, lobby_msg, f"ff_join|{chat_id}", "ff_join_cb")
+            else:
+                await self.command(user, chat_id, "/diem", "diem_cmd")
+
+    def report(self, wall: float, api: FakeBotAPI):
+        every = [v for vs in self.latency.values() for v in vs]
+        print(f"updates sent={self.updates_sent} answered={len(every)} in {wall:.1f}s "
+              f"-> {len(every) / max(wall, 1e-9):.1f} updates/s")
+        print(f"outbound calls={self.outbound_total} ({self.outbound_total / max(self.updates_sent, 1):.2f}/update) "
+              f"429 injected={sum(api.flooded.values())} webhook 503s={api.webhook_503}")
+        print(f"{'route':<12}{'n':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'timeouts':>10}")
+        for kind in sorted(set(self.latency) | set(self.timeouts)):
+            vs = self.latency[kind]
+            print(f"{kind:<12}{len(vs):>7}{percentile(vs, 50) * 1000:>9.1f}{percentile(vs, 95) * 1000:>9.1f}"
+                  f"{percentile(vs, 99) * 1000:>9.1f}{self.timeouts[kind]:>10}")
+        print(f"{'all':<12}{len(every):>7}{percentile(every, 50) * 1000:>9.1f}{percentile(every, 95) * 1000:>9.1f}"
+              f"{percentile(every, 99) * 1000:>9.1f}{sum(self.timeouts.values()):>10}")
+        print(f"api calls {dict(api.calls)}")
+
+async def bot_ready(api: FakeBotAPI, args) -> bool:
+    if not args.webhook:
+        return bool(api.calls["getUpdates"])
+    try:
+        _, writer = await asyncio.open_connection("127.0.0.1", args.webhook_port)
+    except OSError:
+        return False
+    writer.close()
+    return True
+
+async def run(args):
+    api = FakeBotAPI((args.latency_min / 1000, args.latency_max / 1000), args.flood_rate, args.retry_after)
+    server = await asyncio.start_server(api.handle, "127.0.0.1", args.port)
+    port = server.sockets[0].getsockname()[1]
+    base_url = f"http://127.0.0.1:{port}/bot"
+    print(f"fake Bot API on {base_url}")
+    if args.serve:
+        async with server:
+            await server.serve_forever()
+        return
+    workdir = tempfile.mkdtemp(prefix="ff-load-")
+    env = dict(os.environ, BOT_TOKEN=TOKEN, BOT_API_URL=base_url, GROUP_ID="0")
+    if args.webhook:
+        env.update(WEBHOOK_PORT=str(args.webhook_port), WEBHOOK_HOST="127.0.0.1", WEBHOOK_PATH="/telegram")
+        env.pop("WEBHOOK_URL", None)
+        env.pop("WEBHOOK_SECRET", None)
+    bot = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(args.bot), cwd=workdir, env=env,
+                                               stdout=asyncio.subprocess.DEVNULL if not args.bot_log else None,
+                                               stderr=asyncio.subprocess.DEVNULL if not args.bot_log else None)
+    try:
+        while not await bot_ready(api, args):
+            if bot.returncode is not None:
+                raise RuntimeError(f"bot exited with code {bot.returncode}")
+            await asyncio.sleep(0.1)
+        if args.webhook:
+            api.webhook = ("127.0.0.1", args.webhook_port, "/telegram")
+        gen = LoadGen(api, args.users, args.groups, args.think, args.reply_timeout)
+        t0 = time.perf_counter()
+        deadline = t0 + args.duration
+        await asyncio.gather(*(gen.user_loop(u, deadline) for u in gen.users))
+        gen.report(time.perf_counter() - t0, api)
+    finally:
+        bot.terminate()
+        await bot.wait()
+        server.close()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Fake Bot API + load generator for ff.py")
+    ap.add_argument("--bot", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ff.py"))
+    ap.add_argument("--port", type=int, default=0)
+    ap.add_argument("--serve", action="store_true", help="only run the fake API")
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--groups", type=int, default=5)
+    ap.add_argument("--duration", type=float, default=30)
+    ap.add_argument("--think", type=float, default=1.0, help="mean seconds between a user's actions")
+    ap.add_argument("--reply-timeout", type=float, default=10)
+    ap.add_argument("--latency-min", type=float, default=5, help="ms")
+    ap.add_argument("--latency-max", type=float, default=30, help="ms")
+    ap.add_argument("--flood-rate", type=float, default=0.0, help="fraction of sends answered with 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--bot-log", action="store_true", help="show the bot's output")
+    ap.add_argument("--webhook", action="store_true", help="run the bot in webhook mode and POST updates to it")
+    ap.add_argument("--webhook-port", type=int, default=8443)
+    asyncio.run(run(ap.parse_args(argv)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+sim.py - headless simulation of the ff.py games on a virtual clock.
+- Runs TX, Xổ số, Bầu Cua and Free Fire flows with no Telegram connection
+- asyncio sleeps/timers jump straight to the next deadline (no wall time spent)
+- Prints throughput and outcome distributions; --events dumps structured events
+- --seed makes every round's RNG stream deterministic; `replay` re-runs logged rounds
+
+    python sim.py tx -n 1000 --chats 20 --players 30
+    python sim.py xoso -n 200 --players 500
+    python sim.py baucua -n 500 --chats 10
+    python sim.py ff -n 50 --players 100 --mode st
+    python sim.py ffqueue -n 200 --chats 50 --players 3   (cross-chat matchmaking)
+    python sim.py replay history/20250101.rounds.jsonl   (or an --events file)
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import itertools
+from types import SimpleNamespace
+from collections import Counter, defaultdict
+
+import ff
+
+# --- Virtual clock ---
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop whose clock jumps to the next scheduled callback whenever
+    nothing is ready to run, so sleeps and timers cost no wall time."""
+    def __init__(self):
+        super().__init__()
+        self._virtual = 0.0
+
+    def time(self):
+        return self._virtual
+
+    def _run_once(self):
+        if not self._ready and self._scheduled:
+            self._virtual = max(self._virtual, self._scheduled[0]._when)
+        super()._run_once()
+
+class SimClock(ff.Clock):
+    """Wall clock that advances with the virtual loop time."""
+    def __init__(self, loop: asyncio.AbstractEventLoop, start: float):
+        self.loop = loop
+        self.start = start
+
+    def time(self) -> float:
+        return self.start + self.loop.time()
+
+# --- Bot API stand-in ---
+class SimBot:
+    """Accepts the Bot API calls the games make and only counts them."""
+    def __init__(self):
+        self.calls = Counter()
+        self._ids = itertools.count(1)
+
+    def _msg(self, chat_id):
+        return SimpleNamespace(message_id=next(self._ids), chat_id=chat_id, photo=[SimpleNamespace(file_id="sim")])
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        self.calls["send_message"] += 1
+        return self._msg(chat_id)
+
+    async def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        self.calls["edit_message_text"] += 1
+        return True
+
+    async def send_photo(self, chat_id, photo=None, **kwargs):
+        self.calls["send_photo"] += 1
+        return self._msg(chat_id)
+
+    async def get_chat(self, chat_id):
+        self.calls["get_chat"] += 1
+        return SimpleNamespace(id=chat_id)
+
+# --- Scenarios ---
+STAKES = [1_000, 10_000, 50_000, 100_000]
+
+def fund(uids):
+    for uid in uids:
+        ff.user_names[uid] = f"sim{uid}"
+        ff.apply_delta(uid, 10**12, "reg")
+
+async def tx_chat(app, chat_id: int, rounds: int, players: int, rng: random.Random):
+    uids = [chat_id * -1000 + i for i in range(players)]
+    fund(uids)
+    for _ in range(rounds):
+        async def bet(uid):
+            await ff.timers.sleep(rng.uniform(0, ff.AUTO_CLOSE_AFTER_LAST_BET))
+            await ff.place_tx_bet(app, chat_id, uid, ff.user_names[uid], rng.choice("tx"), rng.choice(STAKES))
+        await ff.place_tx_bet(app, chat_id, uids[0], ff.user_names[uids[0]], rng.choice("tx"), rng.choice(STAKES))
+        await asyncio.gather(*(bet(uid) for uid in uids[1:]))
+        while chat_id in ff.active_tx:
+            await ff.timers.sleep(1)
+
+async def xoso_chat(app, chat_id: int, rounds: int, players: int, rng: random.Random):
+    uids = [chat_id * -1000 + i for i in range(players)]
+    fund(uids)
+    for _ in range(rounds):
+        session = ff.open_xoso_session(app, chat_id, 0)
+        for uid in uids:
+            nums = rng.sample(range(ff.XOSO_MIN, ff.XOSO_MAX + 1), rng.randint(1, ff.XOSO_MAX_CHOICES))
+            await ff.xoso_pick(session, uid, nums, rng.choice(STAKES))
+        while chat_id in ff.active_xoso:
+            await ff.timers.sleep(1)
+
+async def baucua_chat(app, chat_id: int, rounds: int, players: int, rng: random.Random):
+    uids = [chat_id * -1000 + i for i in range(players)]
+    fund(uids)
+    for _ in range(rounds):
+        async def bet(uid):
+            await ff.timers.sleep(rng.uniform(0, ff.BAUCUA_SECONDS - 1))
+            await ff.place_baucua_bet(app, chat_id, uid, rng.choice(ff.BAU_CUA_KEYS), rng.choice(STAKES))
+        await ff.place_baucua_bet(app, chat_id, uids[0], rng.choice(ff.BAU_CUA_KEYS), rng.choice(STAKES))
+        await asyncio.gather(*(bet(uid) for uid in uids[1:]))
+        while chat_id in ff.active_baucua:
+            await ff.timers.sleep(1)
+
+async def ff_chat(app, chat_id: int, rounds: int, players: int, rng: random.Random, mode: str):
+    for _ in range(rounds):
+        lobby = ff.FFLobby(chat_id, mode)
+        for i in range(players):
+            p = ff.FFPlayer(chat_id * -1000 + i, f"sim{i}")
+            p.team = i % 2 if mode == "tc" else None
+            lobby.players[p.user_id] = p
+        lobby.started = True
+        ff.ff_lobbies.open(lobby)
+        await ff.ff_matchmaking(app, lobby)
+
+async def ffqueue_chat(app, chat_id: int, rounds: int, players: int, rng: random.Random, mode: str):
+    """Players of one chat drift into the cross-chat queue; waits until all have played."""
+    uids = [chat_id * -1000 + i for i in range(players)]
+    fund(uids)
+    for _ in range(rounds):
+        async def join(uid):
+            await ff.timers.sleep(rng.uniform(0, ff.MATCHMAKING_MAX_WAIT))
+            ff.ff_ratings.setdefault(uid, int(rng.gauss(ff.FF_RATING_START, 300)))
+            ff.ff_enqueue(app, mode, uid, ff.user_names[uid], chat_id)
+        await asyncio.gather(*(join(uid) for uid in uids))
+        while any(uid in ff.ff_queues[mode] for uid in uids) or ff.ff_matches:
+            await ff.timers.sleep(1)
+
+def summarize(game: str, events: list, bot: SimBot, rounds: int, wall: float, virtual: float):
+    print(f"game={game} rounds={rounds} wall={wall:.2f}s virtual={virtual:.0f}s "
+          f"speedup={virtual / max(wall, 1e-9):.0f}x throughput={rounds / max(wall, 1e-9):.1f} rounds/s")
+    calls = sum(bot.calls.values())
+    print(f"bot calls={calls} ({calls / max(rounds, 1):.1f}/round) {dict(bot.calls)}")
+    if game == "tx":
+        res = [e for k, e in events if k == "tx_result"]
+        staked = sum(e["staked"] for e in res); paid = sum(e["paid"] for e in res)
+        print(f"results {dict(Counter(e['result'] for e in res))}  bets={sum(e['bets'] for e in res)}")
+        print(f"staked={ff.fmt_amount(staked)} paid={ff.fmt_amount(paid)} house edge={(staked - paid) / max(staked, 1):.2%}")
+    elif game == "xoso":
+        res = [e for k, e in events if k == "xoso_result"]
+        print(f"numbers drawn per round {dict(sorted(Counter(len(e['results']) for e in res).items()))}")
+        print(f"hits per round mean={sum(e['hits'] for e in res) / max(len(res), 1):.1f} "
+              f"distribution={dict(sorted(Counter(e['hits'] for e in res).items()))}")
+        staked = sum(e["staked"] for e in res); paid = sum(e["paid"] for e in res)
+        print(f"staked={ff.fmt_amount(staked)} paid={ff.fmt_amount(paid)} house edge={(staked - paid) / max(staked, 1):.2%}")
+    elif game == "baucua":
+        res = [e for k, e in events if k == "baucua_result"]
+        staked = sum(e["staked"] for e in res); paid = sum(e["paid"] for e in res)
+        print(f"animals rolled {dict(Counter(a for e in res for a in e['dice']))}  bets={sum(e['bets'] for e in res)}")
+        print(f"staked={ff.fmt_amount(staked)} paid={ff.fmt_amount(paid)} house edge={(staked - paid) / max(staked, 1):.2%}")
+    elif game in ("ff", "ffqueue"):
+        res = [e for k, e in events if k == "ff_result"]
+        if game == "ffqueue":
+            print(f"matches={len(res)} players per match={dict(sorted(Counter(e['players'] for e in res).items()))}")
+        kills = Counter(max(e["kills"].values(), default=0) for e in res)
+        print(f"match seconds mean={sum(e['seconds'] for e in res) / max(len(res), 1):.1f} "
+              f"survivors={dict(sorted(Counter(e['survivors'] for e in res).items()))}")
+        print(f"shots mean={sum(e['shots'] for e in res) / max(len(res), 1):.0f} top fragger kills={dict(sorted(kills.items()))}")
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    ff.clock = SimClock(loop, time.time())
+    ff.persist.enabled = False
+    ff.history.enabled = False
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    ff.rngs.reseed(args.seed)
+    events = []
+    ff.event_listeners.append(lambda kind, data: events.append((kind, data)))
+    bot = SimBot()
+    app = SimpleNamespace(bot=bot)
+    asyncio.create_task(ff.timers.run())
+    asyncio.create_task(ff.outbox.run(bot))
+    per_chat = [args.n // args.chats + (1 if i < args.n % args.chats else 0) for i in range(args.chats)]
+    wall0 = time.perf_counter(); v0 = loop.time()
+    jobs = []
+    for i, rounds in enumerate(per_chat):
+        chat_id = -(1000 + i)
+        if args.game == "tx":
+            jobs.append(tx_chat(app, chat_id, rounds, args.players, rng))
+        elif args.game == "xoso":
+            jobs.append(xoso_chat(app, chat_id, rounds, args.players, rng))
+        elif args.game == "baucua":
+            jobs.append(baucua_chat(app, chat_id, rounds, args.players, rng))
+        elif args.game == "ffqueue":
+            jobs.append(ffqueue_chat(app, chat_id, rounds, args.players, rng, args.mode))
+        else:
+            jobs.append(ff_chat(app, chat_id, rounds, args.players, rng, args.mode))
+    await asyncio.gather(*jobs)
+    await ff.outbox.drain()  # let queued results go out (virtual time)
+    wall = time.perf_counter() - wall0; virtual = loop.time() - v0
+    pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    for t in pending:
+        t.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    summarize(args.game, events, bot, args.n, wall, virtual)
+    if args.events:
+        with open(args.events, "w", encoding="utf-8") as f:
+            for kind, data in events:
+                f.write(json.dumps({"kind": kind, **data}, ensure_ascii=False, default=str) + "\n")
+
+def replay(path: str):
+    """Re-run every logged round from its seed and compare with the logged outcome."""
+    checked = mismatched = 0
+    t0 = time.perf_counter()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec.get("kind", "round") != "round":
+                continue
+            outcome, draws = ff.replay_round(rec)
+            checked += 1
+            if outcome != rec["outcome"] or draws != rec["draws"]:
+                mismatched += 1
+                print(f"MISMATCH {rec['game']} chat={rec['chat']} ts={rec['ts']} seed={rec['seed']}: "
+                      f"logged {rec['outcome']} ({rec['draws']} draws), replayed {outcome} ({draws} draws)")
+    wall = time.perf_counter() - t0
+    print(f"replayed {checked} rounds in {wall:.2f}s ({checked / max(wall, 1e-9):.0f} rounds/s), {mismatched} mismatched")
+    return 1 if mismatched else 0
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Headless game simulation on a virtual clock")
+    ap.add_argument("game", choices=["tx", "xoso", "baucua", "ff", "ffqueue", "replay"])
+    ap.add_argument("log", nargs="?", help="round log or --events file to replay")
+    ap.add_argument("-n", type=int, default=100, help="rounds/matches to simulate")
+    ap.add_argument("--chats", type=int, default=1, help="chats running in parallel")
+    ap.add_argument("--players", type=int, default=20, help="players per round")
+    ap.add_argument("--mode", choices=["st", "tc"], default="st", help="Free Fire mode")
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--events", help="write structured events (JSON lines) here")
+    args = ap.parse_args(argv)
+    if args.game == "replay":
+        if not args.log:
+            ap.error("replay needs a round log")
+        sys.exit(replay(args.log))
+    args.chats = max(1, min(args.chats, args.n))
+    logging.getLogger("gamebot").setLevel(logging.WARNING)
+    loop = VirtualTimeLoop()
+    try:
+        loop.run_until_complete(run(args))
+    finally:
+        loop.close()
+
+if __name__ == "__main__":
+    main()
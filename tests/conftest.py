@@ -0,0 +1,87 @@
+import os
+import sys
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ff  # noqa: E402
+
+
+def reset_stores():
+    """Empty the in-memory stores in place (PERSIST_TABLES holds references to them)."""
+    ff.balances.clear()
+    ff.user_names.clear()
+    ff.user_names.by_name.clear()
+    ff.leaderboard.clear()
+    ff.score_boards.boards = {"g": ff.TopBoard(ff.leaderboard)}
+    ff.ff_ratings.clear()
+    ff.subscriptions.clear()
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    """Fresh stores, persistence and account engine, with every file under tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ff, "SAVE_FILE", str(tmp_path / "game_data.json"))
+    monkeypatch.setattr(ff, "LEDGER_FILE", str(tmp_path / "game_ledger.jsonl"))
+    monkeypatch.setattr(ff, "persist", ff.Persistence())
+    monkeypatch.setattr(ff, "accounts", ff.AccountEngine())
+    monkeypatch.setattr(ff.history, "enabled", False)
+    reset_stores()
+    yield ff
+    reset_stores()
+
+
+class FakeBot:
+    """Bot API stand-in that records calls; sends take `delay` seconds."""
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self._ids = iter(range(1, 10**9))
+
+    async def _call(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return SimpleNamespace(message_id=next(self._ids), chat_id=kwargs.get("chat_id"))
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        return await self._call("send_message", chat_id=chat_id, text=text, **kwargs)
+
+    async def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        return await self._call("edit_message_text", chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+
+    async def send_photo(self, chat_id, photo=None, **kwargs):
+        return await self._call("send_photo", chat_id=chat_id, **kwargs)
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+@pytest.fixture
+def app(bot):
+    return SimpleNamespace(bot=bot)
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    """A fresh ff.outbox; a test runs it with asyncio.create_task(outbox.run(bot))."""
+    ob = ff.Outbox()
+    monkeypatch.setattr(ff, "outbox", ob)
+    return ob
+
+
+@pytest.fixture(autouse=True)
+def clean_sessions():
+    yield
+    for r in ff.SessionRegistry.registries:
+        for s in r.values():
+            r.close(s)
+        r.retired.clear()
+    ff.SessionRegistry.chats.clear()
+    ff.timers._heap.clear()
@@ -0,0 +1,64 @@
+import asyncio
+
+from conftest import reset_stores
+
+
+def test_concurrent_reserves_never_overdraw(state):
+    ff = state
+    ff.apply_delta(1, 100_000, "reg")
+
+    async def run():
+        singles = [ff.accounts.reserve(1, 30_000, "bet") for _ in range(3)]
+        batch = ff.accounts.reserve_many([(1, 30_000), (1, 30_000)], "bet")
+        return await asyncio.gather(*singles, batch)
+
+    *singles, batch = asyncio.run(run())
+    assert sum(singles) + sum(batch) == 3  # 90k of 100k
+    assert ff.balances[1] == 10_000 and ff.accounts.held == 90_000
+    assert ff.accounts.stats["rejected"] == 2
+
+
+def test_settle_and_refund_release_what_was_held(state):
+    ff = state
+    for uid in (1, 2, 3):
+        ff.apply_delta(uid, 50_000, "reg")
+
+    async def run():
+        await ff.accounts.reserve_many([(1, 10_000), (2, 20_000)], "bet")
+        await ff.accounts.settle(30_000, [(1, 20_000, 10_000), (2, 0, -20_000)], "payout", -100)
+        await ff.accounts.reserve(3, 5_000, "bet")
+        await ff.accounts.refund_round([(3, 5_000)], -100)
+
+    asyncio.run(run())
+    assert ff.accounts.held == 0
+    assert (ff.balances[1], ff.balances[2], ff.balances[3]) == (60_000, 30_000, 50_000)
+    assert ff.leaderboard[1] == 10_000 and ff.leaderboard[2] == -20_000
+
+
+def test_register_only_tops_up_an_empty_balance(state):
+    ff = state
+
+    async def run():
+        return await asyncio.gather(*(ff.accounts.register(1) for _ in range(3)))
+
+    assert sorted(asyncio.run(run())) == [0, 0, ff.REGISTER_AMOUNT]
+    assert ff.balances[1] == ff.REGISTER_AMOUNT
+
+
+def test_settled_round_replays_from_the_ledger(state):
+    ff = state
+    ff.load_data()
+    for uid in (1, 2):
+        ff.apply_delta(uid, 50_000, "reg")
+
+    async def run():
+        await ff.accounts.reserve_many([(1, 10_000), (2, 20_000)], "bet")
+        await ff.accounts.settle(30_000, [(1, 20_000, 10_000), (2, 0, -20_000)], "payout", -100)
+        await ff.persist.flush()
+
+    asyncio.run(run())
+    expected = dict(ff.balances), dict(ff.leaderboard)
+    reset_stores()
+    ff.persist.seq = 0
+    ff.load_data()
+    assert (dict(ff.balances), dict(ff.leaderboard)) == expected
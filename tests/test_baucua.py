@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+
+def fund(ff, *uids, amount=1_000_000):
+    for uid in uids:
+        ff.apply_delta(uid, amount, "reg")
+
+
+def test_concurrent_first_bets_share_one_round(state, app, bot, outbox):
+    ff = state
+    fund(ff, 1, 2, 3)
+    bot.delay = 0.01
+
+    async def run():
+        task = asyncio.create_task(outbox.run(bot))
+        sessions = await asyncio.gather(*(ff.place_baucua_bet(app, -100, uid, ff.BAU_CUA_KEYS[0], 10_000) for uid in (1, 2, 3)))
+        task.cancel()
+        return sessions
+
+    sessions = asyncio.run(run())
+    assert len({id(s) for s in sessions}) == 1
+    session = sessions[0]
+    assert ff.active_baucua.get(-100) is session and not ff.active_baucua.retired
+    assert [m for m, _ in bot.calls] == ["send_message"]
+    assert session.message_id is not None
+    assert session.staked == 30_000 and len(session.by_user) == 3
+
+
+def test_failed_board_send_refunds_the_round(state, app, bot, outbox):
+    ff = state
+    fund(ff, 1, 2)
+
+    async def boom(*a, **k):
+        await asyncio.sleep(0.01)
+        raise RuntimeError("network")
+    bot.send_message = boom
+
+    async def run():
+        task = asyncio.create_task(outbox.run(bot))
+        results = await asyncio.gather(ff.place_baucua_bet(app, -100, 1, ff.BAU_CUA_KEYS[0], 10_000),
+                                       ff.place_baucua_bet(app, -100, 2, ff.BAU_CUA_KEYS[1], 20_000), return_exceptions=True)
+        task.cancel()
+        return results
+
+    results = asyncio.run(run())
+    assert isinstance(results[0], RuntimeError)
+    assert -100 not in ff.active_baucua
+    assert ff.balances[1] == ff.balances[2] == 1_000_000
+    assert ff.accounts.held == 0
+
+
+def test_settlement_pays_per_animal(state, app, bot, outbox):
+    ff = state
+    fund(ff, 1, 2)
+
+    async def run():
+        task = asyncio.create_task(outbox.run(bot))
+        s = await ff.place_baucua_bet(app, -100, 1, ff.BAU_CUA_KEYS[0], 10_000)
+        await ff.place_baucua_bet(app, -100, 2, ff.BAU_CUA_KEYS[1], 10_000)
+        s.rng = ff.RNGStream(1)
+        dice = ff.baucua_roll(ff.RNGStream(1))
+        await ff.end_baucua_session(app, s)
+        task.cancel()
+        return dice
+
+    dice = asyncio.run(run())
+    mult = ff.BauCuaSession.multipliers(dice)
+    assert ff.balances[1] == 1_000_000 - 10_000 + 10_000 * mult[0]
+    assert ff.balances[2] == 1_000_000 - 10_000 + 10_000 * mult[1]
+    assert ff.accounts.held == 0
+    assert -100 not in ff.active_baucua
+
+
+@pytest.mark.parametrize("dice,expected", [([0, 0, 0], [4, 0, 0, 0, 0, 0]), ([0, 1, 1], [2, 3, 0, 0, 0, 0])])
+def test_multipliers(state, dice, expected):
+    assert state.BauCuaSession.multipliers(dice) == expected
@@ -0,0 +1,152 @@
+import asyncio
+from types import SimpleNamespace
+
+
+class ScriptedRNG:
+    """randrange answers from a script; randint always rolls the low end."""
+    def __init__(self, picks):
+        self.picks = list(picks)
+
+    def randrange(self, n):
+        return self.picks.pop(0)
+
+    def randint(self, lo, hi):
+        return lo
+
+
+def tc_engine(ff, rng):
+    lobby = ff.FFLobby(-100, "tc")
+    for uid, team in ((1, 0), (2, 0), (3, 1), (4, 1)):
+        p = lobby.players[uid] = ff.FFPlayer(uid, f"u{uid}")
+        p.team = team
+        p.hp = 1
+    return ff.FFEngine(lobby, rng)
+
+
+def test_last_standing_teammate_is_not_knocked(state):
+    ff = state
+    # shot 1: u3 downs u1 (u2 still up); shot 2: u3 downs u2, nobody on team 0 is standing
+    engine = tc_engine(ff, ScriptedRNG([2, 0, 2, 1]))
+    engine.tick()
+    a, b = engine.players[1], engine.players[2]
+    assert a.knocked and a.alive
+    assert not b.knocked and not b.alive
+    assert engine.team_up[0] == 0 and engine.team_alive[0] == 1
+
+    engine.tick()  # u1 bleeds out
+    assert not a.alive and engine.teams_left() == 1 and engine.finished()
+    assert engine.players[3].kills == 2
+
+
+def test_players_still_knocked_when_combat_ends_do_not_survive(state):
+    ff = state
+    # u3 downs u1 while u2 is up and u2 only grazes u4; combat runs out before u1 bleeds out
+    engine = tc_engine(ff, ScriptedRNG([2, 0, 1, 0]))
+    engine.players[4].hp = 100
+    engine.tick()
+    assert engine.players[1].knocked
+    engine.bleed_out()
+    survivors = [p for p in engine.standings() if p.alive]
+    assert [p.user_id for p in survivors if p.team == 0] == [2]
+    assert not engine.knocked and engine.team_alive[0] == 1 == engine.team_up[0]
+
+
+def test_tc_lobby_creator_gets_a_team(state, bot):
+    ff = state
+
+    async def answer(text=None, show_alert=False):
+        pass
+    q = SimpleNamespace(from_user=SimpleNamespace(id=1, username="u1", full_name=""),
+                        message=SimpleNamespace(chat=SimpleNamespace(id=-100)), answer=answer)
+
+    asyncio.run(ff.ff_mode_callback(SimpleNamespace(callback_query=q), SimpleNamespace(args=("ff_mode", "tc"), bot=bot)))
+    assert ff.ff_lobbies.get(-100).players[1].team == 0
+
+
+def ticket(ff, uid, rating, since=0.0, chat_id=-100):
+    return ff.FFTicket(uid, f"u{uid}", chat_id, rating, since)
+
+
+def test_lone_timed_out_ticket_leaves_the_queue(state):
+    ff = state
+    queue = ff.FFQueue("st")
+    queue.add(ticket(ff, 1, 1000))
+    matches, stranded = queue.take(ff.MATCHMAKING_MAX_WAIT)
+    assert matches == [] and [t.user_id for t in stranded] == [1]
+    assert len(queue) == 0 and queue.keys == []
+
+
+def test_timed_out_tickets_match_across_buckets(state):
+    ff = state
+    queue = ff.FFQueue("st")
+    queue.add(ticket(ff, 1, 1000))
+    queue.add(ticket(ff, 2, 3000, since=5.0))
+    matches, stranded = queue.take(ff.MATCHMAKING_MAX_WAIT - 1)
+    assert matches == [] and stranded == []  # buckets too far apart to widen into yet
+    matches, stranded = queue.take(ff.MATCHMAKING_MAX_WAIT)
+    assert [[t.user_id for t in m] for m in matches] == [[1, 2]] and stranded == []
+
+
+def test_match_ids_never_collide_with_chat_ids(state, app):
+    ff = state
+
+    async def run():
+        return ff.start_ff_match(app, "tc", [ticket(ff, 1, 1000, chat_id=5), ticket(ff, 2, 1000, chat_id=-100)])
+
+    lobby = asyncio.run(run())
+    assert lobby.chat_id < -(1 << 52)
+    assert ff.ff_matches.get(lobby.chat_id) is lobby
+    assert set(ff.SessionRegistry.chats) == {lobby.chat_id}
+    assert sorted(p.team for p in lobby.players.values()) == [0, 1]
+
+
+def lobby_press(ff, app, uid, action, chat_id, edits):
+    async def answer(text=None, show_alert=False):
+        pass
+
+    async def edit_message_text(text, **kwargs):
+        edits.append(text)
+    q = SimpleNamespace(from_user=SimpleNamespace(id=uid, username=f"u{uid}", full_name=""),
+                        answer=answer, edit_message_text=edit_message_text)
+    return ff.ff_lobby_callback(SimpleNamespace(callback_query=q),
+                                SimpleNamespace(args=(action, chat_id), application=app))
+
+
+def test_small_lobby_plays_locally_with_its_teams(state, app, monkeypatch):
+    ff = state
+    started = []
+
+    async def matchmaking(app, lobby):
+        started.append(lobby)
+    monkeypatch.setattr(ff, "ff_matchmaking", matchmaking)
+    lobby = ff.FFLobby(-100, "tc")
+    for uid, team in ((1, 0), (2, 1)):
+        lobby.players[uid] = ff.FFPlayer(uid, f"u{uid}")
+        lobby.players[uid].team = team
+    ff.ff_lobbies.open(lobby)
+    edits = []
+
+    async def run():
+        await lobby_press(ff, app, 1, "ff_start", -100, edits)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert started == [lobby] and lobby.started
+    assert len(ff.ff_queues["tc"]) == 0
+    assert {uid: p.team for uid, p in lobby.players.items()} == {1: 0, 2: 1}
+
+
+def test_lone_starter_is_queued(state, app):
+    ff = state
+    lobby = ff.FFLobby(-100, "st")
+    lobby.players[1] = ff.FFPlayer(1, "u1")
+    ff.ff_lobbies.open(lobby)
+    edits = []
+
+    async def run():
+        await lobby_press(ff, app, 1, "ff_start", -100, edits)
+        ff.ff_queues["st"].timer.cancel()
+
+    asyncio.run(run())
+    assert 1 in ff.ff_queues["st"] and -100 not in ff.ff_lobbies
+    ff.ff_queues["st"].remove(1)
@@ -0,0 +1,38 @@
+import random
+import time
+
+import pytest
+
+
+def brute_top(scores, n):
+    return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_top_matches_a_full_sort(state, monkeypatch, seed):
+    ff = state
+    monkeypatch.setattr(ff, "TOP_CACHE_SIZE", 5)
+    rng = random.Random(seed)
+    board = ff.TopBoard()
+    for step in range(2000):
+        if rng.random() < 0.05:
+            board.add_many([(rng.randrange(40), rng.randint(-500, 500)) for _ in range(rng.choice((3, 12)))])
+        else:
+            board.add(rng.randrange(40), rng.randint(-500, 500))
+        if step % 7 == 0:
+            got = board.top(5)
+            # ties may come in any order; the scores must match exactly
+            assert [v for _, v in got] == [v for _, v in brute_top(board.scores, 5)]
+            assert all(board.scores[uid] == v for uid, v in got)
+
+
+def test_scoped_boards(state):
+    ff = state
+    ts = time.time()
+    ff.score_boards.add_many([(1, 300), (2, 100)], chat_id=-100, ts=ts)
+    ff.score_boards.add(2, 500, chat_id=-200, ts=ts)
+    day, week = ff.period_keys(ts)
+    assert ff.score_boards.top("g") == [(2, 600), (1, 300)]
+    assert ff.score_boards.top("c:-100") == [(1, 300), (2, 100)]
+    assert ff.score_boards.top("c:-200") == [(2, 500)]
+    assert ff.score_boards.top(day) == ff.score_boards.top(week) == [(2, 600), (1, 300)]
@@ -0,0 +1,100 @@
+import asyncio
+
+
+async def run_outbox(ff, bot, body):
+    outbox = ff.Outbox()
+    task = asyncio.create_task(outbox.run(bot))
+    try:
+        await body(outbox)
+        await outbox.drain(5)
+    finally:
+        task.cancel()
+    return outbox
+
+
+def test_edit_queued_while_in_flight_is_sent(state, bot):
+    ff = state
+    bot.delay = 0.05
+
+    async def body(outbox):
+        outbox.edit(-100, 7, "v1")
+        await asyncio.sleep(0.01)  # v1 is now in flight
+        outbox.edit(-100, 7, "v2")
+
+    outbox = asyncio.run(run_outbox(ff, bot, body))
+    assert [kw["text"] for m, kw in bot.calls] == ["v1", "v2"]
+    assert outbox.stats["merged"] == 0 and outbox.stats["sent"] == 2
+    assert not outbox.edits
+
+
+def test_queued_edits_merge(state, bot):
+    ff = state
+
+    async def body(outbox):
+        outbox.send(-100, "hello")  # occupies the chat while the edits queue
+        outbox.edit(-100, 7, "v1")
+        outbox.edit(-100, 7, "v2")
+        outbox.edit(-100, 7, "v3")
+
+    outbox = asyncio.run(run_outbox(ff, bot, body))
+    assert [kw["text"] for m, kw in bot.calls] == ["hello", "v3"]
+    assert outbox.stats["merged"] == 2
+
+
+def test_results_go_before_edits(state, bot):
+    ff = state
+
+    async def body(outbox):
+        for i in range(3):
+            outbox.edit(-100 - i, 1, f"edit{i}")
+        outbox.send(-200, "result", ff.PRIO_RESULT)
+
+    asyncio.run(run_outbox(ff, bot, body))
+    assert bot.calls[0][1]["text"] == "result"
+
+
+def test_failed_send_falls_back_and_resolves(state, bot):
+    ff = state
+    sent = []
+
+    async def send_message(chat_id, text=None, **kwargs):
+        if chat_id == -1:
+            raise RuntimeError("chat not found")
+        sent.append(chat_id)
+        return object()
+    bot.send_message = send_message
+
+    async def body(outbox):
+        assert await outbox.send(-1, "x", fallback=-100) is not None
+        assert await outbox.send(-1, "y") is None
+
+    asyncio.run(run_outbox(ff, bot, body))
+    assert sent == [-100]
+
+
+def test_merged_edit_ages_from_its_newest_text(state):
+    ff = state
+
+    async def run():
+        outbox = ff.Outbox()
+        outbox.edit(-100, 7, "v1")
+        item = outbox.edits[(-100, 7)]
+        item.created -= ff.OUT_EDIT_MAX_AGE + 1  # v1 would be dropped as stale
+        outbox.edit(-100, 7, "v2")
+        return item, asyncio.get_running_loop().time()
+
+    item, now = asyncio.run(run())
+    assert item.kwargs["text"] == "v2" and now - item.created < ff.OUT_EDIT_MAX_AGE
+
+
+def test_unchanged_edit_counts_as_delivered(state, bot):
+    ff = state
+
+    async def edit_message_text(**kwargs):
+        raise ff.BadRequest("Message is not modified")
+    bot.edit_message_text = edit_message_text
+
+    async def body(outbox):
+        assert await outbox.edit(-100, 7, "same") is True
+
+    asyncio.run(run_outbox(ff, bot, body))
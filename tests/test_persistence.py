@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+from conftest import reset_stores
+
+
+def snapshot_of(ff):
+    return (dict(ff.balances), dict(ff.user_names), dict(ff.leaderboard), dict(ff.score_boards.cells.items()),
+            dict(ff.ff_ratings), dict(ff.subscriptions))
+
+
+def fill(ff):
+    ff.apply_delta(1, 100_000, "reg")
+    ff.apply_delta(2, 50_000, "reg")
+    ff.apply_bulk([(1, 30_000, 30_000), (2, -5_000, -5_000)], "payout", chat_id=-100)
+    ff.user_names[1] = "alice"
+    ff.persist.touch("user_names", 1)
+    ff.ff_ratings[1] = 1040
+    ff.persist.touch("ff_ratings", 1)
+    ff.subscriptions[-200] = ["tx", "xoso"]
+    ff.persist.touch("subscriptions", -200)
+
+
+def reload(ff):
+    reset_stores()
+    ff.persist.seq = 0
+    ff.load_data()
+
+
+def test_load_data_without_files(state):
+    state.load_data()
+    assert state.persist.seq == 0
+    assert not state.balances
+
+
+def test_ledger_replay_restores_state(state):
+    ff = state
+    ff.load_data()
+    fill(ff)
+    expected = snapshot_of(ff)
+    asyncio.run(ff.persist.flush())
+    with open(ff.LEDGER_FILE, encoding="utf-8") as f:
+        assert len(f.readlines()) == 3
+    reload(ff)
+    # names, ratings and subscriptions are only in a snapshot; balances and boards come back from the ledger
+    assert dict(ff.balances) == expected[0]
+    assert dict(ff.leaderboard) == expected[2]
+    assert dict(ff.score_boards.cells.items()) == expected[3]
+    assert ff.persist.seq == 3
+
+
+def test_snapshot_round_trip(state):
+    ff = state
+    ff.load_data()
+    fill(ff)
+    expected = snapshot_of(ff)
+    asyncio.run(ff.persist.flush(snapshot=True))
+    with open(ff.LEDGER_FILE, encoding="utf-8") as f:
+        assert f.read() == ""  # compacted into the snapshot
+    with open(ff.SAVE_FILE, encoding="utf-8") as f:
+        assert json.load(f)["seq"] == 3
+    reload(ff)
+    assert snapshot_of(ff) == expected
+    assert ff.score_boards.top("c:-100") == [(1, 30_000), (2, -5_000)]
+
+
+def test_snapshot_then_ledger_tail(state):
+    ff = state
+    ff.load_data()
+    fill(ff)
+    asyncio.run(ff.persist.flush(snapshot=True))
+    ff.apply_delta(2, 7_000, "liixi")
+    expected = snapshot_of(ff)
+    asyncio.run(ff.persist.flush())
+    reload(ff)
+    assert snapshot_of(ff) == expected
+    assert ff.persist.seq == 4
+
+
+def test_torn_ledger_line_is_skipped(state):
+    ff = state
+    ff.load_data()
+    ff.apply_delta(1, 10, "reg")
+    asyncio.run(ff.persist.flush())
+    with open(ff.LEDGER_FILE, "a", encoding="utf-8") as f:
+        f.write('{"k":"reg","u":1,"d":5')  # crash mid-write
+    reload(ff)
+    assert ff.balances[1] == 10
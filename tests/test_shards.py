@@ -0,0 +1,75 @@
+import asyncio
+import json
+
+
+def test_shard_shutdown_leaves_snapshot_alone(state, tmp_path, monkeypatch):
+    ff = state
+    ff.load_data()
+    ff.apply_delta(1, 100_000, "reg")
+    asyncio.run(ff.persist.flush(snapshot=True))
+    with open(ff.SAVE_FILE, encoding="utf-8") as f:
+        before = f.read()
+    shared = ff.SharedAccounts(str(tmp_path / "accounts.db"))
+    monkeypatch.setattr(ff, "shared", shared)
+    monkeypatch.setattr(ff, "persist", ff.Persistence())  # a worker's persistence never loaded anything
+    ff.persist.enabled = False
+    asyncio.run(ff.on_shutdown(None))
+    with open(ff.SAVE_FILE, encoding="utf-8") as f:
+        assert f.read() == before
+    assert json.loads(before)["balances"] == {"1": 100_000}
+
+
+def test_shared_writes_do_not_block_the_loop(state, tmp_path):
+    ff = state
+    path = str(tmp_path / "accounts.db")
+    shared = ff.SharedAccounts(path)
+    names, ratings, subs = shared.names, shared.ratings, shared.subscriptions
+    other = ff.sqlite3.connect(path, timeout=30, isolation_level=None)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        other.execute("BEGIN IMMEDIATE")  # another process holds the write lock
+        t0 = loop.time()
+        names[1] = "alice"
+        ratings.update({1: 1050})
+        subs[-100] = ["tx"]
+        subs[-200] = ["ff"]
+        subs.pop(-200)
+        assert loop.time() - t0 < 0.1
+        assert names[1] == "alice" and ratings.get(1) == 1050
+        assert subs.get(-100) == ["tx"] and -200 not in subs and subs.items() == [(-100, ["tx"])]
+        await asyncio.sleep(0.2)
+        other.execute("COMMIT")
+        await loop.run_in_executor(shared.executor, lambda: None)  # queued writes done
+        assert not ratings.pending and not subs.pending
+
+    asyncio.run(run())
+    check = ff.sqlite3.connect(path)
+    assert check.execute("SELECT v FROM user_names WHERE uid = 1").fetchone() == ("alice",)
+    assert check.execute("SELECT v FROM ff_ratings WHERE uid = 1").fetchone() == (1050,)
+    assert check.execute("SELECT chat, v FROM subscriptions").fetchall() == [(-100, "tx")]
+
+
+def test_shard_views_read_through_the_account_thread(state, tmp_path, monkeypatch):
+    ff = state
+    shared = ff.SharedAccounts(str(tmp_path / "accounts.db"))
+    shared.db.execute("INSERT INTO user_names VALUES (1, 'alice')")
+    shared.db.execute("INSERT INTO balances VALUES (1, 70000)")
+    boards = shared.boards
+
+    async def run():
+        assert shared.names.get(1, 1) == 1  # not cached yet: the caller's fallback
+        await asyncio.get_running_loop().run_in_executor(shared.executor, lambda: None)
+        await asyncio.sleep(0)
+        assert shared.names.get(1, 1) == "alice"
+        assert await ff.accounts.balance(1) == 70_000 and await ff.accounts.balance(2) == 0
+        await boards.add_many([(1, 300), (2, 100)], chat_id=-100, ts=ff.clock.time())
+        await boards.add(2, 500, chat_id=-200, ts=ff.clock.time())
+
+    with monkeypatch.context() as mp:  # undone before the state fixture resets the stores
+        mp.setattr(ff, "shared", shared)
+        mp.setattr(ff, "balances", shared.balances)
+        asyncio.run(run())
+    assert boards.top("g") == [(2, 600), (1, 300)]
+    assert boards.top("c:-100") == [(1, 300), (2, 100)]
+    assert boards.top(ff.period_keys(ff.clock.time())[0]) == [(2, 600), (1, 300)]
@@ -0,0 +1,61 @@
+import asyncio
+
+
+def run_timers(ff, body):
+    async def main():
+        service = ff.TimerService()
+        task = asyncio.create_task(service.run())
+        try:
+            return await body(service)
+        finally:
+            task.cancel()
+    return asyncio.run(main())
+
+
+def test_timers_fire_in_deadline_order(state):
+    ff = state
+    fired = []
+
+    async def body(service):
+        service.call_later(0.06, fired.append, "c")
+        service.call_later(0.02, fired.append, "a")
+        cancelled = service.call_later(0.03, fired.append, "x")
+        service.call_later(0.04, fired.append, "b")
+        cancelled.cancel()
+        await asyncio.sleep(0.1)
+        return service.fired
+
+    assert run_timers(ff, body) == 3
+    assert fired == ["a", "b", "c"]
+
+
+def test_reschedule_moves_a_deadline_both_ways(state):
+    ff = state
+    fired = []
+
+    async def body(service):
+        late = service.call_later(0.02, fired.append, "late")
+        early = service.call_later(0.2, fired.append, "early")
+        service.reschedule(late, service.now() + 0.08)  # later: the stale heap entry is re-queued
+        service.reschedule(early, service.now() + 0.04)  # earlier: pushed again
+        await asyncio.sleep(0.12)
+        return service.fired
+
+    assert run_timers(ff, body) == 2
+    assert fired == ["early", "late"]
+
+
+def test_sleep_and_coroutine_callbacks(state):
+    ff = state
+    fired = []
+
+    async def job(tag):
+        fired.append(tag)
+
+    async def body(service):
+        service.call_later(0.01, job, "job")
+        await service.sleep(0.03)
+        fired.append("slept")
+
+    run_timers(ff, body)
+    assert fired == ["job", "slept"]
@@ -0,0 +1,141 @@
+import asyncio
+from types import SimpleNamespace
+
+
+class EditRecorder:
+    """Stands in for ff.outbox; each edit is delivered unless `fail` is set."""
+    def __init__(self):
+        self.edits = []
+        self.fail = False
+
+    def edit(self, chat_id, message_id, text, **kwargs):
+        self.edits.append(text)
+        fut = asyncio.get_running_loop().create_future()
+        fut.set_result(None if self.fail else object())
+        return fut
+
+
+def test_countdown_keeps_ticking_in_a_quiet_round(state, monkeypatch):
+    ff = state
+    clock = [1000.0]
+    monkeypatch.setattr(ff.timers, "now", lambda: clock[0])
+    rec = EditRecorder()
+    monkeypatch.setattr(ff, "outbox", rec)
+    session = ff.TxSession(-100)
+    session.running = True
+    session.end_time = clock[0] + 30
+    session.message_id = 1
+    session.board.add(1, "an", "t", 10_000)
+
+    async def tick():
+        ff.tx_tick(None, session)
+        await asyncio.sleep(0)  # let the delivery callback run
+
+    async def run():
+        await tick()
+        await tick()  # same second, nothing changed
+        clock[0] += 5
+        await tick()  # no new bets, but the countdown moved
+
+    asyncio.run(run())
+    assert len(rec.edits) == 2
+    assert rec.edits[0].startswith("⏳ Phiên TX — còn 30s") and rec.edits[1].startswith("⏳ Phiên TX — còn 25s")
+    assert "an: Tài" in rec.edits[1]
+
+
+def test_failed_countdown_edit_is_sent_again(state, monkeypatch):
+    ff = state
+    monkeypatch.setattr(ff.timers, "now", lambda: 1000.0)
+    rec = EditRecorder()
+    monkeypatch.setattr(ff, "outbox", rec)
+    session = ff.TxSession(-100)
+    session.running = True
+    session.end_time = 1030.0
+    session.message_id = 1
+
+    async def run():
+        rec.fail = True
+        ff.tx_tick(None, session)
+        await asyncio.sleep(0)
+        rec.fail = False
+        ff.tx_tick(None, session)
+        await asyncio.sleep(0)
+        ff.tx_tick(None, session)
+
+    asyncio.run(run())
+    assert len(rec.edits) == 2 and rec.edits[0] == rec.edits[1] == session.board.sent_text
+
+
+def press(ff, app, uid, choice, amount, answers):
+    async def answer(text=None, show_alert=False):
+        answers.append((uid, text, ff.balances.get(uid, 0)))
+    q = SimpleNamespace(from_user=SimpleNamespace(id=uid, username=f"u{uid}", full_name=""),
+                        message=SimpleNamespace(chat_id=-100), answer=answer)
+    update = SimpleNamespace(callback_query=q)
+    context = SimpleNamespace(args=("tx", choice, amount), application=app)
+    return ff.tx_callback(update, context)
+
+
+def test_press_is_answered_before_its_batch_and_rejections_go_privately(state, app, bot, outbox):
+    ff = state
+    ff.apply_delta(1, 50_000, "reg")
+    answers = []
+
+    async def run():
+        task = asyncio.create_task(outbox.run(bot))
+        await asyncio.gather(press(ff, app, 1, "t", 20_000, answers), press(ff, app, 2, "x", 20_000, answers))
+        assert not ff.tx_intakes[-100].task.done()  # answered while the batch is still gathering
+        await asyncio.sleep(ff.TX_INTAKE_WINDOW * 3)
+        await outbox.drain(2)
+        task.cancel()
+
+    asyncio.run(run())
+    assert sorted(answers) == [(1, "⏳ Đã nhận cược Tài 20k", 50_000), (2, "⏳ Đã nhận cược Xỉu 20k", 0)]
+    # the round opens in the group; the rejected bettor hears about it in private only
+    assert [(kw["chat_id"], kw["text"]) for m, kw in bot.calls] == [
+        (-100, "🎲 Phiên TX bắt đầu — chờ cược..."),
+        (2, "❌ Cược Xỉu 20k không được đặt: Bạn không đủ tiền."),
+    ]
+    session = ff.active_tx.get(-100)
+    assert session.book.by_user() == {1: [20_000, 0]} and ff.balances[1] == 30_000
+
+
+def test_round_message_failure_refunds_the_batch(state, app, bot, outbox):
+    ff = state
+    ff.apply_delta(1, 50_000, "reg")
+
+    async def boom(*a, **k):
+        raise RuntimeError("network")
+    bot.send_message = boom
+
+    async def run():
+        task = asyncio.create_task(outbox.run(bot))
+        reasons = await ff.place_tx_bets(app, -100, [(1, "u1", "t", 20_000)])
+        task.cancel()
+        return reasons
+
+    assert asyncio.run(run()) == [ff.TX_FAILED_TEXT]
+    assert ff.balances[1] == 50_000 and ff.accounts.held == 0 and -100 not in ff.active_tx
+
+
+def test_round_settles_per_bettor(state, app, bot, outbox, monkeypatch):
+    ff = state
+    for uid in (1, 2):
+        ff.apply_delta(uid, 100_000, "reg")
+    monkeypatch.setattr(ff, "tx_roll", lambda rng, previous: "t")
+
+    async def run():
+        task = asyncio.create_task(outbox.run(bot))
+        reasons = await ff.place_tx_bets(app, -100, [(1, "u1", "t", 20_000), (1, "u1", "x", 5_000),
+                                                     (2, "u2", "x", 10_000), (2, "u2", "t", 500_000)])
+        session = ff.active_tx.get(-100)
+        await ff.end_tx_session(app, session)
+        task.cancel()
+        return reasons, session
+
+    reasons, session = asyncio.run(run())
+    assert reasons == [None, None, None, "Bạn không đủ tiền."]
+    assert len(session.book) == 3 and session.book.totals == [20_000, 15_000]
+    assert session.book.by_user() == {1: [20_000, 5_000], 2: [0, 10_000]}
+    assert ff.balances[1] == 115_000 and ff.balances[2] == 90_000
+    assert ff.accounts.held == 0 and session.settled and -100 not in ff.active_tx
@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+
+class RecordingApp:
+    def __init__(self, bot):
+        self.bot = bot
+        self.updates = []
+
+    async def process_update(self, update):
+        self.updates.append(update.update_id)
+
+
+def post(ff, update_id):
+    body = json.dumps({"update_id": update_id}).encode()
+    return (f"POST {ff.WEBHOOK_PATH} HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+
+
+def test_drain_closes_idle_keep_alive_connections(state, bot, monkeypatch):
+    ff = state
+    monkeypatch.setattr(ff, "WEBHOOK_SECRET", None)
+    app = RecordingApp(bot)
+
+    async def run():
+        server = ff.WebhookServer(app, workers=2)
+        await server.start("127.0.0.1", 0)
+        port = server._server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(post(ff, 1))
+        await writer.drain()
+        status = await reader.readline()
+        while await reader.readline() not in (b"\r\n", b""):
+            pass
+        await reader.readexactly(2)  # "{}"
+        assert len(server._conns) == 1  # the connection stays open, idle
+        handlers = list(server._conns.values())
+        await asyncio.wait_for(server.drain(timeout=1), 2)
+        assert await reader.read() == b""  # closed by the server
+        writer.close()
+        return status, handlers, server
+
+    status, handlers, server = asyncio.run(run())
+    assert status.startswith(b"HTTP/1.1 200")
+    assert app.updates == [1] and server.stats["processed"] == 1
+    assert not server._conns and all(t.done() and not t.cancelled() for t in handlers)
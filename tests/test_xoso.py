@@ -0,0 +1,54 @@
+import asyncio
+import random
+
+import pytest
+
+
+def brute_settle(ff, picks, stakes, drawn):
+    rows = {}
+    for uid, nums in picks.items():
+        h = len(set(nums) & set(drawn))
+        payout = stakes[uid] * h * ff.XOSO_ODDS // len(set(nums))
+        rows[uid] = (payout, payout - stakes[uid])
+    return rows
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_settle_matches_a_scan_of_every_pick(state, seed):
+    ff = state
+    rng = random.Random(seed)
+    book = ff.XoSoBook()
+    picks, stakes = {}, {}
+    for _ in range(300):
+        uid = rng.randrange(60)
+        nums = rng.sample(range(ff.XOSO_MIN, ff.XOSO_MAX + 1), rng.randint(1, ff.XOSO_MAX_CHOICES))
+        amount = rng.randint(1, 50) * 1000
+        old = book.add(uid, nums, amount)  # a repeat pick replaces the earlier one
+        assert old == stakes.get(uid, 0)
+        picks[uid], stakes[uid] = nums, amount
+    drawn = [rng.randint(ff.XOSO_MIN, ff.XOSO_MAX) for _ in range(3)]
+    rows, hits = book.settle(drawn)
+    assert {uid: (p, n) for uid, p, n in rows} == brute_settle(ff, picks, stakes, drawn)
+    assert book.staked == sum(stakes.values()) and len(book) == len(picks)
+    assert set(hits) == {uid for uid, nums in picks.items() if set(nums) & set(drawn)}
+
+
+def test_remove_clears_the_index(state):
+    ff = state
+    book = ff.XoSoBook()
+    book.add(1, [3, 7], 10_000)
+    assert book.remove(1) == 10_000
+    assert not any(book.index) and book.staked == 0
+    assert book.settle([3, 7, 7]) == ([], {})
+
+
+def test_evicted_round_cancels_its_draw(state, app, outbox):
+    ff = state
+
+    async def run():
+        session = ff.open_xoso_session(app, -100, 1)
+        await ff.evict_round(app, session)
+        return session
+
+    session = asyncio.run(run())
+    assert session.close_timer.done and session.tick_timer.done